@@ -0,0 +1,142 @@
+"""
+   batch.py
+
+   Batch mode shared by clean.py and classify.py: finds all the files of a stage's input directory in AWS that need to be processed
+   (see manifest.py), and processes them in a single run, with bounded concurrency for the downloads, the processing, and the uploads.
+
+   A file is matched to its output by name: e.g., 'raw_tweets/X.json' -> 'cleaned_tweets/X.csv' -> 'labelled_tweets/X.csv'
+
+"""
+
+import concurrent.futures
+import fnmatch
+import os
+import threading
+import time
+
+import boto3 # for working with AWS S3
+
+import metrics
+
+
+def list_AWS_files(aws_access, aws_secret, bucket, directory):
+
+   """
+      Lists the files in a directory of the AWS bucket
+
+      Input:
+         • aws_access: AWS access key
+         • aws_secret: AWS secret key
+         • bucket: name of bucket in AWS S3 storage
+         • directory: the directory/folder to list (e.g., 'raw_tweets/')
+
+      Output:
+         • files: dict of file name (without the directory) -> ETag (content hash given by AWS)
+   """
+
+   s3 = boto3.client('s3',
+                     aws_access_key_id = aws_access,
+                     aws_secret_access_key= aws_secret)
+
+   files = {}
+   paginator = s3.get_paginator('list_objects_v2')
+   for page in paginator.paginate(Bucket = bucket, Prefix = directory):
+      for obj in page.get('Contents', []):
+         name = obj['Key'][len(directory):]
+         if name and '/' not in name:
+            files[name] = obj['ETag'].strip('"')
+
+   return files
+
+def select_files(file_names, pattern):
+
+   """
+      Selects the files matching a pattern: a glob (e.g., 'outrage_tweets_streamed_*-Apr-2020.json'), or a prefix of the file names
+
+      Input:
+         • file_names: names of files
+         • pattern: glob or prefix
+
+      Output:
+         • sorted list of matching file names
+   """
+
+   if any(char in pattern for char in '*?['):
+      return sorted(name for name in file_names if fnmatch.fnmatch(name, pattern))
+
+   return sorted(name for name in file_names if name.startswith(pattern))
+
+def output_name(input_name, output_extension):
+
+   """ Returns the name of the output of a file (same name, with the output stage's extension, e.g. 'X.json.zst' -> 'X.csv') """
+
+   name = input_name
+   if name.endswith(('.zst', '.gz')):
+      name = os.path.splitext(name)[0]
+   return os.path.splitext(name)[0] + output_extension
+
+def run_batch(file_names, download, process, upload, num_downloads = 4, num_uploads = 4, process_executor = None):
+
+   """
+      Downloads, processes and uploads a batch of files. Each step runs concurrently for different files,
+      with at most num_downloads downloads, num_uploads uploads, and (process_executor's) workers at a time.
+
+      Input:
+         • file_names: names of the files to process
+         • download: function called with a file name, returns the local input file
+         • process: function called with the local input file and the file name (in process_executor), returns (local output file, number of rows)
+         • upload: function called with the local output file and the file name, returns True if successful
+         • num_downloads: maximum number of concurrent downloads
+         • num_uploads: maximum number of concurrent uploads
+         • process_executor: concurrent.futures executor that runs process (default: a single thread)
+
+      Output:
+         • results: dict of file name -> number of rows (or None if the file failed)
+   """
+
+   own_executor = process_executor is None
+   if own_executor:
+      process_executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+
+   download_slots = threading.Semaphore(num_downloads)
+   upload_slots = threading.Semaphore(num_uploads)
+   results = {}
+
+   def process_file(file_name):
+
+      try:
+         with download_slots:
+            with metrics.stage("download"):
+               local_input = download(file_name)
+               metrics.file_read(local_input)
+
+         with metrics.stage("process"):
+            local_output, num_rows = process_executor.submit(process, local_input, file_name).result()
+            metrics.rows(rows_in = 1, rows_out = num_rows)
+
+         with upload_slots:
+            with metrics.stage("upload"):
+               if not upload(local_output, file_name):
+                  raise ValueError("Upload of {} unsuccessful".format(local_output))
+               metrics.file_written(local_output)
+
+         results[file_name] = num_rows
+         print("{0} processed ({1} rows)".format(file_name, num_rows))
+
+      except Exception as e:
+         results[file_name] = None
+         print("Processing of {} unsuccessful. See error message: ".format(file_name))
+         print(e)
+
+   start = time.time()
+   max_files_in_flight = num_downloads + num_uploads + getattr(process_executor, '_max_workers', 1)
+   with concurrent.futures.ThreadPoolExecutor(max_workers = max_files_in_flight) as executor:
+      list(executor.map(process_file, file_names))
+
+   if own_executor:
+      process_executor.shutdown()
+
+   num_failed = sum(1 for rows in results.values() if rows is None)
+   print("Batch finished in {0:.1f} seconds: {1} files processed, {2} failed".format(time.time() - start, len(results) - num_failed, num_failed))
+
+   return results
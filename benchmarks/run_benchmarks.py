@@ -0,0 +1,282 @@
+"""
+   run_benchmarks.py
+
+   Benchmarks the stages of the pipeline on synthetic tweets (see synthetic_tweets.py), offline:
+   the GRU model and its tokenizer are replaced by stubs, and nothing is read from or written to AWS.
+
+   Each benchmark (stage x number of tweets) runs in its own process, and reports:
+      • seconds: wall-clock time of the stage
+      • rows_in / rows_out / rows_per_second: throughput of the stage
+      • peak_rss_mb: peak resident memory of the process (and peak_rss_delta_mb: increase during the stage)
+   The compress benchmark (raw tweets segments, see segments.py) also reports the bytes saved and the decode throughput.
+
+   Results are saved to a .json file, which can be compared against the results of a previous run (--compare).
+
+   Usage:
+      python benchmarks/run_benchmarks.py --sizes 1000 10000 --output bench_results.json
+      python benchmarks/run_benchmarks.py --compare bench_results_before.json
+
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+# the pipeline scripts live in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic_tweets
+
+
+class StubTokenizer(object):
+
+   """ Stand-in for the GRU model's tokenizer (keras Tokenizer): hashes words into a fixed vocabulary (with crc32, the same on every run, unlike the salted hash of str) """
+
+   def __init__(self, num_words = 20000):
+      self.num_words = num_words
+
+   def texts_to_sequences(self, texts):
+      return [[zlib.crc32(word.encode()) % (self.num_words - 1) + 1 for word in str(text).lower().split()] for text in texts]
+
+
+class StubGRU(object):
+
+   """ Stand-in for the GRU model: returns a deterministic probability per padded sequence """
+
+   def predict(self, sequences):
+      sequences = np.asarray(sequences, dtype = np.float64)
+      return (np.sin(sequences.sum(axis = 1)) * 0.5 + 0.5).reshape(-1, 1)
+
+
+def load_raw_tweets(local_file):
+   with open(local_file) as f:
+      return [json.loads(line) for line in f]
+
+def parse_tweets(local_file):
+   import clean
+   return clean.standard_parse(load_raw_tweets(local_file), 'benchmark')
+
+def preprocess(local_file):
+   import classify
+   return classify.preprocess_tweets(parse_tweets(local_file))
+
+def label_tweets(df):
+   df = df.copy()
+   df['gru_prob'] = np.linspace(0, 1, df.shape[0])
+   df['gru_binary'] = np.where(df['gru_prob'] > .51, 1, 0)
+   df['created_at'] = df['created_at'].astype(str)
+   return df
+
+
+"""
+   Benchmarked stages. Each stage has a setup function (not timed), called with the synthetic .json file,
+   and a run function (timed), called with the output of setup. run returns (rows_in, rows_out).
+"""
+
+def setup_parse(local_file):
+   return local_file
+
+def run_parse(local_file):
+   tweets = load_raw_tweets(local_file)
+   import clean
+   df = clean.standard_parse(tweets, 'benchmark')
+   return len(tweets), df.shape[0]
+
+def setup_preprocess(local_file):
+   import classify # fail early if the classifier's dependencies are missing
+   return parse_tweets(local_file)
+
+def run_preprocess(df):
+   import classify
+   rows_in = df.shape[0]
+   return rows_in, classify.preprocess_tweets(df).shape[0]
+
+def setup_predict(local_file):
+   return preprocess(local_file)
+
+def run_predict(df):
+   import classify
+   rows_in = df.shape[0]
+   return rows_in, classify.predict_values(df, StubGRU(), StubTokenizer()).shape[0]
+
+def setup_tweet_info(local_file):
+   return label_tweets(parse_tweets(local_file))
+
+def run_tweet_info(df):
+   import send_DMs
+   return df.shape[0], send_DMs.get_users_tweet_info(df).shape[0]
+
+def setup_compress(local_file):
+   import segments
+   try:
+      with open(local_file) as f:
+         dictionary = segments.train_dictionary([line for _, line in zip(range(10000), f)])
+      return local_file, 'zstd', dictionary
+   except ImportError:
+      return local_file, 'gzip', None
+
+def run_compress(state):
+   import segments
+   local_file, codec, dictionary = state
+   segment_file = segments.segment_name(local_file, codec)
+
+   writer = segments.SegmentWriter(segment_file, codec, dictionary = dictionary)
+   with open(local_file) as f:
+      for line in f:
+         writer.write(line)
+   writer.close()
+
+   start = time.perf_counter()
+   load_dictionary = {dictionary.dict_id(): dictionary}.get if dictionary is not None else None
+   num_lines = sum(1 for _ in segments.open_segment(segment_file, load_dictionary))
+   decode_seconds = time.perf_counter() - start
+
+   compressed_bytes = os.path.getsize(segment_file)
+   return writer.num_lines, num_lines, {'codec': codec, 'raw_bytes': writer.raw_bytes, 'compressed_bytes': compressed_bytes,
+      'bytes_saved': writer.raw_bytes - compressed_bytes, 'compression_ratio': writer.raw_bytes / compressed_bytes,
+      'decode_mb_per_second': writer.raw_bytes / 1e6 / decode_seconds}
+
+def run_end_to_end(local_file):
+   import classify
+   import send_DMs
+   import clean
+   tweets = load_raw_tweets(local_file)
+   df = classify.predict_values(classify.preprocess_tweets(clean.standard_parse(tweets, 'benchmark')), StubGRU(), StubTokenizer())
+   return len(tweets), send_DMs.get_users_tweet_info(df.loc[:, classify.LABELLED_COLUMNS]).shape[0]
+
+BENCHMARKS = {'parse': (setup_parse, run_parse),
+   'preprocess': (setup_preprocess, run_preprocess),
+   'predict': (setup_predict, run_predict),
+   'tweet_info': (setup_tweet_info, run_tweet_info),
+   'end_to_end': (setup_parse, run_end_to_end),
+   'compress': (setup_compress, run_compress)}
+
+
+def peak_rss_mb():
+   # ru_maxrss is in KB on Linux (bytes on macOS)
+   peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+   return peak / (1024 ** 2) if sys.platform == 'darwin' else peak / 1024
+
+def run_one(name, local_file, results):
+
+   """ Runs one benchmark (in a child process, so that peak memory is measured per benchmark) """
+
+   setup, run = BENCHMARKS[name]
+   try:
+      state = setup(local_file)
+      rss_before = peak_rss_mb()
+      start = time.perf_counter()
+      output = run(state)
+      seconds = time.perf_counter() - start
+      rss_after = peak_rss_mb()
+      # (run may also return a dict of benchmark-specific results)
+      rows_in, rows_out, extra = output if len(output) == 3 else output + ({},)
+      results.put(dict({'seconds': seconds, 'rows_in': rows_in, 'rows_out': rows_out,
+         'rows_per_second': rows_in / seconds if seconds > 0 else None,
+         'peak_rss_mb': rss_after, 'peak_rss_delta_mb': rss_after - rss_before}, **extra))
+   except ImportError as e:
+      results.put({'skipped': "missing dependency ({})".format(e)})
+   except Exception as e:
+      results.put({'error': "{0}: {1}".format(type(e).__name__, e)})
+
+def run_benchmark(name, local_file):
+
+   context = multiprocessing.get_context('fork')
+   results = context.Queue()
+   process = context.Process(target = run_one, args = (name, local_file, results))
+   process.start()
+   result = results.get()
+   process.join()
+   return result
+
+def get_metadata():
+
+   try:
+      commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr = subprocess.DEVNULL,
+         cwd = os.path.dirname(os.path.abspath(__file__))).decode().strip()
+   except Exception:
+      commit = None
+
+   return {'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+      'commit': commit,
+      'python': platform.python_version(),
+      'pandas': pd.__version__,
+      'platform': platform.platform(),
+      'cpu_count': os.cpu_count()}
+
+def compare(results, baseline, threshold):
+
+   """ Prints the change in wall-clock time of each benchmark, compared with a previous run """
+
+   previous = {(r['benchmark'], r['num_tweets']): r for r in baseline['results'] if 'seconds' in r}
+   print("\nComparison with {0} (commit {1}):".format(baseline['metadata']['date'], baseline['metadata']['commit']))
+
+   regressions = 0
+   for r in results:
+      key = (r['benchmark'], r['num_tweets'])
+      if 'seconds' not in r or key not in previous:
+         continue
+      ratio = r['seconds'] / previous[key]['seconds']
+      flag = ""
+      if ratio > 1 + threshold:
+         flag = "  <-- REGRESSION"
+         regressions += 1
+      print("   {0:<12} {1:>8} tweets: {2:8.3f}s -> {3:8.3f}s ({4:+.1%}){5}".format(key[0], key[1], previous[key]['seconds'], r['seconds'], ratio - 1, flag))
+
+   return regressions
+
+def main():
+
+   parser = argparse.ArgumentParser(description = "Benchmarks the pipeline stages on synthetic tweets (offline).")
+   parser.add_argument("--sizes", help = "Numbers of tweets to benchmark", nargs = "+", type = int, default = [1000, 10000])
+   parser.add_argument("--benchmarks", help = "Benchmarks to run", nargs = "+", choices = sorted(BENCHMARKS), default = sorted(BENCHMARKS))
+   parser.add_argument("--seed", help = "Random seed of the synthetic tweets", default = 0, type = int)
+   parser.add_argument("--output", help = "Name of .json file to save the results to", default = "bench_results.json")
+   parser.add_argument("--compare", help = "Name of .json file with the results of a previous run, to compare against")
+   parser.add_argument("--threshold", help = "Slowdown (fraction) reported as a regression when comparing", default = 0.1, type = float)
+   args = parser.parse_args()
+
+   results = []
+   with tempfile.TemporaryDirectory() as tmp_dir:
+      for num_tweets in args.sizes:
+         local_file = os.path.join(tmp_dir, "synthetic_{}.json".format(num_tweets))
+         file_size = synthetic_tweets.write_tweets(local_file, num_tweets, args.seed)
+         print("{0} synthetic tweets ({1:.1f} MB)".format(num_tweets, file_size / 1e6))
+
+         for name in args.benchmarks:
+            result = dict(benchmark = name, num_tweets = num_tweets, **run_benchmark(name, local_file))
+            results.append(result)
+
+            if 'seconds' in result:
+               print("   {0:<12} {1:8.3f}s  {2:>10.0f} rows/s  peak RSS {3:7.1f} MB".format(name, result['seconds'], result['rows_per_second'] or 0, result['peak_rss_mb']))
+               if 'compressed_bytes' in result:
+                  print("   {0:<12} {1}: {2:.1f} MB -> {3:.1f} MB ({4:.1f}x, {5:.1f} MB saved), decoded at {6:.0f} MB/s".format("", result['codec'],
+                     result['raw_bytes'] / 1e6, result['compressed_bytes'] / 1e6, result['compression_ratio'], result['bytes_saved'] / 1e6, result['decode_mb_per_second']))
+            else:
+               print("   {0:<12} {1}".format(name, result.get('skipped') or result.get('error')))
+
+   output = {'metadata': get_metadata(), 'results': results}
+   with open(args.output, 'w') as f:
+      json.dump(output, f, indent = 2)
+   print("Results saved to {}".format(args.output))
+
+   if args.compare:
+      with open(args.compare) as f:
+         baseline = json.load(f)
+      if compare(results, baseline, args.threshold):
+         sys.exit(1)
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,182 @@
+"""
+   synthetic_tweets.py
+
+   Deterministic generator of raw tweets (Twitter API v1.1 JSON, as streamed by stream.py), for benchmarking the pipeline offline.
+
+   The mix of tweets is similar to what the stream delivers: truncated tweets (with an extended_tweet), retweets, 'RT @' quotes,
+   tweets by verified users, tweets with coordinates, media, hashtags, links, mentions and emojis, and the occasional
+   limit notice (which has no 'text'). The same seed always gives the same tweets.
+
+   Usage:
+      python benchmarks/synthetic_tweets.py [output .json file] [number of tweets] [--seed SEED]
+
+"""
+
+import argparse
+import datetime
+import json
+import random
+
+WORDS = ['the', 'they', 'people', 'government', 'should', 'never', 'again', 'outrageous', 'disgusting', 'shame', 'news', 'today',
+   'president', 'vote', 'lies', 'health', 'virus', 'workers', 'unacceptable', 'angry', 'love', 'great', 'why', 'who', 'is',
+   'are', 'not', 'this', 'what', 'absolutely', 'ridiculous', 'every', 'single', 'time', 'just', 'stop', 'protect', 'our', 'kids']
+HASHTAGS = ['COVID19', 'coronavirus', 'StayHome', 'outrage', 'news', 'Election2020', 'MAGA', 'Resist', 'healthcare', 'lockdown']
+EMOJIS = ['\U0001F602', '\U0001F923', '\U0001F621', '\U0001F595', '\U0001F639', '\U0001F64F', '\U0001F44E', '\U0001F30A',
+   '\U0001F644', '\U0001F914', '\U0001F525', '❤']
+LOCATIONS = ['New York, NY', 'Los Angeles, CA', 'London', '', 'Earth', None]
+
+START_DATE = datetime.datetime(2020, 4, 3, 12, 0, 0)
+FIRST_TWEET_ID = 1246000000000000000
+
+
+def make_user(rnd, user_index):
+
+   """
+      Returns a synthetic (v1.1) user object
+   """
+
+   return {'id': 10000 + user_index,
+      'id_str': str(10000 + user_index),
+      'name': 'User {}'.format(user_index),
+      'screen_name': 'user_{}'.format(user_index),
+      'location': rnd.choice(LOCATIONS),
+      'description': ' '.join(rnd.choice(WORDS) for i in range(rnd.randint(0, 20))),
+      'verified': rnd.random() < 0.05,
+      'followers_count': rnd.randint(0, 100000),
+      'friends_count': rnd.randint(0, 5000),
+      'statuses_count': rnd.randint(1, 200000),
+      'favourites_count': rnd.randint(0, 100000),
+      'created_at': 'Mon Jan 01 00:00:00 +0000 2018',
+      'lang': None,
+      'profile_image_url_https': 'https://pbs.twimg.com/profile_images/{}/photo.jpg'.format(user_index)}
+
+def make_text(rnd, tweet_id, max_len):
+
+   """
+      Returns a synthetic tweet text, with its entities (hashtags, urls, mentions)
+   """
+
+   tokens = [rnd.choice(WORDS) for i in range(rnd.randint(3, 45))]
+   hashtags = rnd.sample(HASHTAGS, rnd.choice([0, 0, 1, 2, 3]))
+   mentions = ['user_{}'.format(rnd.randint(0, 999)) for i in range(rnd.choice([0, 0, 1, 2]))]
+   urls = ['https://example.com/{}'.format(tweet_id)] if rnd.random() < 0.3 else []
+   emojis = [rnd.choice(EMOJIS) for i in range(rnd.choice([0, 0, 0, 1, 2, 4]))]
+
+   text = ' '.join(['@' + m for m in mentions] + tokens + emojis + ['#' + h for h in hashtags] + ['https://t.co/' + str(tweet_id)[-10:] for u in urls])
+   entities = {'hashtags': [{'text': h, 'indices': [0, 0]} for h in hashtags],
+      'urls': [{'url': 'https://t.co/' + str(tweet_id)[-10:], 'expanded_url': u, 'indices': [0, 0]} for u in urls],
+      'user_mentions': [{'screen_name': m, 'id_str': m[5:], 'indices': [0, 0]} for m in mentions],
+      'symbols': []}
+
+   return text, entities, len(text) > max_len
+
+def make_tweet(rnd, index, num_users):
+
+   """
+      Returns the index-th synthetic raw tweet (dict)
+   """
+
+   tweet_id = FIRST_TWEET_ID + index * 1000 + rnd.randint(0, 999)
+   created_at = START_DATE + datetime.timedelta(seconds = index * 0.05)
+   user = make_user(rnd, rnd.randint(0, num_users - 1))
+   text, entities, truncated = make_text(rnd, tweet_id, 140)
+
+   tweet = {'created_at': created_at.strftime('%a %b %d %H:%M:%S +0000 %Y'),
+      'id': tweet_id,
+      'id_str': str(tweet_id),
+      'text': text[:140] if truncated else text,
+      'source': '<a href="http://twitter.com/download/iphone" rel="nofollow">Twitter for iPhone</a>',
+      'truncated': truncated,
+      'in_reply_to_status_id': None,
+      'in_reply_to_user_id': None,
+      'user': user,
+      'geo': None,
+      'coordinates': None,
+      'place': None,
+      'is_quote_status': False,
+      'quote_count': 0,
+      'reply_count': rnd.randint(0, 50),
+      'retweet_count': rnd.randint(0, 500),
+      'favorite_count': rnd.randint(0, 2000),
+      'entities': entities,
+      'favorited': False,
+      'retweeted': False,
+      'filter_level': 'low',
+      'lang': 'en',
+      'timestamp_ms': str(int(created_at.timestamp() * 1000))}
+
+   if truncated:
+      tweet['extended_tweet'] = {'full_text': text, 'display_text_range': [0, len(text)], 'entities': entities}
+
+   if rnd.random() < 0.05:
+      lat, lon = rnd.uniform(25, 49), rnd.uniform(-124, -67)
+      tweet['coordinates'] = {'type': 'Point', 'coordinates': [lon, lat]}
+      tweet['geo'] = {'type': 'Point', 'coordinates': [lat, lon]}
+
+   if rnd.random() < 0.1:
+      entities['media'] = [{'id_str': str(tweet_id + 1), 'media_url': 'http://pbs.twimg.com/media/{}.jpg'.format(tweet_id), 'type': 'photo'}]
+
+   # retweets (most of the stream) and 'RT @' quotes
+   kind = rnd.random()
+   if kind < 0.45:
+      original = make_tweet(random.Random(tweet_id), index + 1, num_users)
+      original.pop('retweeted_status', None)
+      tweet['retweeted_status'] = original
+      tweet['text'] = 'RT @' + original['user']['screen_name'] + ': ' + original['text']
+      tweet['truncated'] = False
+      tweet.pop('extended_tweet', None)
+   elif kind < 0.5:
+      tweet['text'] = 'RT @user_{}: '.format(rnd.randint(0, 999)) + tweet['text']
+
+   return tweet
+
+def generate_tweets(num_tweets, seed = 0, num_users = None):
+
+   """
+      Generates raw tweets (and limit notices, like the stream does)
+
+      Input:
+         • num_tweets: number of tweets
+         • seed: random seed (the same seed always gives the same tweets)
+         • num_users: number of distinct users (default: num_tweets / 4)
+
+      Output:
+         • generator of raw tweets (dicts)
+   """
+
+   rnd = random.Random(seed)
+   num_users = num_users or max(1, num_tweets // 4)
+
+   for index in range(num_tweets):
+      if index % 500 == 499:
+         yield {'limit': {'track': index, 'timestamp_ms': str(int(START_DATE.timestamp() * 1000))}}
+      else:
+         yield make_tweet(rnd, index, num_users)
+
+def write_tweets(local_file, num_tweets, seed = 0):
+
+   """
+      Writes synthetic raw tweets to a local .json file (one tweet per line, like stream.py's new_tweets.json)
+
+      Output:
+         • size of the file (bytes)
+   """
+
+   with open(local_file, 'w') as f:
+      for tweet in generate_tweets(num_tweets, seed):
+         f.write(json.dumps(tweet) + '\r\n')
+      return f.tell()
+
+def main():
+
+   parser = argparse.ArgumentParser(description = "Generates synthetic raw tweets (one JSON per line).")
+   parser.add_argument("output_file", help = "Name of .json file to write")
+   parser.add_argument("num_tweets", help = "Number of tweets to generate", type = int)
+   parser.add_argument("--seed", help = "Random seed", default = 0, type = int)
+   args = parser.parse_args()
+
+   size = write_tweets(args.output_file, args.num_tweets, args.seed)
+   print("{0} tweets written to {1} ({2:.1f} MB)".format(args.num_tweets, args.output_file, size / 1e6))
+
+if __name__ == '__main__':
+   main()
@@ -20,6 +20,7 @@ import numpy as np
 import helpers
 from helpers import val_ar, nb_model, nb_vectorizer, exp_outrage_list, top_emojis, threshold_acc
 import datetime
+import re
 
 import os
 import sys
@@ -35,6 +36,38 @@ from keras.preprocessing.sequence import pad_sequences
 from keras.models import load_model
 from scipy.sparse import hstack
 from joblib import dump, load
+import concurrent.futures
+import multiprocessing
+
+import metrics
+import batch
+import manifest
+import s3_stream
+import profiling
+import schema
+import lexicons
+
+# columns of the labelled tweets exported to AWS
+LABELLED_COLUMNS = ['user_name', 'user_screen_name', 'user_id', 'created_at', 'text', 'tweet_id', 'gru_prob', 'gru_binary']
+
+# quoted items of the entity lists of cleaned tweets read from .csv (e.g., "['covid', 'MeToo']")
+ENTITY_ITEM_PATTERN = re.compile(r"'([^']*)'|\"([^\"]*)\"")
+
+# number of tweets of each DataFrame, drawn at random, whose sparse lexicon scores are checked against the per-row functions
+# of helpers (see lexicon_scores)
+LEXICON_PARITY_ROWS = 1000
+# entity columns of clean.py used for the hashtag and link features (see entity_features)
+ENTITY_COLUMNS = ['tweet_hashtags', 'tweet_urls', 'tweet_media']
+
+# model files of the GRU classifier
+GRU_MODEL_FILE = "model_files/GRU_20200309.h5"
+TOKENIZER_FILE = "model_files/training.joblib"
+
+# model loaded once in each batch mode worker process (see load_worker_model)
+_worker_model = {}
+
+# lexicons compiled once per process (see lexicon_scores)
+_lexicon_scorer = {}
 
 def extract_from_AWS(aws_access, aws_secret, bucket, s3_file, local_file):
 
@@ -77,14 +110,151 @@ def extract_from_AWS(aws_access, aws_secret, bucket, s3_file, local_file):
       print("File download unsuccessful")
       print(e)
 
-def preprocess_tweets(data):
+def entity_list(value):
+
+   """
+
+      Returns an entity column value of a cleaned tweet (tweet_hashtags, tweet_urls, tweet_media) as a list: lists are
+      kept as they are (cleaned tweets in memory, e.g. in pipeline.py), lists read back from .csv are parsed,
+      and missing values (e.g., no media) are empty lists
+
+   """
+
+   if isinstance(value, list):
+      return value
+   if not isinstance(value, str) or len(value) <= 2:
+      return []
+   return [single or double for single, double in ENTITY_ITEM_PATTERN.findall(value)]
+
+def parity_sample(num_rows, sample_size):
+
+   """ Returns the positions of a random sample of sample_size rows (out of num_rows), the same on every run """
+
+   return np.random.default_rng(0).choice(num_rows, min(sample_size, num_rows), replace = False)
+
+def entity_features(data):
+
+   """
+
+      Computes the hashtag, has_hashtag and has_link features from the entity columns of clean.py (tweet_hashtags, tweet_urls,
+      tweet_media) instead of searching the text of each tweet. The features are defined by Twitter's entities, which leave out
+      text that only looks like a hashtag (e.g., "C#", "#1" or a bare "#"), so they can differ from the features found in the
+      text that the GRU model was trained on: see compare_entity_features for the (one-time) check of their effect on the predictions
+
+      Input:
+         • data: Pandas df with the entity columns
+
+      Output:
+         • hashtag, has_hashtag, has_link: lists
+
+   """
+
+   hashtags = [entity_list(value) for value in data['tweet_hashtags']]
+   media = data['tweet_media'] if 'tweet_media' in data.columns else [None] * data.shape[0]
+   hashtag = [' '.join(tweet_hashtags) for tweet_hashtags in hashtags]
+   has_hashtag = [1 if tweet_hashtags else 0 for tweet_hashtags in hashtags]
+   has_link = [1 if entity_list(urls) or entity_list(tweet_media) else 0 for urls, tweet_media in zip(data['tweet_urls'], media)]
+
+   return hashtag, has_hashtag, has_link
+
+def compare_entity_features(data, gru_embedding, embedding_tokenizer, sparse_lexicons = False):
+
+   """
+
+      Classifies cleaned tweets twice, with the hashtag and link features taken from the entity columns (entity_features) and
+      found in the text (as the GRU model was trained), and reports how often the features and the predictions differ.
+      Meant to be run once on a sample of real tweets (classify.py --compare_entity_features), not on every batch
+
+      Input:
+         • data: Pandas df of cleaned tweets, with the entity columns (not modified)
+         • gru_embedding, embedding_tokenizer: see predict_values
+         • sparse_lexicons: see preprocess_tweets
+
+      Output:
+         • differences: dict of the share of tweets whose features (hashtag, has_hashtag, has_link) and predictions
+           (gru_binary) differ, and the mean/max absolute difference of gru_prob
+
+   """
+
+   entity_data = preprocess_tweets(data.copy(), sparse_lexicons = sparse_lexicons)
+   text_data = preprocess_tweets(data.drop(columns = ENTITY_COLUMNS, errors = 'ignore'), sparse_lexicons = sparse_lexicons)
+
+   differences = {feature: float(np.mean(entity_data[feature].to_numpy() != text_data[feature].to_numpy()))
+      for feature in ['hashtag', 'has_hashtag', 'has_link']}
+   entity_preds = predict_values(entity_data, gru_embedding, embedding_tokenizer)
+   text_preds = predict_values(text_data, gru_embedding, embedding_tokenizer)
+   gru_prob_difference = np.abs(entity_preds['gru_prob'].to_numpy() - text_preds['gru_prob'].to_numpy())
+   differences['gru_binary'] = float(np.mean(entity_preds['gru_binary'].to_numpy() != text_preds['gru_binary'].to_numpy()))
+   differences['gru_prob_mean_difference'] = float(gru_prob_difference.mean()) if len(gru_prob_difference) else 0.0
+   differences['gru_prob_max_difference'] = float(gru_prob_difference.max()) if len(gru_prob_difference) else 0.0
+
+   print("Entity features vs. features found in the text, on {} tweets:".format(data.shape[0]))
+   for name, value in differences.items():
+      print("   {0}: {1:.4f}".format(name, value))
+
+   return differences
+
+def lexicon_scores(data):
+
+   """
+
+      Computes the arousal and expanded outrage features of all the tweets at once, with sparse matrix products (see lexicons.py),
+      from the psy_stemmed and len_tokenize columns. The scores are checked against helpers.get_arousal and
+      helpers.get_expanded_outrage on a random sample of LEXICON_PARITY_ROWS tweets, and on every tweet without tokens
+      (len_tokenize = 0, where the per-row functions may differ)
+
+      Input:
+         • data: Pandas df with the psy_stemmed and len_tokenize columns
+
+      Output:
+         • arousal, expanded_outrage: numpy arrays, or None if the lexicons can't be compiled or the scores don't match
+           the per-row functions (the features are then computed row by row)
+
+   """
+
+   if 'scorer' not in _lexicon_scorer:
+      try:
+         _lexicon_scorer['scorer'] = lexicons.LexiconScorer({'arousal': val_ar, 'expanded_outrage': exp_outrage_list})
+      except (TypeError, ValueError) as e:
+         print("Lexicons could not be compiled, computing the lexicon features row by row. See error message: ")
+         print(e)
+         _lexicon_scorer['scorer'] = None
+   scorer = _lexicon_scorer['scorer']
+   if scorer is None:
+      return None
+
+   counts = scorer.count_matrix(data['psy_stemmed'])
+   len_tokenize = data['len_tokenize'].to_numpy(dtype = np.float64)
+   arousal = np.divide(scorer.score(counts, 'arousal'), len_tokenize, out = np.zeros(len(len_tokenize)), where = len_tokenize > 0)
+   expanded_outrage = scorer.score(counts, 'expanded_outrage')
+
+   positions = np.union1d(parity_sample(len(data), LEXICON_PARITY_ROWS), np.flatnonzero(len_tokenize == 0))
+   sample = data.iloc[positions]
+   expected_arousal = [helpers.get_arousal(val_ar, row.psy_stemmed, row.len_tokenize) for row in sample.itertuples()]
+   expected_outrage = [helpers.get_expanded_outrage(exp_outrage_list, row.psy_stemmed) for row in sample.itertuples()]
+   if not (np.array_equal(arousal[positions], np.asarray(expected_arousal, dtype = np.float64)) and
+         np.array_equal(expanded_outrage[positions], np.asarray(expected_outrage, dtype = np.float64))):
+      print("Sparse lexicon scores don't match helpers.get_arousal / get_expanded_outrage, computing them row by row")
+      return None
+
+   # (same type as the per-row functions)
+   if all(isinstance(value, (int, np.integer)) for value in expected_outrage):
+      expanded_outrage = expanded_outrage.astype(np.int64)
+   return arousal, expanded_outrage
+
+def preprocess_tweets(data, scale = True, sparse_lexicons = False):
 
    """ 
    
       Performs additional preprocessing steps to prepare the data to be fed into the classifier. 
       
       Input:
-         • data: Pandas df of cleaned .csv file from AWS
+         • data: Pandas df of cleaned .csv file from AWS. The hashtags and links are taken from the entity columns of
+           clean.py (tweet_hashtags, tweet_urls, tweet_media) if they are there (see entity_features), and found in the
+           text otherwise (older files)
+         • scale: min-max scale the length/count features? (bool, default = True)
+         • sparse_lexicons: compute the arousal and expanded outrage features of all the tweets at once (lexicon_scores),
+           instead of row by row (bool, default = False)
 
       Output:
          • data: cleaned data
@@ -93,51 +263,84 @@ def preprocess_tweets(data):
 
    # preprocessing steps of text
 
-   # clean data
-   data['text'] = data['text'].astype('str')
+   # clean data (missing texts become 'nan', whether the column holds Python or Arrow strings)
+   data['text'] = data['text'].fillna('nan').astype('str')
    print("Preprocessing: Computing features")
+   metrics.rows(rows_in = data.shape[0])
 
    # the main features to be computed are "wn_lemmatize_hashtag", "get_arousal", "get_sentiment", "get_expanded_outrage"
-   data["hashtag"] = [helpers.get_hashtag(tweet) for tweet in data["text"]]
-   data["wn_lemmatize"] = [helpers.tweet_process(text) for text in data["text"]]
-   data['wn_lemmatize_hashtag'] = data.apply(lambda row: ' '.join([x for x in row.wn_lemmatize.split(" ") + row.hashtag.split(" ") if x]), axis=1)
-
-   data["psy_stemmed"], data["len_tokenize"] = zip(*data['text'].apply(helpers.psy_tweet_process))
-   data["get_arousal"] = data.apply(lambda row: helpers.get_arousal(val_ar, row.psy_stemmed, row.len_tokenize), axis = 1)
-   data['get_sentiment'] = data.apply(lambda row: helpers.get_sentiment(nb_model, nb_vectorizer, row.psy_stemmed), axis = 1)
-   data['get_expanded_outrage'] = data.apply(lambda row: helpers.get_expanded_outrage(exp_outrage_list, row.psy_stemmed), axis = 1)
+   has_entities = 'tweet_hashtags' in data.columns and 'tweet_urls' in data.columns
+   with metrics.stage("hashtag"):
+      entities = entity_features(data) if has_entities else None
+      if entities is not None:
+         data["hashtag"] = entities[0]
+      else:
+         data["hashtag"] = [helpers.get_hashtag(tweet) for tweet in data["text"]]
+   with metrics.stage("lemmatize"):
+      data["wn_lemmatize"] = [helpers.tweet_process(text) for text in data["text"]]
+      # (joined tweet by tweet over the two columns, without building a row Series for each tweet as DataFrame.apply does)
+      data['wn_lemmatize_hashtag'] = [' '.join([x for x in wn_lemmatize.split(" ") + hashtag.split(" ") if x])
+         for wn_lemmatize, hashtag in zip(data["wn_lemmatize"], data["hashtag"])]
+
+   with metrics.stage("psy_stemming"):
+      data["psy_stemmed"], data["len_tokenize"] = zip(*data['text'].apply(helpers.psy_tweet_process))
+   with metrics.stage("arousal"):
+      scores = lexicon_scores(data) if sparse_lexicons and data.shape[0] > 0 else None
+      if scores is not None:
+         data["get_arousal"] = scores[0]
+      else:
+         data["get_arousal"] = data.apply(lambda row: helpers.get_arousal(val_ar, row.psy_stemmed, row.len_tokenize), axis = 1)
+   with metrics.stage("sentiment"):
+      data['get_sentiment'] = data.apply(lambda row: helpers.get_sentiment(nb_model, nb_vectorizer, row.psy_stemmed), axis = 1)
+   with metrics.stage("expanded_outrage"):
+      if scores is not None:
+         data['get_expanded_outrage'] = scores[1]
+      else:
+         data['get_expanded_outrage'] = data.apply(lambda row: helpers.get_expanded_outrage(exp_outrage_list, row.psy_stemmed), axis = 1)
    print ("Prepocessing: Done. Start loading NLP features")
 
    #start getting NLP features + topic modelling is used
-   data['emojis_list'] = [helpers.extract_emojis(tweet) for tweet in data['text']]
+   with metrics.stage("emoji"):
+      data['emojis_list'] = [helpers.extract_emojis(tweet) for tweet in data['text']]
     
    # start getting NLP features
-   data['raw_len'] = data['text'].str.len()
-   data['has_hashtag'] = [1 if '#' in str(tweet) else 0 for tweet in data['text']]
-   data['has_mention'] = [1 if '@' in str(tweet) else 0 for tweet in data['text']]
-   data['has_link'] = [helpers.has_link(tweet) for tweet in data["text"]]
-   data['count_emoji'] = [sum([helpers.char_is_emoji(c) for c in str(tweet)]) for tweet in data['text']]
-   data['len_processed'] = data['wn_lemmatize'].str.len()
+   with metrics.stage("text_features"):
+      data['raw_len'] = data['text'].str.len()
+      if entities is not None:
+         data['has_hashtag'] = entities[1]
+         # (mentions aren't stored by clean.py: a substring check of the text, as before)
+         data['has_mention'] = [1 if '@' in str(tweet) else 0 for tweet in data['text']]
+         data['has_link'] = entities[2]
+      else:
+         data['has_hashtag'] = [1 if '#' in str(tweet) else 0 for tweet in data['text']]
+         data['has_mention'] = [1 if '@' in str(tweet) else 0 for tweet in data['text']]
+         data['has_link'] = [helpers.has_link(tweet) for tweet in data["text"]]
+      data['count_emoji'] = [sum([helpers.char_is_emoji(c) for c in str(tweet)]) for tweet in data['text']]
+      data['len_processed'] = data['wn_lemmatize'].str.len()
     
    # get top emojis and extract them into features
-   for i in top_emojis:
-      emoji_type = i[0]
-      name = emoji.unicode_codes.UNICODE_EMOJI[emoji_type]
-      data[name] = [1 if emoji_type in emoji_list else 0 for emoji_list in data['emojis_list']] 
+   with metrics.stage("top_emojis"):
+      for i in top_emojis:
+         emoji_type = i[0]
+         name = emoji.unicode_codes.UNICODE_EMOJI[emoji_type]
+         data[name] = [1 if emoji_type in emoji_list else 0 for emoji_list in data['emojis_list']] 
    # counting the Part of Speech
-   data['pos_count'] =  data.wn_lemmatize.map(lambda x: helpers.modify_pos(collections.Counter(elem[1] for elem in helpers.token_postag(x))))
+   with metrics.stage("pos"):
+      data['pos_count'] =  data.wn_lemmatize.map(lambda x: helpers.modify_pos(collections.Counter(elem[1] for elem in helpers.token_postag(x))))
 
-   # create 7 variables for the count of specific POS
-   POS = ['adj', 'verb', 'noun', 'adv', 'pronoun', 'wh', 'other']
-   for pos_tag in POS:
-      data[pos_tag] = data.pos_count.map(lambda x: 0 if pos_tag not in x else x[pos_tag])
+      # create 7 variables for the count of specific POS
+      POS = ['adj', 'verb', 'noun', 'adv', 'pronoun', 'wh', 'other']
+      for pos_tag in POS:
+         data[pos_tag] = data.pos_count.map(lambda x: 0 if pos_tag not in x else x[pos_tag])
 
    # scale + transform variables as necessary
    if scale:
-      scale_var = ["raw_len", "count_emoji","len_processed"] + POS
-      scaler = MinMaxScaler()
-      data[scale_var] = scaler.fit_transform(data[scale_var])
+      with metrics.stage("scale"):
+         scale_var = ["raw_len", "count_emoji","len_processed"] + POS
+         scaler = MinMaxScaler()
+         data[scale_var] = scaler.fit_transform(data[scale_var])
 
+   metrics.rows(rows_out = data.shape[0])
    return data
 
 def predict_values(df, gru_embedding, embedding_tokenizer):
@@ -157,9 +360,13 @@ def predict_values(df, gru_embedding, embedding_tokenizer):
    """
 
    # perform GRU prediction using tweet embedding model:
-   tweet_emb_processed = pad_sequences(embedding_tokenizer.texts_to_sequences(df['wn_lemmatize_hashtag']), 
-                                        padding='post', maxlen=50)
-   tweet_gru_predict  = gru_embedding.predict(tweet_emb_processed)
+   with metrics.stage("tokenize"):
+      sequences = embedding_tokenizer.texts_to_sequences(df['wn_lemmatize_hashtag'])
+   with metrics.stage("pad"):
+      tweet_emb_processed = pad_sequences(sequences, padding='post', maxlen=50)
+   with metrics.stage("gru_predict"):
+      tweet_gru_predict  = gru_embedding.predict(tweet_emb_processed)
+      metrics.rows(rows_in = df.shape[0], rows_out = len(tweet_gru_predict))
    df['gru_prob'] = tweet_gru_predict.ravel()
    df['gru_binary'] = np.where(df['gru_prob'] > .51, 1, 0)
    
@@ -239,16 +446,119 @@ def store_AWS(aws_access, aws_secret, local_file, bucket, s3_file):
 
    print("Export to AWS finished.")
 
+def load_worker_model():
+
+   """ Loads the GRU model and its tokenizer in a batch mode worker process (once per process, not once per file) """
+
+   _worker_model['gru_model'] = load_model(GRU_MODEL_FILE, custom_objects={'threshold_acc': threshold_acc})
+   _worker_model['embedding_tokenizer'] = load(TOKENIZER_FILE)
+
+def classify_file(import_file, export_file, sparse_lexicons = False):
+
+   """
+
+      Classifies a local .csv file of cleaned tweets, and writes the labelled tweets to a local .csv file (in a batch mode worker process)
+
+      Input:
+         • import_file: name/location of local .csv file of cleaned tweets
+         • export_file: name/location of local .csv file of labelled tweets
+         • sparse_lexicons: see preprocess_tweets
+
+      Output:
+         • number of labelled tweets
+
+   """
+
+   data = schema.apply_schema(pd.read_csv(import_file, lineterminator = '\n', encoding = 'utf-8-sig'), "cleaned tweets")
+   preds = predict_values(preprocess_tweets(data, sparse_lexicons = sparse_lexicons), _worker_model['gru_model'], _worker_model['embedding_tokenizer'])
+   preds.loc[:, LABELLED_COLUMNS].to_csv(export_file, index = False, encoding = 'utf-8-sig')
+   return preds.shape[0]
+
+def classify_batch(aws_access, aws_secret, bucket, pattern, stage_manifest, num_workers = 1, num_downloads = 4, num_uploads = 4, sparse_lexicons = False, force = False):
+
+   """
+
+      Classifies all the cleaned tweets files in AWS ('cleaned_tweets/') matching a pattern that don't have up-to-date labelled tweets ('labelled_tweets/').
+      The labelled tweets of 'cleaned_tweets/X.csv' are stored in 'labelled_tweets/X.csv'
+
+      Input:
+         • aws_access: AWS access key
+         • aws_secret: AWS secret key
+         • bucket: name of bucket in AWS S3 storage
+         • pattern: glob or prefix of the names of the cleaned tweets files (see batch.select_files)
+         • stage_manifest: manifest of the files classified in previous runs (manifest.Manifest), updated with the files classified
+         • num_workers: number of files classified in parallel (one process each, which loads the model once)
+         • num_downloads / num_uploads: maximum number of concurrent downloads / uploads
+         • sparse_lexicons: see preprocess_tweets
+         • force: classify every file matching the pattern, even if it is up to date in the manifest
+
+      Output:
+         • results: dict of file name -> number of labelled tweets (or None if the file failed)
+
+   """
+
+   cleaned_files = batch.list_AWS_files(aws_access, aws_secret, bucket, "cleaned_tweets/")
+   cleaned_files = {name: cleaned_files[name] for name in batch.select_files(cleaned_files, pattern)}
+   labelled_files = batch.list_AWS_files(aws_access, aws_secret, bucket, "labelled_tweets/")
+   file_names = stage_manifest.find_stale(cleaned_files, "cleaned_tweets/", labelled_files, "labelled_tweets/", ".csv", force)
+   print("{0} cleaned tweets files match '{1}', {2} of them need to be classified".format(len(cleaned_files), pattern, len(file_names)))
+
+   # input and output files have the same name, so they are kept in separate local directories
+   for directory in ["cleaned_tweets", "labelled_tweets"]:
+      os.makedirs(directory, exist_ok = True)
+
+   def download(file_name):
+      local_file = os.path.join("cleaned_tweets", file_name)
+      extract_from_AWS(aws_access, aws_secret, bucket, s3_file = file_name, local_file = local_file)
+      return local_file
+
+   def process(local_file, file_name):
+      export_file = os.path.join("labelled_tweets", batch.output_name(file_name, ".csv"))
+      return export_file, classify_pool.submit(classify_file, local_file, export_file, sparse_lexicons).result()
+
+   def upload(export_file, file_name):
+      stored = store_AWS(aws_access, aws_secret, export_file, bucket, os.path.basename(export_file))
+      if stored:
+         stage_manifest.record("cleaned_tweets/" + file_name, cleaned_files[file_name], "labelled_tweets/" + os.path.basename(export_file))
+      return stored
+
+   # (spawned, rather than forked, so that each worker has its own keras/tensorflow state)
+   with concurrent.futures.ProcessPoolExecutor(max_workers = num_workers, mp_context = multiprocessing.get_context('spawn'),
+         initializer = load_worker_model) as classify_pool, concurrent.futures.ThreadPoolExecutor(max_workers = num_workers) as process_executor:
+      results = batch.run_batch(file_names, download, process, upload, num_downloads, num_uploads, process_executor = process_executor)
+
+   return results
+
 def main():
 
    # get params
    parser = argparse.ArgumentParser(description = "File for streaming tweets and storing in AWS.")
    parser.add_argument("aws_credentials", help = "Text file with AWS credentials (AWS access, AWS secret)")
-   parser.add_argument("import_tweets_name", help = "Name of .csv file (without .csv extension) of cleaned tweets, to import from AWS", 
+   parser.add_argument("import_tweets_name", nargs = "?", help = "Name of .csv file (without .csv extension) of cleaned tweets, to import from AWS", 
         default = "outrage_tweets_streamed_{}".format(datetime.datetime.today().strftime ('%d-%b-%Y'))) # assumes that there exists a .csv file named by default of stream.py
-   parser.add_argument("export_tweets_name", help = "Name to give to .csv file (without .csv extension) of classified tweets exported to AWS", 
+   parser.add_argument("export_tweets_name", nargs = "?", help = "Name to give to .csv file (without .csv extension) of classified tweets exported to AWS", 
         default = "outrage_tweets_streamed_labeled_{}".format(datetime.datetime.today().strftime ('%d-%b-%Y'))) # named by current date, by default
+   parser.add_argument("--metrics_file", help = "Name of file to write the run's metrics to (Prometheus text format)")
+   parser.add_argument("--sparse_lexicons", help = "Compute the arousal and expanded outrage features of all the tweets at once, with sparse matrix products", action = "store_true")
+   parser.add_argument("--compare_entity_features", help = "Only compare the predictions with the hashtag and link features taken from the entity columns and found in the text (one-time check, nothing is exported)", 
+      action = "store_true")
+   parser.add_argument("--profile", help = "Profile each step of preprocessing and prediction (writes a ranked summary and a flame graph file)", action = "store_true")
+   parser.add_argument("--profile_output", help = "Name of the profile files (without extension)", default = "classify_profile")
+   parser.add_argument("--batch", help = "Batch mode: classify all the cleaned tweets files in AWS matching this glob or prefix (e.g., 'outrage_tweets_streamed_*') that aren't up to date in the manifest. " + 
+        "The labelled tweets of 'cleaned_tweets/X.csv' are stored in 'labelled_tweets/X.csv'")
+   parser.add_argument("--workers", help = "Batch mode: number of files classified in parallel (each worker loads the model)", default = 1, type = int)
+   parser.add_argument("--max_downloads", help = "Batch mode: maximum number of concurrent downloads", default = 4, type = int)
+   parser.add_argument("--max_uploads", help = "Batch mode: maximum number of concurrent uploads", default = 4, type = int)
+   parser.add_argument("--stage_locally", help = "Download the cleaned tweets to the local disk before reading them (instead of streaming them from AWS)", action = "store_true")
+   parser.add_argument("--force", help = "Classify the cleaned tweets even if they are up to date in the manifest (i.e., were already classified by the same code and model)", action = "store_true")
    args = parser.parse_args()
+   metrics.start_run("classify")
+
+   # profile each step (opt-in)
+   profiler = None
+   if args.profile:
+      profiler = profiling.StepProfiler().start()
+      metrics.add_stage_hook(profiler)
 
 
    # set up access to AWS
@@ -263,28 +573,75 @@ def main():
       aws_access = aws_creds.readline().split(sep = "=")[1].rstrip() # separate the equal sign, eliminate \n
       aws_secret = aws_creds.readline().split(sep = "=")[1].rstrip() # separate the equal sign, eliminate \n
 
-   # load files from AWS (extract_from_AWS)
-   try: 
-      # try extraction
-      extract_from_AWS(aws_access, aws_secret, bucket, s3_file = import_file_name, local_file = import_file_name)
+   # get manifest of the files classified in previous runs (reprocess the files that changed, or if the code or model changed)
+   stage_manifest = manifest.load_manifest(aws_access, aws_secret, bucket, "classify",
+      manifest.code_version([os.path.abspath(__file__), helpers.__file__, GRU_MODEL_FILE, TOKENIZER_FILE] +
+         [os.path.join(os.path.dirname(os.path.abspath(__file__)), name) for name in ["schema.py", "lexicons.py"]]))
+
+   # batch mode: classify all the files that aren't up to date
+   if args.batch is not None:
+      classify_batch(aws_access, aws_secret, bucket, args.batch, stage_manifest, args.workers, args.max_downloads, args.max_uploads, args.sparse_lexicons, args.force)
+      stage_manifest.save(aws_access, aws_secret, bucket)
+      metrics.finish_run(args.metrics_file)
+      print("Script execution finished.")
+      return
+
+   # skip the file if it was already classified (same content, same code and model) and its labelled tweets still exist
+   import_etag = manifest.get_etag(aws_access, aws_secret, bucket, "cleaned_tweets/" + import_file_name)
+   export_key = "labelled_tweets/" + export_file_name
+   output_keys = [export_key] if manifest.get_etag(aws_access, aws_secret, bucket, export_key) is not None else []
+   if not args.force and stage_manifest.is_up_to_date("cleaned_tweets/" + import_file_name, import_etag, output_keys):
+      print("{0} is up to date in the manifest (already classified to {1}). Use --force to classify it again".format(import_file_name, export_key))
+      metrics.finish_run(args.metrics_file)
+      print("Script execution finished.")
+      return
+
+   # stream the cleaned tweets from AWS (without staging the file on the local disk)
+   if not args.stage_locally:
+      with metrics.stage("load"):
+         data = s3_stream.read_csv(aws_access, aws_secret, bucket, "cleaned_tweets/" + import_file_name, lineterminator = '\n', encoding = 'utf-8-sig')
+         schema.apply_schema(data, "cleaned tweets")
+         metrics.rows(rows_out = data.shape[0])
+
+   # or load files from AWS (extract_from_AWS)
+   else:
+      try: 
+         # try extraction
+         with metrics.stage("download"):
+            extract_from_AWS(aws_access, aws_secret, bucket, s3_file = import_file_name, local_file = import_file_name)
+            metrics.file_read(import_file_name)
          
-      # check if file was exported successfully:
-      if import_file_name in os.listdir():
-         print("{} file successfully imported from AWS. Proceeding with parsing...".format(import_file_name))
-         print("\n")
-      else:
-         print("{} not found in the current directory (something may have gone wrong in the import?)".format(import_file_name))
-         raise ValueError("Data could not be imported")
-   except Exception as e:
-      print("Extraction from AWS failed. Please see error message: ")
-      print(e)
-
-   # import data
-   data = pd.read_csv(import_file_name, lineterminator = '\n', encoding = 'utf-8-sig')
+         # check if file was exported successfully:
+         if import_file_name in os.listdir():
+            print("{} file successfully imported from AWS. Proceeding with parsing...".format(import_file_name))
+            print("\n")
+         else:
+            print("{} not found in the current directory (something may have gone wrong in the import?)".format(import_file_name))
+            raise ValueError("Data could not be imported")
+      except Exception as e:
+         print("Extraction from AWS failed. Please see error message: ")
+         print(e)
+
+      # import data
+      with metrics.stage("load"):
+         data = schema.apply_schema(pd.read_csv(import_file_name, lineterminator = '\n', encoding = 'utf-8-sig'), "cleaned tweets")
+         metrics.file_read(import_file_name)
+         metrics.rows(rows_out = data.shape[0])
+
+   # one-time check of the entity features against the model, which was trained on the features found in the text
+   if args.compare_entity_features:
+      with metrics.stage("compare_entity_features"):
+         gru_model = load_model(GRU_MODEL_FILE, custom_objects={'threshold_acc': threshold_acc})
+         embedding_tokenizer = load(TOKENIZER_FILE)
+         compare_entity_features(data, gru_model, embedding_tokenizer, args.sparse_lexicons)
+      metrics.finish_run(args.metrics_file)
+      print("Script execution finished.")
+      return
 
    # clean (preprocess_tweets)
    try:
-      cleaned_data = preprocess_tweets(data)
+      with metrics.stage("preprocess"):
+         cleaned_data = preprocess_tweets(data, sparse_lexicons = args.sparse_lexicons)
       print("Data successfully preprocessed. Moving to next stage: classification")
    except Exception as e:
       print("Data preprocessing unsuccessful. See error message: ")
@@ -292,8 +649,9 @@ def main():
 
    # import model files
    try:
-      gru_model = load_model("model_files/GRU_20200309.h5", custom_objects={'threshold_acc': threshold_acc})
-      embedding_tokenizer = load('model_files/training.joblib')
+      with metrics.stage("load_model"):
+         gru_model = load_model(GRU_MODEL_FILE, custom_objects={'threshold_acc': threshold_acc})
+         embedding_tokenizer = load(TOKENIZER_FILE)
       print("Model files successfully loaded")
    except Exception as e:
       print("Error in loading model files")
@@ -302,7 +660,8 @@ def main():
 
    # predict values (using predict_values)
    try:
-      preds = predict_values(data, gru_model, embedding_tokenizer)
+      with metrics.stage("predict"):
+         preds = predict_values(data, gru_model, embedding_tokenizer)
       print("Predictions successful. Will export to AWS.")
    except Exception as e:
       print("Error in prediction step")
@@ -311,14 +670,22 @@ def main():
    # select rows and columns (depends on application. Hard-coded in this instance. Only select those that had outrage)
    #outrage_tweets = preds.loc[preds['gru_binary'] == 1, ['user_name', 'user_screen_name', 'user_id', 'created_at', 'text', 'tweet_id', 'gru_prob', 'gru_binary']]
    # edit: 20 April 2020 (export all predictions, not just those that have outrage)
-   outrage_tweets = preds.loc[:, ['user_name', 'user_screen_name', 'user_id', 'created_at', 'text', 'tweet_id', 'gru_prob', 'gru_binary']]
+   outrage_tweets = preds.loc[:, LABELLED_COLUMNS]
    # export as csv
-   outrage_tweets.to_csv(export_file_name, index = False, encoding = 'utf-8-sig')
+   with metrics.stage("write"):
+      outrage_tweets.to_csv(export_file_name, index = False, encoding = 'utf-8-sig')
+      metrics.file_written(export_file_name)
 
    # re-upload to AWS (store_AWS)
    try:
-      store_AWS(aws_access, aws_secret, export_file_name, bucket, export_file_name)
+      with metrics.stage("upload"):
+         stored = store_AWS(aws_access, aws_secret, export_file_name, bucket, export_file_name)
+         metrics.file_written(export_file_name)
       print("Tweets successfully stored in AWS")
+      # record the file in the manifest
+      if stored:
+         stage_manifest.record("cleaned_tweets/" + import_file_name, import_etag, export_key)
+         stage_manifest.save(aws_access, aws_secret, bucket)
    except Exception as e:
       print("AWS storage unsuccessful. Please see error message: ")
       print(e)
@@ -333,6 +700,10 @@ def main():
       print("Example: " + outrage_tweets['text'][i])
       print("\n")
 
+   metrics.finish_run(args.metrics_file)
+   if profiler is not None:
+      profiler.stop()
+      profiler.write_report(args.profile_output)
    print("Script execution finished.")
 
 if __name__ == "__main__":
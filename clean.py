@@ -15,12 +15,41 @@
 import boto3 # for working with AWS S3
 from botocore.exceptions import NoCredentialsError
 import argparse
+import array
+import numpy as np
 import pandas as pd
 import datetime
 import os
 import json
-
-def extract_from_AWS(aws_access, aws_secret, bucket, s3_file, local_file):
+import re
+import concurrent.futures
+import functools
+import mmap
+import threading
+
+import metrics
+import batch
+import manifest
+import s3_stream
+import segments
+import schema
+from dedup import TweetIdIndex
+from term_matcher import TermMatcher
+
+NAN = float('nan')
+# format of the dates of the raw tweets (e.g., 'Fri Apr 03 12:00:00 +0000 2020')
+CREATED_AT_FORMAT = '%a %b %d %H:%M:%S %z %Y'
+
+# maximum size of the byte ranges of raw tweets parsed by each process (see parallel_parse)
+RANGE_BYTES = 64 * 1024 * 1024
+
+# columns of the cleaned tweets (in order)
+TWEET_COLUMNS = ['created_at', 'text', 'tweet_id', 'user_screen_name', 'user_name', 'user_id', 
+   'user_followers_count', 'user_following_count', 'user_statuses_count', 'user_likes_given_count', 
+   'user_location', 'user_verified', 'user_description', 'tweet_lat', 'tweet_long', 
+   'tweet_retweet_count', 'tweet_favorite_count', 'tweet_reply_count', 'tweet_hashtags', 'tweet_urls', 'tweet_media', 'matched_terms']
+
+def extract_from_AWS(aws_access, aws_secret, bucket, s3_file, local_file, directory = "raw_tweets/"):
 
    """
       Imports .json file from AWS.
@@ -29,8 +58,9 @@ def extract_from_AWS(aws_access, aws_secret, bucket, s3_file, local_file):
          • aws_access: AWS access key
          • aws_secret: AWS secret key
          • bucket: name of bucket in AWS S3 storage (place to store data)
-         • s3_file: name of file in AWS (assumes that it is in the 'raw_tweets/' directory)
+         • s3_file: name of file in AWS
          • local_file: name/location of local .json file
+         • directory: the directory/folder that the file is in (default: 'raw_tweets/')
         
    """
    # use boto3 to interface with AWS
@@ -46,7 +76,7 @@ def extract_from_AWS(aws_access, aws_secret, bucket, s3_file, local_file):
     # load data from AWS
    try:
       s3.download_file(Bucket = bucket, 
-         Key = "raw_tweets/" + s3_file,
+         Key = directory + s3_file,
          Filename = local_file)
         
       print("Upload Successful")
@@ -62,7 +92,308 @@ def extract_from_AWS(aws_access, aws_secret, bucket, s3_file, local_file):
       print(e)
 
 
-def standard_parse(tweets, set_name):
+# fields of the raw tweets read by parse_tweet, kept when the raw tweets are projected at ingest (see project_tweet)
+# ('a.b': field b of object a, 'a[].b': field b of each object of list a)
+PARSED_FIELDS = ['created_at', 'text', 'truncated', 'extended_tweet.full_text', 'id_str', 'retweeted_status.id_str',
+    'user.screen_name', 'user.name', 'user.id_str', 'user.followers_count', 'user.friends_count', 'user.statuses_count',
+    'user.favourites_count', 'user.location', 'user.verified', 'user.description', 'coordinates',
+    'retweet_count', 'favorite_count', 'reply_count',
+    'entities.hashtags[].text', 'entities.urls[].expanded_url', 'entities.media[].media_url',
+    'extended_tweet.entities.hashtags[].text', 'extended_tweet.entities.urls[].expanded_url', 'extended_tweet.entities.media[].media_url', 'matched_terms']
+
+def projection(fields):
+
+    """
+
+        Turns a list of fields (see PARSED_FIELDS) into the nested dict used by project_tweet
+        Input:
+            • fields: list of fields ('a.b', 'a[].b')
+        Output:
+            • projection: dict of field -> None (keep the whole value) or projection of its sub-fields
+
+    """
+
+    tree = {}
+    for field in fields:
+        node = tree
+        keys = field.split('.')
+        for i, key in enumerate(keys):
+            is_last = i == len(keys) - 1
+            if is_last:
+                node[key] = None
+            else:
+                if node.get(key) is None and key in node:
+                    break # (the whole value is already kept)
+                node = node.setdefault(key, {})
+
+    return tree
+
+def project_tweet(tweet, fields_projection):
+
+    """
+
+        Keeps only some fields of a raw tweet (e.g., the fields read by parse_tweet), with the same nested structure,
+        so that the projected tweet can be parsed like the raw tweet
+        Input:
+            • tweet: raw tweet (dict)
+            • fields_projection: output of projection
+        Output:
+            • projected tweet (dict)
+
+    """
+
+    projected = {}
+    for key, sub_fields in fields_projection.items():
+        list_key = key[:-2] if key.endswith('[]') else key
+        if list_key not in tweet:
+            continue
+        value = tweet[list_key]
+        if sub_fields is None or value is None:
+            projected[list_key] = value
+        elif key.endswith('[]'):
+            projected[list_key] = [project_tweet(item, sub_fields) for item in value]
+        else:
+            projected[list_key] = project_tweet(value, sub_fields)
+
+    return projected
+
+# substrings of the raw JSON of every tweet that filter_reason filters out (see might_be_filtered)
+FILTER_MARKERS = ['"retweeted_status"', 'RT @']
+# (verified users, with or without whitespace around the colon, e.g. '"verified":true' or '"verified": true')
+VERIFIED_PATTERN = re.compile(r'"verified"\s*:\s*true')
+
+def might_be_filtered(data):
+
+    """
+
+        Cheap check of a raw tweet (JSON string, before it is decoded): False if the tweet is certainly kept by filter_reason, 
+        True if it has to be decoded to know (it isn't a tweet, or contains the key of a retweet, 'RT @' or a verified user somewhere)
+
+    """
+
+    return '"text"' not in data or any(marker in data for marker in FILTER_MARKERS) or VERIFIED_PATTERN.search(data) is not None
+
+def filter_reason(tweet):
+
+    """
+
+        Returns why a raw tweet is filtered out by parse_tweet: 'not_tweet' (e.g., limit notices), 'retweet', 'verified',
+        or None if the tweet is kept
+
+    """
+
+    if 'text' not in tweet:
+        return 'not_tweet'
+    if 'retweeted_status' in tweet or 'RT @' in tweet['text']:
+        return 'retweet'
+    if tweet['user']['verified']:
+        return 'verified'
+    return None
+
+def tag_matched_terms(tweet, matcher):
+
+    """
+
+        Adds the search terms matched by a raw tweet to the tweet ('matched_terms', stored with the raw tweet by stream.py)
+        Input:
+            • tweet: raw tweet (dict), left as is if it isn't a tweet (e.g., limit notices)
+            • matcher: term_matcher.TermMatcher of the search terms
+
+    """
+
+    if 'text' in tweet:
+        tweet['matched_terms'] = matcher.match(tweet['extended_tweet']['full_text'] if tweet.get('truncated') else tweet['text'])
+
+def tweet_entities(tweet):
+
+    """
+
+        Returns the entities of a raw tweet (hashtags, urls, media): those of the full text for truncated tweets
+        (the entities of a truncated tweet only cover its first 140 characters), unless they weren't stored
+
+    """
+
+    if tweet['truncated'] and 'entities' in tweet.get('extended_tweet', {}):
+        return tweet['extended_tweet']['entities']
+    return tweet['entities']
+
+def parse_tweet(tweet, matcher = None):
+
+    """
+
+        Returns the relevant data of a single raw tweet (the filtering and field extraction step of standard_parse)
+        Input:
+            • tweet: raw tweet (dict)
+            • matcher: term_matcher.TermMatcher of the search terms, to find the matched terms of tweets that weren't tagged 
+              when they were streamed (optional, see tag_matched_terms)
+        Output:
+            • record: dict with relevant tweet data (same keys as the columns of standard_parse), 
+              or None if the tweet is filtered out (retweets, tweets by verified users, non-tweet messages)
+
+    """
+
+    if filter_reason(tweet) is not None:
+        return None
+
+    user = tweet['user']
+    entities = tweet_entities(tweet)
+
+    record = {'created_at': tweet['created_at'],\
+       'text': tweet['extended_tweet']['full_text'] if tweet['truncated'] else tweet['text'],\
+       'tweet_id': tweet['id_str'],\
+       'user_screen_name': user['screen_name'],\
+       'user_name': user['name'],\
+       'user_id': user['id_str'],\
+       'user_followers_count': user['followers_count'],\
+       'user_following_count': user['friends_count'],\
+       'user_statuses_count': user['statuses_count'],\
+       'user_likes_given_count': user['favourites_count'],\
+       'user_location': user['location'],\
+       'user_verified': user['verified'],\
+       'user_description': user['description'],\
+       'tweet_lat': tweet['coordinates']['coordinates'][1] if tweet['coordinates'] else NAN,\
+       'tweet_long': tweet['coordinates']['coordinates'][0] if tweet['coordinates'] else NAN,\
+       'tweet_retweet_count': tweet['retweet_count'],\
+       'tweet_favorite_count': tweet['favorite_count'],\
+       'tweet_reply_count': tweet['reply_count'],\
+       'tweet_hashtags': [hashtag['text'] for hashtag in entities['hashtags']],\
+       'tweet_urls': list(url['expanded_url'] for url in entities['urls']),\
+       'tweet_media': list(url['media_url'] for url in entities['media']) if 'media' in entities else None,\
+       'matched_terms': tweet['matched_terms'] if 'matched_terms' in tweet else None}
+
+    if matcher is not None and 'matched_terms' not in tweet:
+        record['matched_terms'] = matcher.match(record['text'])
+
+    return record
+
+class TweetEntities(object):
+
+    """ Variable-length lists of a parsed tweet (one compact object per tweet, without an instance dict) """
+
+    __slots__ = ('hashtags', 'urls', 'media', 'matched_terms')
+
+    def __init__(self, hashtags, urls, media, matched_terms):
+        self.hashtags = hashtags
+        self.urls = urls
+        self.media = media
+        self.matched_terms = matched_terms
+
+class RecordBuilder(object):
+
+    """
+
+        Builds the columns of the cleaned tweets (see TWEET_COLUMNS) one tweet at a time, in typed arrays: int64 IDs and counts, 
+        float64 coordinates (NaN if missing), bool user_verified. Strings are kept in lists, and the entity lists in TweetEntities.
+        The DataFrame is then assembled from the arrays as they are (to_df), without turning each value into a Python object
+        Usage:
+            builder = RecordBuilder()
+            builder.add(tweet)   (or builder.add_record(record), with a record of parse_tweet)
+            df = builder.to_df(set_name)
+
+    """
+
+    STRING_COLUMNS = ['created_at', 'text', 'user_screen_name', 'user_name', 'user_location', 'user_description']
+    INT_COLUMNS = ['tweet_id', 'user_id', 'user_followers_count', 'user_following_count', 'user_statuses_count', 'user_likes_given_count',
+        'tweet_retweet_count', 'tweet_favorite_count', 'tweet_reply_count']
+    FLOAT_COLUMNS = ['tweet_lat', 'tweet_long']
+
+    def __init__(self):
+        self.strings = {column: [] for column in self.STRING_COLUMNS}
+        self.ints = {column: array.array('q') for column in self.INT_COLUMNS}
+        self.floats = {column: array.array('d') for column in self.FLOAT_COLUMNS}
+        self.verified = array.array('b')
+        self.entities = []
+
+        # (bound append methods, in the order of the values of add)
+        self._append_strings = [self.strings[column].append for column in self.STRING_COLUMNS]
+        self._append_ints = [self.ints[column].append for column in self.INT_COLUMNS]
+
+    def __len__(self):
+        return len(self.entities)
+
+    def add(self, tweet, matcher = None):
+
+        """ Adds a raw tweet that passed the filters (see filter_reason). Same fields as parse_tweet """
+
+        user = tweet['user']
+        entities = tweet_entities(tweet)
+        coordinates = tweet['coordinates']
+        text = tweet['extended_tweet']['full_text'] if tweet['truncated'] else tweet['text']
+
+        for append, value in zip(self._append_strings, (tweet['created_at'], text, user['screen_name'], user['name'], user['location'], user['description'])):
+            append(value)
+        for append, value in zip(self._append_ints, (int(tweet['id_str']), int(user['id_str']), user['followers_count'], user['friends_count'],
+                user['statuses_count'], user['favourites_count'], tweet['retweet_count'], tweet['favorite_count'], tweet['reply_count'])):
+            append(value)
+        self.floats['tweet_lat'].append(coordinates['coordinates'][1] if coordinates else NAN)
+        self.floats['tweet_long'].append(coordinates['coordinates'][0] if coordinates else NAN)
+        self.verified.append(user['verified'])
+
+        if 'matched_terms' in tweet:
+            matched_terms = tweet['matched_terms']
+        else:
+            matched_terms = matcher.match(text) if matcher is not None else None
+        self.entities.append(TweetEntities([hashtag['text'] for hashtag in entities['hashtags']],
+            [url['expanded_url'] for url in entities['urls']],
+            [url['media_url'] for url in entities['media']] if 'media' in entities else None,
+            matched_terms))
+
+    def add_record(self, record):
+
+        """ Adds a parsed tweet (output of parse_tweet) """
+
+        for append, column in zip(self._append_strings, self.STRING_COLUMNS):
+            append(record[column])
+        for append, column in zip(self._append_ints, self.INT_COLUMNS):
+            append(int(record[column]))
+        for column in self.FLOAT_COLUMNS:
+            self.floats[column].append(float(record[column]))
+        self.verified.append(record['user_verified'])
+        self.entities.append(TweetEntities(record['tweet_hashtags'], record['tweet_urls'], record['tweet_media'], record['matched_terms']))
+
+    def to_df(self, set_name, keep_duplicates = False):
+
+        """ Returns the DataFrame of the tweets added (duplicate tweet IDs dropped, unless keep_duplicates), with a set_id column of set_name """
+
+        columns = {}
+        columns.update((column, values) for column, values in self.strings.items())
+        columns.update((column, np.frombuffer(values, dtype = np.int64)) for column, values in self.ints.items())
+        columns.update((column, np.frombuffer(values, dtype = np.float64)) for column, values in self.floats.items())
+        columns['user_verified'] = np.frombuffer(self.verified, dtype = np.int8).astype(bool)
+        columns['tweet_hashtags'] = [entities.hashtags for entities in self.entities]
+        columns['tweet_urls'] = [entities.urls for entities in self.entities]
+        columns['tweet_media'] = [entities.media for entities in self.entities]
+        columns['matched_terms'] = [entities.matched_terms for entities in self.entities]
+
+        df = pd.DataFrame(columns, columns = TWEET_COLUMNS)
+        if not keep_duplicates:
+            df.drop_duplicates(subset = 'tweet_id', inplace = True)
+        df.reset_index(drop = True, inplace = True)
+        df['created_at'] = pd.to_datetime(df['created_at'], format = CREATED_AT_FORMAT)
+        df['set_id'] = set_name # column lets us define the source of the data
+
+        return df
+
+def records_to_df(records, set_name):
+
+    """
+
+        Turns a list of parsed tweets (from parse_tweet) into a DataFrame
+        Input:
+            • records: list of dicts (output of parse_tweet)
+            • set_name: name to give to set of tweets
+        Output:
+            • df: df with relevant tweet data
+
+    """
+
+    builder = RecordBuilder()
+    for record in records:
+        builder.add_record(record)
+
+    return builder.to_df(set_name)
+
+def standard_parse(tweets, set_name, dedup_index = None, matcher = None, keep_duplicates = False):
 
     """
 
@@ -70,83 +401,220 @@ def standard_parse(tweets, set_name):
         Input:
             • tweets: raw tweets
             • set_name: name to give to set of tweets (useful if parsing multiple bunches of tweets and then concatenating)
+            • dedup_index: index of the tweet IDs parsed in previous runs (dedup.TweetIdIndex, optional). 
+              Tweets already in the index are dropped, and the new tweet IDs are added to it
+            • matcher: term_matcher.TermMatcher, to fill the matched_terms column of tweets not tagged when streamed (optional)
+            • keep_duplicates: keep the tweets delivered more than once (e.g., to drop them later, see parallel_parse)
         Output:
-            • df: df with relevant tweet data
+            • df: df with relevant tweet data (see RecordBuilder)
 
     """
     
-    data = {'created_at':[],\
-       'text':[],\
-       'tweet_id':[],\
-       'user_screen_name':[],\
-       'user_name':[],\
-       'user_id':[],\
-       'user_followers_count':[],\
-       'user_following_count':[],\
-       'user_statuses_count':[],\
-       'user_likes_given_count':[],\
-       'user_location':[],\
-       'user_verified':[],\
-       'user_description':[],\
-       'tweet_lat':[],\
-       'tweet_long':[],\
-       'tweet_retweet_count':[],\
-       'tweet_favorite_count':[],\
-       'tweet_reply_count': [],\
-       'tweet_hashtags':[],\
-       'tweet_urls':[],\
-       'tweet_media':[]}
-    
+    builder = RecordBuilder()
     for tweet in tweets:
-        if 'text' in tweet:
-            if 'retweeted_status' not in tweet and 'RT @' not in tweet['text'] and not tweet['user']['verified']:
-                data['created_at'].append(tweet['created_at'])
-
-                if tweet['truncated']:
-                    data['text'].append(tweet['extended_tweet']['full_text'])
-                elif not tweet['truncated']:
-                    data['text'].append(tweet['text'])
-
-                data['tweet_id'].append(tweet['id_str'])
-                data['user_screen_name'].append(tweet['user']['screen_name'])
-                data['user_name'].append(tweet['user']['name'])
-                data['user_id'].append(tweet['user']['id_str'])
-                data['user_followers_count'].append(tweet['user']['followers_count'])
-                data['user_following_count'].append(tweet['user']['friends_count'])
-                data['user_statuses_count'].append(tweet['user']['statuses_count'])
-                data['user_likes_given_count'].append(tweet['user']['favourites_count'])
-                data['user_location'].append(tweet['user']['location'])
-                data['user_verified'].append(tweet['user']['verified'])
-                data['user_description'].append(tweet['user']['description'])
-
-                if tweet['coordinates']:
-                    data['tweet_lat'].append(tweet['coordinates']['coordinates'][1])
-                    data['tweet_long'].append(tweet['coordinates']['coordinates'][0])
-                elif not tweet['coordinates']:
-                    data['tweet_lat'].append('NaN')
-                    data['tweet_long'].append('NaN')
-
-                data['tweet_retweet_count'].append(tweet['retweet_count'])
-                data['tweet_favorite_count'].append(tweet['favorite_count'])
-                data['tweet_reply_count'].append(tweet['reply_count'])
-                data['tweet_hashtags'].append([hashtag['text'] for hashtag in tweet['entities']['hashtags']])
-                data['tweet_urls'].append(list(url['expanded_url'] for url in tweet['entities']['urls']))
-
-                if 'media' in tweet['entities']:
-                    data['tweet_media'].append(list(url['media_url'] for url in tweet['entities']['media']))
-                else:
-                    data['tweet_media'].append('NaN')
-
-    df = pd.DataFrame(data)
-
-    df.drop_duplicates(subset = 'tweet_id', inplace = True)
+        if filter_reason(tweet) is not None:
+            continue
+        if dedup_index is not None and not dedup_index.add(tweet['id_str'], set_name):
+            continue
+        builder.add(tweet, matcher)
+
+    return builder.to_df(set_name, keep_duplicates)
+
+def clean_file(import_file, set_name, load_dictionary = None, matcher = None):
+
+    """
+
+        Reads a local .json file of raw tweets (one tweet per line, uncompressed or a compressed segment) and parses it
+        Input:
+            • import_file: name/location of local .json file
+            • set_name: name to give to set of tweets
+            • load_dictionary: function called with a zstd dictionary ID, returns the dictionary (see segments.open_segment)
+            • matcher: see standard_parse
+        Output:
+            • df: df with relevant tweet data (see standard_parse)
+
+    """
+
+    return standard_parse(s3_stream.JSONLines(segments.open_segment(import_file, load_dictionary)), set_name, matcher = matcher)
+
+def split_ranges(import_file, num_ranges):
+
+    """
+
+        Splits a local .json file of raw tweets (uncompressed, one tweet per line) into byte ranges of about the same size,
+        that start and end at line boundaries
+        Input:
+            • import_file: name/location of local .json file
+            • num_ranges: number of ranges
+        Output:
+            • ranges: list of (start, end) byte offsets, in the order of the file
+
+    """
+
+    size = os.path.getsize(import_file)
+    if size == 0:
+        return []
+
+    boundaries = [0]
+    with open(import_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+        for i in range(1, num_ranges):
+            newline = mapped.find(b'\n', max(size * i // num_ranges, boundaries[-1]))
+            if newline == -1:
+                break
+            if newline + 1 < size:
+                boundaries.append(newline + 1)
+    boundaries.append(size)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def parse_range(import_file, start, end, set_name, matcher = None):
+
+    """
+
+        Parses the raw tweets of a byte range of a local .json file (see split_ranges), like standard_parse (without the dedup index)
+        Output:
+            • df: df with relevant tweet data (see RecordBuilder), with the tweets delivered more than once
+            • num_lines: number of raw tweets read
+
+    """
+
+    with open(import_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+        tweets = s3_stream.JSONLines(mapped[start:end].decode('utf-8').split('\n'))
+        df = standard_parse(tweets, set_name, matcher = matcher, keep_duplicates = True)
+
+    return df, tweets.num_lines
+
+def parallel_parse(import_file, set_name, num_workers, dedup_index = None, matcher = None, load_dictionary = None):
+
+    """
+
+        Parses a local .json file of raw tweets on several cores: the file is memory-mapped and split into byte ranges at line
+        boundaries (several per worker, of at most RANGE_BYTES, to balance the work), each range is parsed by a process of a pool,
+        and the tweets of the ranges are concatenated in the order of the file, without duplicate tweet IDs.
+        Compressed files are parsed on a single core (see clean_file)
+        Input:
+            • import_file: name/location of local .json file
+            • set_name: name to give to set of tweets
+            • num_workers: number of processes
+            • dedup_index: see standard_parse
+            • matcher: see standard_parse
+            • load_dictionary: see clean_file (compressed files only)
+        Output:
+            • df: df with relevant tweet data (see standard_parse)
+            • num_lines: number of raw tweets read
+
+    """
+
+    with open(import_file, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(s3_stream.GZIP_MAGIC) or magic == s3_stream.ZSTD_MAGIC:
+        tweets = s3_stream.JSONLines(segments.open_segment(import_file, load_dictionary))
+        df = standard_parse(tweets, set_name, dedup_index, matcher)
+        return df, tweets.num_lines
+
+    num_ranges = max(num_workers * 4, -(-os.path.getsize(import_file) // RANGE_BYTES))
+    ranges = split_ranges(import_file, num_ranges)
+    with concurrent.futures.ProcessPoolExecutor(max_workers = num_workers) as executor:
+        futures = [executor.submit(parse_range, import_file, start, end, set_name, matcher) for start, end in ranges]
+        results = [future.result() for future in futures]
+
+    if not results:
+        return RecordBuilder().to_df(set_name), 0
+
+    # (with a dedup index, the tweets delivered more than once are dropped and counted by the index)
+    df = pd.concat([range_df for range_df, num_lines in results], ignore_index = True)
+    if dedup_index is not None:
+        is_new = [dedup_index.add(tweet_id, set_name) for tweet_id in df['tweet_id']]
+        df = df[is_new]
+    else:
+        df.drop_duplicates(subset = 'tweet_id', inplace = True)
     df.reset_index(drop = True, inplace = True)
-    df['created_at'] = pd.to_datetime(df['created_at'])
-    df['set_id'] = set_name # column lets us define the source of the data
-    
-    return df
 
-def store_AWS(aws_access, aws_secret, local_file, bucket, s3_file):
+    return df, sum(num_lines for range_df, num_lines in results)
+
+def clean_batch(aws_access, aws_secret, bucket, pattern, stage_manifest, dedup_index = None, num_workers = 2, num_downloads = 4, num_uploads = 4, matcher = None, force = False):
+
+    """
+
+        Cleans all the raw tweets files in AWS ('raw_tweets/') matching a pattern that don't have up-to-date cleaned tweets ('cleaned_tweets/').
+        The cleaned tweets of 'raw_tweets/X.json' are stored in 'cleaned_tweets/X.csv'
+        Input:
+            • aws_access: AWS access key
+            • aws_secret: AWS secret key
+            • bucket: name of bucket in AWS S3 storage
+            • pattern: glob or prefix of the names of the raw tweets files (see batch.select_files)
+            • stage_manifest: manifest of the files cleaned in previous runs (manifest.Manifest), updated with the files cleaned
+            • dedup_index: index of the tweet IDs parsed in previous runs (dedup.TweetIdIndex, optional)
+            • num_workers: number of files parsed in parallel (one process each)
+            • num_downloads / num_uploads: maximum number of concurrent downloads / uploads
+            • matcher: see standard_parse
+            • force: clean every file matching the pattern, even if it is up to date in the manifest
+        Output:
+            • results: dict of file name -> number of cleaned tweets (or None if the file failed)
+
+    """
+
+    raw_files = batch.list_AWS_files(aws_access, aws_secret, bucket, "raw_tweets/")
+    raw_files = {name: raw_files[name] for name in batch.select_files(raw_files, pattern)}
+    cleaned_files = batch.list_AWS_files(aws_access, aws_secret, bucket, "cleaned_tweets/")
+    file_names = stage_manifest.find_stale(raw_files, "raw_tweets/", cleaned_files, "cleaned_tweets/", ".csv", force)
+    print("{0} raw tweets files match '{1}', {2} of them need to be cleaned".format(len(raw_files), pattern, len(file_names)))
+
+    # zstd dictionaries of the compressed raw tweets segments
+    load_dictionary = functools.partial(s3_stream.load_AWS_dictionary, aws_access, aws_secret, bucket)
+
+    # tweet IDs added to the dedup index by each file (removed again if the file fails to be written or stored)
+    dedup_lock = threading.Lock()
+    added_tweet_ids = {}
+
+    def forget_tweet_ids(file_name):
+        if dedup_index is not None:
+            with dedup_lock:
+                dedup_index.remove(added_tweet_ids.pop(file_name, []))
+
+    def download(file_name):
+        extract_from_AWS(aws_access, aws_secret, bucket, s3_file = file_name, local_file = file_name)
+        return file_name
+
+    def process(local_file, file_name):
+        set_name = batch.output_name(file_name, '')
+        df = parse_pool.submit(clean_file, local_file, set_name, load_dictionary, matcher).result()
+
+        # drop tweets parsed in previous runs (or in other files of the batch)
+        if dedup_index is not None:
+            with dedup_lock:
+                is_new = [dedup_index.add(tweet_id, set_name) for tweet_id in df['tweet_id']]
+            added_tweet_ids[file_name] = list(df['tweet_id'][is_new])
+            df = df[is_new].reset_index(drop = True)
+
+        try:
+            schema.apply_schema(df, "cleaned tweets of " + file_name)
+            export_file = batch.output_name(file_name, ".csv")
+            df.to_csv(export_file, index = False, encoding = 'utf-8-sig')
+        except Exception:
+            forget_tweet_ids(file_name)
+            raise
+        return export_file, df.shape[0]
+
+    def upload(export_file, file_name):
+        try:
+            stored = store_AWS(aws_access, aws_secret, export_file, bucket, export_file)
+            if stored:
+                stage_manifest.record("raw_tweets/" + file_name, raw_files[file_name], "cleaned_tweets/" + export_file)
+        except Exception:
+            forget_tweet_ids(file_name)
+            raise
+        if not stored:
+            forget_tweet_ids(file_name)
+        return stored
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers = num_workers) as parse_pool, \
+            concurrent.futures.ThreadPoolExecutor(max_workers = num_workers) as process_executor:
+        results = batch.run_batch(file_names, download, process, upload, num_downloads, num_uploads, process_executor = process_executor)
+
+    return results
+
+def store_AWS(aws_access, aws_secret, local_file, bucket, s3_file, directory = "cleaned_tweets/"):
 
    """
       Takes the exported file and stores it into aws
@@ -156,6 +624,7 @@ def store_AWS(aws_access, aws_secret, local_file, bucket, s3_file):
          • local_file: name/location of local .csv file
          • bucket: name of bucket in AWS S3 storage (place to store data)
          • s3_file: name of file once it is stored in AWS
+         • directory: name of directory to store the file (default: 'cleaned_tweets/')
    """
 
    # use boto3 to interface with AWS
@@ -170,7 +639,7 @@ def store_AWS(aws_access, aws_secret, local_file, bucket, s3_file):
 
    # upload data to AWS
    try:
-      s3.upload_file(local_file, bucket, "cleaned_tweets/" + s3_file)
+      s3.upload_file(local_file, bucket, directory + s3_file)
       print("Upload Successful")
       return True
    except FileNotFoundError:
@@ -186,20 +655,59 @@ def store_AWS(aws_access, aws_secret, local_file, bucket, s3_file):
 
    print("Export to AWS finished.")
 
+def save_dedup_index(aws_access, aws_secret, bucket, dedup_index, retention_days, stored):
+
+    """
+
+        Saves the index of parsed tweet IDs and stores it in AWS ('dedup_index/'), if the cleaned tweets were stored. 
+        Otherwise, the changes to the index are discarded (so that the tweets are cleaned again in the next run)
+
+    """
+
+    if dedup_index is None:
+        return
+
+    if not stored:
+        dedup_index.rollback()
+        dedup_index.close()
+        print("Index of parsed tweet IDs not updated, since the cleaned tweets weren't stored")
+        return
+
+    dedup_index.prune(retention_days)
+    dedup_index.commit()
+    dedup_index.close()
+    with metrics.stage("upload"):
+        store_AWS(aws_access, aws_secret, dedup_index.db_file, bucket, os.path.basename(dedup_index.db_file), directory = "dedup_index/")
+        metrics.file_written(dedup_index.db_file)
+
 def main():
 
     # get params
     parser = argparse.ArgumentParser(description = "File for cleaning tweets and storing in AWS.")
     parser.add_argument("aws_credentials", help = "Text file with AWS credentials (AWS access, AWS secret)")
-    parser.add_argument("import_tweets_name", help = "Name of .json file (without .json extension) of raw tweets, to import from AWS", 
+    parser.add_argument("import_tweets_name", nargs = "?", help = "Name of .json file (without .json extension) of raw tweets, to import from AWS", 
         default = "outrage_tweets_streamed_{}".format(datetime.datetime.today().strftime ('%d-%b-%Y'))) # assumes that there exists a .json file named by default of stream.py
-    parser.add_argument("export_tweets_name", help = "Name to give to .csv file (without .csv extension) of cleaned tweets exported to AWS", 
+    parser.add_argument("export_tweets_name", nargs = "?", help = "Name to give to .csv file (without .csv extension) of cleaned tweets exported to AWS", 
         default = "outrage_tweets_streamed_cleaned_{}".format(datetime.datetime.today().strftime ('%d-%b-%Y'))) # named by current date, by default
+    parser.add_argument("--metrics_file", help = "Name of file to write the run's metrics to (Prometheus text format)")
+    parser.add_argument("--dedup_index_name", help = "Name of the index of tweet IDs parsed in previous runs (in the 'dedup_index/' directory in AWS). Tweets already in the index are dropped", 
+        default = "tweet_id_index")
+    parser.add_argument("--no_dedup", help = "Don't drop tweets parsed in previous runs", action = "store_true")
+    parser.add_argument("--batch", help = "Batch mode: clean all the raw tweets files in AWS matching this glob or prefix (e.g., 'outrage_tweets_streamed_*') that aren't up to date in the manifest. " + 
+        "The cleaned tweets of 'raw_tweets/X.json' are stored in 'cleaned_tweets/X.csv'")
+    parser.add_argument("--workers", help = "Batch mode: number of files parsed in parallel", default = 2, type = int)
+    parser.add_argument("--max_downloads", help = "Batch mode: maximum number of concurrent downloads", default = 4, type = int)
+    parser.add_argument("--max_uploads", help = "Batch mode: maximum number of concurrent uploads", default = 4, type = int)
+    parser.add_argument("--dedup_retention_days", help = "Number of days that tweet IDs are kept in the index", default = 30, type = int)
+    parser.add_argument("--stage_locally", help = "Download the raw tweets to the local disk before parsing them (instead of streaming them from AWS)", action = "store_true")
+    parser.add_argument("--parse_workers", help = "Number of processes parsing the raw tweets of a file (the file is downloaded to the local disk first, as with --stage_locally)", default = 1, type = int)
+    parser.add_argument("--search_terms", help = "Search terms of the stream, to fill the matched_terms column of tweets that weren't tagged when they were streamed", nargs = "+")
+    parser.add_argument("--force", help = "Clean the raw tweets even if they are up to date in the manifest (i.e., were already cleaned by the same code)", action = "store_true")
     args = parser.parse_args()
+    metrics.start_run("clean")
+    matcher = TermMatcher(args.search_terms) if args.search_terms else None
     
     # set up access to AWS
-    import_file_name = args.import_tweets_name + ".json"
-    export_file_name = args.export_tweets_name + ".csv"
     aws_access = ''
     aws_secret = ''
     bucket = 'augmented-outrage-classifier-tweets' # name of bucket in AWS
@@ -208,29 +716,103 @@ def main():
         aws_access = aws_creds.readline().split(sep = "=")[1].rstrip() # separate the equal sign, eliminate \n
         aws_secret = aws_creds.readline().split(sep = "=")[1].rstrip() # separate the equal sign, eliminate \n
 
-    # load files from AWS (extract_from_AWS)
-    try: 
-        # try extraction
-        extract_from_AWS(aws_access, aws_secret, bucket, s3_file = import_file_name, local_file = import_file_name)
-        # check if file was exported successfully:
-        if import_file_name in os.listdir():
-            print("{} file successfully imported from AWS. Proceeding with parsing...".format(import_file_name))
-            print("\n")
-        else:
-            print("{} not found in the current directory (something may have gone wrong in the import?)".format(import_file_name))
-            raise ValueError("Data could not be imported")
-    except Exception as e:
-        print("Extraction from AWS failed. Please see error message: ")
-        print(e)
+    # get manifest of the files cleaned in previous runs (reprocess the files that changed, or if this script or the modules
+    # that shape its output changed)
+    source_directory = os.path.dirname(os.path.abspath(__file__))
+    stage_manifest = manifest.load_manifest(aws_access, aws_secret, bucket, "clean", manifest.code_version([os.path.abspath(__file__)] +
+        [os.path.join(source_directory, name) for name in ["term_matcher.py", "dedup.py", "schema.py", "segments.py", "s3_stream.py"]]))
+
+    # get index of tweet IDs parsed in previous runs
+    dedup_index = None
+    if not args.no_dedup:
+        dedup_index_file = args.dedup_index_name + ".sqlite"
+        with metrics.stage("download"):
+            extract_from_AWS(aws_access, aws_secret, bucket, s3_file = dedup_index_file, local_file = dedup_index_file, directory = "dedup_index/")
+            metrics.file_read(dedup_index_file)
+        dedup_index = TweetIdIndex(dedup_index_file)
+        print("Index of previously parsed tweets has {} tweet IDs".format(len(dedup_index)))
+
+    # batch mode: clean all the files that aren't up to date
+    if args.batch is not None:
+        clean_batch(aws_access, aws_secret, bucket, args.batch, stage_manifest, dedup_index, args.workers, args.max_downloads, args.max_uploads, matcher, args.force)
+        # (the tweet IDs of files that failed to be stored were already removed from the index)
+        save_dedup_index(aws_access, aws_secret, bucket, dedup_index, args.dedup_retention_days, stored = True)
+        stage_manifest.save(aws_access, aws_secret, bucket)
+        metrics.finish_run(args.metrics_file)
+        print("Script execution finished.")
+        return
 
-    # load JSON tweets
-    tweets = [json.loads(tweet) for tweet in open(import_file_name)]
+    import_file_name = args.import_tweets_name + ".json"
+    # (the raw tweets may be stored as a compressed segment, see segments.py)
+    for extension in ['', '.zst', '.gz']:
+        if manifest.get_etag(aws_access, aws_secret, bucket, "raw_tweets/" + import_file_name + extension) is not None:
+            import_file_name += extension
+            break
+    export_file_name = args.export_tweets_name + ".csv"
+
+    # skip the file if it was already cleaned (same content, same code) and its cleaned tweets still exist
+    import_etag = manifest.get_etag(aws_access, aws_secret, bucket, "raw_tweets/" + import_file_name)
+    export_key = "cleaned_tweets/" + export_file_name
+    output_keys = [export_key] if manifest.get_etag(aws_access, aws_secret, bucket, export_key) is not None else []
+    if not args.force and stage_manifest.is_up_to_date("raw_tweets/" + import_file_name, import_etag, output_keys):
+        print("{0} is up to date in the manifest (already cleaned to {1}). Use --force to clean it again".format(import_file_name, export_key))
+        save_dedup_index(aws_access, aws_secret, bucket, dedup_index, args.dedup_retention_days, stored = False)
+        metrics.finish_run(args.metrics_file)
+        print("Script execution finished.")
+        return
+
+    # stream the raw tweets from AWS: tweets are parsed as they are read, without staging the file on the local disk
+    load_dictionary = functools.partial(s3_stream.load_AWS_dictionary, aws_access, aws_secret, bucket)
+    if not args.stage_locally and args.parse_workers <= 1:
+        with metrics.stage("download"):
+            tweets = s3_stream.read_json_lines(aws_access, aws_secret, bucket, "raw_tweets/" + import_file_name)
+
+    # or load files from AWS (extract_from_AWS)
+    else:
+        try: 
+            # try extraction
+            with metrics.stage("download"):
+                extract_from_AWS(aws_access, aws_secret, bucket, s3_file = import_file_name, local_file = import_file_name)
+                metrics.file_read(import_file_name)
+            # check if file was exported successfully:
+            if import_file_name in os.listdir():
+                print("{} file successfully imported from AWS. Proceeding with parsing...".format(import_file_name))
+                print("\n")
+            else:
+                print("{} not found in the current directory (something may have gone wrong in the import?)".format(import_file_name))
+                raise ValueError("Data could not be imported")
+        except Exception as e:
+            print("Extraction from AWS failed. Please see error message: ")
+            print(e)
+
+        # load JSON tweets (unless they are parsed in parallel, straight from the file)
+        if args.parse_workers <= 1:
+            with metrics.stage("load"):
+                tweets = list(s3_stream.JSONLines(segments.open_segment(import_file_name, load_dictionary)))
+                metrics.file_read(import_file_name)
+                metrics.rows(rows_out = len(tweets))
 
     # clean files (standard_parse)
+    stored = False
     try:
         print("Starting tweet parsing and cleaning....")
-        df = standard_parse(tweets, args.export_tweets_name)
-        df.to_csv(export_file_name, index = False, encoding = 'utf-8-sig')
+        with metrics.stage("parse"):
+            if args.parse_workers > 1:
+                df, num_tweets = parallel_parse(import_file_name, args.export_tweets_name, args.parse_workers, dedup_index, matcher, load_dictionary)
+                metrics.file_read(import_file_name)
+            else:
+                df = standard_parse(tweets, args.export_tweets_name, dedup_index, matcher)
+                num_tweets = tweets.num_lines if isinstance(tweets, s3_stream.JSONLines) else len(tweets)
+            metrics.rows(rows_in = num_tweets, rows_out = df.shape[0])
+            if dedup_index is not None:
+                metrics.count('duplicates_dropped', dedup_index.num_duplicates)
+                metrics.count('repeats_dropped', dedup_index.num_repeated)
+                print("{} tweets dropped (already parsed in a previous run), {} tweets delivered more than once in the file dropped".format(
+                    dedup_index.num_duplicates, dedup_index.num_repeated))
+            schema.apply_schema(df, "cleaned tweets")
+        with metrics.stage("write"):
+            df.to_csv(export_file_name, index = False, encoding = 'utf-8-sig')
+            metrics.file_written(export_file_name)
         print("Finished parsing and cleaning tweets")
     except Exception as e:
         print("Error encountered with tweet parsing and cleaning. Please see error message: ")
@@ -238,12 +820,23 @@ def main():
 
     # re-upload to AWS (store_AWS)
     try:
-        store_AWS(aws_access, aws_secret, export_file_name, bucket, export_file_name)
+        with metrics.stage("upload"):
+            stored = store_AWS(aws_access, aws_secret, export_file_name, bucket, export_file_name)
+            metrics.file_written(export_file_name)
         print("Tweets successfully stored in AWS")
     except Exception as e:
         print("AWS storage unsuccessful. Please see error message: ")
         print(e)
 
+    # save the index of parsed tweet IDs (only if the cleaned tweets were stored, so that failed runs can be redone)
+    save_dedup_index(aws_access, aws_secret, bucket, dedup_index, args.dedup_retention_days, stored)
+
+    # record the file in the manifest
+    if stored:
+        stage_manifest.record("raw_tweets/" + import_file_name, import_etag, export_key)
+        stage_manifest.save(aws_access, aws_secret, bucket)
+
+    metrics.finish_run(args.metrics_file)
     print("Script execution finished.")
 
 if __name__ == "__main__":
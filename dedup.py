@@ -0,0 +1,140 @@
+"""
+   dedup.py
+
+   Persistent index of the tweet IDs that have already been parsed, so that tweets delivered more than once
+   (overlapping stream runs, reconnects) are dropped before they reach classification.
+
+   The IDs are stored as integers in a SQLite table (a B-tree keyed by tweet ID), so each lookup/insert is a single
+   index probe and memory use is bounded by SQLite's page cache, whatever the size of the index. Since tweet IDs
+   encode the time at which the tweet was posted, old IDs can be pruned to keep the file small.
+
+   Each ID is stored with its source (the file it was parsed from), so that a file that is processed again
+   (e.g., after it changed, see manifest.py) keeps its own tweets. Tweets delivered more than once within the same file
+   are counted apart (num_repeated) from the tweets already parsed from other files or in previous runs (num_duplicates).
+
+   Usage:
+      index = TweetIdIndex("tweet_id_index.sqlite")
+      if index.add(tweet_id, source):
+         ... (first time this tweet is seen)
+      index.commit()
+
+"""
+
+import datetime
+import sqlite3
+
+# tweet IDs (Twitter "snowflake" IDs) store the number of milliseconds since this epoch in their upper bits
+TWITTER_EPOCH_MS = 1288834974657
+
+
+def tweet_id_from_datetime(date_time):
+
+   """
+      Returns the smallest tweet ID that can have been posted at date_time (UTC datetime)
+   """
+
+   epoch = datetime.datetime(1970, 1, 1)
+   ms = int((date_time - epoch).total_seconds() * 1000)
+   return max(0, ms - TWITTER_EPOCH_MS) << 22
+
+
+class TweetIdIndex(object):
+
+   """
+
+   Set of tweet IDs, stored in a SQLite file. Changes are only saved when commit() is called, so that
+   the IDs of a file that failed to be processed aren't marked as seen.
+
+   """
+
+   def __init__(self, db_file):
+
+      """
+         Input:
+            • db_file: name/location of the local SQLite file (created if it doesn't exist)
+      """
+
+      self.db_file = db_file
+      self.connection = sqlite3.connect(db_file, check_same_thread = False)
+      self.connection.execute("CREATE TABLE IF NOT EXISTS tweet_ids (tweet_id INTEGER PRIMARY KEY, source TEXT) WITHOUT ROWID")
+      # (indexes created before sources were recorded)
+      if 'source' not in [column[1] for column in self.connection.execute("PRAGMA table_info(tweet_ids)")]:
+         self.connection.execute("ALTER TABLE tweet_ids ADD COLUMN source TEXT")
+      self.connection.commit()
+      self.num_added = 0
+      self.num_duplicates = 0
+      self.num_repeated = 0
+      # (IDs added by the source being parsed, to tell the tweets it repeats from the ones stored by earlier runs of the same source)
+      self._source = None
+      self._source_ids = set()
+
+   def add(self, tweet_id, source = None):
+
+      """
+         Adds a tweet ID to the index
+
+         Input:
+            • tweet_id: ID of the tweet
+            • source: name of the file the tweet was parsed from (optional)
+
+         Output:
+            • is_new: True if the tweet ID wasn't in the index yet, or was added by the same source in a previous run (bool).
+              False if it is already in the index from another source (num_duplicates), or was already added by this
+              source in this run (repeated within the file, num_repeated)
+      """
+
+      tweet_id = int(tweet_id)
+      if source != self._source:
+         self._source = source
+         self._source_ids = set()
+      if tweet_id in self._source_ids:
+         self.num_repeated += 1
+         return False
+
+      cursor = self.connection.execute("INSERT OR IGNORE INTO tweet_ids (tweet_id, source) VALUES (?, ?)", (tweet_id, source))
+      is_new = cursor.rowcount == 1
+      if not is_new and source is not None:
+         is_new = self.connection.execute("SELECT source FROM tweet_ids WHERE tweet_id = ?", (tweet_id,)).fetchone()[0] == source
+
+      if is_new:
+         self.num_added += 1
+         self._source_ids.add(tweet_id)
+      else:
+         self.num_duplicates += 1
+
+      return is_new
+
+   def remove(self, tweet_ids):
+
+      """ Removes tweet IDs from the index (e.g., the IDs of a file that failed to be stored) """
+
+      tweet_ids = [int(tweet_id) for tweet_id in tweet_ids]
+      self.connection.executemany("DELETE FROM tweet_ids WHERE tweet_id = ?", ((tweet_id,) for tweet_id in tweet_ids))
+      self._source_ids.difference_update(tweet_ids)
+
+   def __contains__(self, tweet_id):
+      return self.connection.execute("SELECT 1 FROM tweet_ids WHERE tweet_id = ?", (int(tweet_id),)).fetchone() is not None
+
+   def __len__(self):
+      return self.connection.execute("SELECT COUNT(*) FROM tweet_ids").fetchone()[0]
+
+   def prune(self, days):
+
+      """
+         Removes the IDs of tweets posted more than `days` days ago (they won't be re-delivered by the stream)
+
+         Output:
+            • number of IDs removed
+      """
+
+      min_tweet_id = tweet_id_from_datetime(datetime.datetime.utcnow() - datetime.timedelta(days = days))
+      return self.connection.execute("DELETE FROM tweet_ids WHERE tweet_id < ?", (min_tweet_id,)).rowcount
+
+   def commit(self):
+      self.connection.commit()
+
+   def rollback(self):
+      self.connection.rollback()
+
+   def close(self):
+      self.connection.close()
@@ -0,0 +1,93 @@
+"""
+   lexicons.py
+
+   Scores batches of tokenized tweets against word lexicons (e.g., the arousal values and the expanded outrage words used by
+   classify.py) with sparse matrix products, instead of looking up the tokens of each tweet one row at a time:
+      • the lexicons are compiled once into a vocabulary index (token -> column) and a weight vector per lexicon
+      • a batch of tweets becomes a sparse matrix of token counts (one row per tweet, one column per token of the vocabulary;
+        tokens that aren't in any lexicon are left out)
+      • the scores of a lexicon are the product of the count matrix and its weight vector, for the whole batch at once
+
+   The weights of a token are added once per occurrence, in the order of the tokens of the tweet, so the scores are the same
+   as summing the weights of the tokens one by one.
+
+   Usage:
+      scorer = lexicons.LexiconScorer({'arousal': {'angri': 6.2, 'calm': 1.7}, 'outrage': ['outrag', 'disgust']})
+      counts = scorer.count_matrix([['angri', 'calm', 'angri'], ['outrag']])
+      scorer.score(counts, 'arousal')   -> array([14.1, 0.])
+      scorer.score(counts, 'outrage')   -> array([0., 1.])
+
+"""
+
+import numpy as np
+import scipy.sparse
+
+
+def tokens_of(tokens):
+
+   """ Returns the tokens of a tweet as a list (tokens separated by spaces are split) """
+
+   if isinstance(tokens, str):
+      return tokens.split()
+   return tokens
+
+
+class LexiconScorer(object):
+
+   """
+
+   Lexicons compiled into a shared vocabulary index and one weight vector per lexicon (see module docstring)
+
+   """
+
+   def __init__(self, lexicons):
+
+      """
+         Input:
+            • lexicons: dict of lexicon name -> lexicon: dict of token -> weight, or list of tokens (weight 1)
+      """
+
+      self.vocabulary = {}
+      entries = {}
+      for name, lexicon in lexicons.items():
+         items = lexicon.items() if hasattr(lexicon, 'items') else ((token, 1.0) for token in lexicon)
+         entries[name] = [(self.vocabulary.setdefault(token, len(self.vocabulary)), float(weight)) for token, weight in items]
+
+      self.weights = {}
+      for name, lexicon_entries in entries.items():
+         weights = np.zeros(len(self.vocabulary))
+         for index, weight in lexicon_entries:
+            weights[index] = weight
+         self.weights[name] = weights
+
+   def count_matrix(self, token_lists):
+
+      """
+         Input:
+            • token_lists: tokens of each tweet (lists of tokens, or strings of tokens separated by spaces)
+         Output:
+            • counts: sparse matrix (scipy CSR) of the counts of the vocabulary tokens in each tweet
+      """
+
+      vocabulary = self.vocabulary
+      indices = []
+      indptr = [0]
+      for tokens in token_lists:
+         indices.extend(vocabulary[token] for token in tokens_of(tokens) if token in vocabulary)
+         indptr.append(len(indices))
+
+      # (repeated tokens are separate entries of the row, in the order of the tweet, so their weights are added one by one)
+      return scipy.sparse.csr_matrix((np.ones(len(indices)), np.array(indices, dtype = np.int64), np.array(indptr, dtype = np.int64)),
+         shape = (len(indptr) - 1, len(vocabulary)))
+
+   def score(self, counts, name):
+
+      """
+         Input:
+            • counts: output of count_matrix
+            • name: name of the lexicon
+         Output:
+            • scores: sum of the weights of the lexicon's tokens in each tweet (numpy array)
+      """
+
+      return counts.dot(self.weights[name])
@@ -0,0 +1,230 @@
+"""
+   manifest.py
+
+   Manifests of the files processed by each stage (clean.py, classify.py), so that reruns skip the inputs that are already done.
+
+   For each input, the manifest of a stage records:
+      • input_key: key of the input file in AWS (e.g., 'raw_tweets/X.json')
+      • etag: ETag (content hash given by AWS) of the input file when it was processed
+      • version: version of the stage's code (hash of its source files and model files, see code_version)
+      • output_key: key of the output file in AWS (e.g., 'cleaned_tweets/X.csv')
+      • processed_at: date/time at which the input was processed
+
+   An input is up to date if its output exists and was produced from the same content (ETag) by the same code (version).
+   It is processed again if the input changed (e.g., a raw tweets file re-uploaded by stream.py), if the code changed,
+   or if its output is missing. Manifests are stored as .json files in the 'manifests/' directory in AWS.
+
+   Usage:
+      stage_manifest = manifest.load_manifest(aws_access, aws_secret, bucket, "clean", manifest.code_version(["clean.py"]))
+      if not stage_manifest.is_up_to_date(input_key, etag, output_keys):
+         ...
+         stage_manifest.record(input_key, etag, output_key)
+      stage_manifest.save(aws_access, aws_secret, bucket)
+
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import threading
+
+import boto3 # for working with AWS S3
+from botocore.exceptions import ClientError
+
+import batch
+
+
+def code_version(files):
+
+   """
+      Returns the version of a stage's code: a hash of the content of its files (source files, model files)
+
+      Input:
+         • files: names/locations of local files (files that don't exist are ignored)
+
+      Output:
+         • version: first 12 characters of the SHA-256 hash (str)
+   """
+
+   sha = hashlib.sha256()
+   for file_name in files:
+      if not os.path.exists(file_name):
+         continue
+      sha.update(os.path.basename(file_name).encode('utf-8'))
+      with open(file_name, 'rb') as f:
+         for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+
+   return sha.hexdigest()[:12]
+
+def get_etag(aws_access, aws_secret, bucket, key):
+
+   """
+      Returns the ETag of a file in the AWS bucket (or None if the file doesn't exist)
+   """
+
+   s3 = boto3.client('s3',
+                     aws_access_key_id = aws_access,
+                     aws_secret_access_key= aws_secret)
+
+   try:
+      return s3.head_object(Bucket = bucket, Key = key)['ETag'].strip('"')
+   except ClientError as e:
+      if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+         return None
+      raise
+
+
+class Manifest(object):
+
+   """
+
+   Record of the inputs processed by a stage (see module docstring). Safe to update from several threads.
+
+   """
+
+   def __init__(self, stage, version, entries = None):
+
+      """
+         Input:
+            • stage: name of the stage (e.g., 'clean')
+            • version: version of the stage's code (see code_version)
+            • entries: dict of input_key -> entry (as loaded from AWS)
+      """
+
+      self.stage = stage
+      self.version = version
+      self.entries = entries or {}
+      self._lock = threading.Lock()
+
+   def is_up_to_date(self, input_key, etag, output_keys):
+
+      """
+         Checks if an input has already been processed, from the same content and by the same code
+
+         Input:
+            • input_key: key of the input file in AWS
+            • etag: current ETag of the input file
+            • output_keys: keys of the files currently in the output directory (the recorded output must still exist)
+
+         Output:
+            • bool
+      """
+
+      with self._lock:
+         entry = self.entries.get(input_key)
+
+      return entry is not None and entry['etag'] == etag and entry['version'] == self.version and entry['output_key'] in output_keys
+
+   def is_recorded(self, input_key):
+      with self._lock:
+         return input_key in self.entries
+
+   def record(self, input_key, etag, output_key):
+
+      """ Records that an input was processed (call after its output was stored) """
+
+      with self._lock:
+         self.entries[input_key] = {'etag': etag,
+            'version': self.version,
+            'output_key': output_key,
+            'processed_at': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}
+
+   def find_stale(self, input_files, input_directory, output_files, output_directory, output_extension, force = False):
+
+      """
+         Finds the inputs that need to be processed: inputs not in the manifest, changed since they were processed,
+         processed by a different version of the code, or whose output is missing.
+         Inputs that aren't in the manifest but already have an output (processed before manifests existed) are skipped.
+
+         Input:
+            • input_files: dict of input file name -> ETag (see batch.list_AWS_files)
+            • input_directory: directory of the inputs in AWS (e.g., 'raw_tweets/')
+            • output_files: names of the files in the output directory
+            • output_directory: directory of the outputs in AWS (e.g., 'cleaned_tweets/')
+            • output_extension: extension of the output files (e.g., '.csv')
+            • force: process every input, even if it is up to date (bool, default = False)
+
+         Output:
+            • list of input file names to process
+      """
+
+      if force:
+         print("Manifest of {0} (version {1}): {2} inputs processed regardless of the manifest (--force)".format(self.stage, self.version, len(input_files)))
+         return sorted(input_files)
+
+      output_keys = set(output_directory + name for name in output_files)
+      stale = []
+      counts = {'new': 0, 'changed': 0, 'up to date': 0}
+
+      for name, etag in sorted(input_files.items()):
+         input_key = input_directory + name
+         if self.is_up_to_date(input_key, etag, output_keys):
+            counts['up to date'] += 1
+         elif not self.is_recorded(input_key):
+            if output_directory + batch.output_name(name, output_extension) in output_keys:
+               counts['up to date'] += 1
+            else:
+               counts['new'] += 1
+               stale.append(name)
+         else:
+            counts['changed'] += 1
+            stale.append(name)
+
+      print("Manifest of {0} (version {1}): {2} new, {3} changed or outdated, {4} up to date".format(self.stage, self.version,
+         counts['new'], counts['changed'], counts['up to date']))
+
+      return stale
+
+   def save(self, aws_access, aws_secret, bucket):
+
+      """ Stores the manifest in AWS ('manifests/[stage].json') """
+
+      s3 = boto3.client('s3',
+                        aws_access_key_id = aws_access,
+                        aws_secret_access_key= aws_secret)
+
+      with self._lock:
+         body = json.dumps({'stage': self.stage, 'entries': self.entries}, indent = 1, sort_keys = True)
+
+      try:
+         s3.put_object(Bucket = bucket, Key = "manifests/{}.json".format(self.stage), Body = body.encode('utf-8'))
+         print("Manifest of {} stored in AWS".format(self.stage))
+         return True
+      except Exception as e:
+         print("Manifest of {} could not be stored in AWS. See error message: ".format(self.stage))
+         print(e)
+         return False
+
+
+def load_manifest(aws_access, aws_secret, bucket, stage, version):
+
+   """
+      Loads the manifest of a stage from AWS ('manifests/[stage].json'). Returns an empty manifest if there is none yet
+
+      Input:
+         • aws_access: AWS access key
+         • aws_secret: AWS secret key
+         • bucket: name of bucket in AWS S3 storage
+         • stage: name of the stage (e.g., 'clean')
+         • version: version of the stage's code (see code_version)
+
+      Output:
+         • Manifest
+   """
+
+   s3 = boto3.client('s3',
+                     aws_access_key_id = aws_access,
+                     aws_secret_access_key= aws_secret)
+
+   try:
+      body = s3.get_object(Bucket = bucket, Key = "manifests/{}.json".format(stage))['Body'].read()
+      entries = json.loads(body.decode('utf-8'))['entries']
+   except ClientError as e:
+      if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+         raise
+      print("No manifest of {} found in AWS: starting a new one".format(stage))
+      entries = {}
+
+   return Manifest(stage, version, entries)
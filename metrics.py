@@ -0,0 +1,266 @@
+"""
+   metrics.py
+
+   Timing and metrics instrumentation shared by the scripts (stream.py, clean.py, classify.py, send_DMs.py, receive_DMs.py, pipeline.py)
+
+   For each stage (and sub-step) of a script, records:
+      • seconds / calls: time spent in the stage, and number of times the stage ran
+      • rows_in / rows_out: number of rows (tweets, users, messages) going in and out of the stage
+      • bytes_read / bytes_written: size of the files downloaded / uploaded or read / written
+      • api_calls: number of calls to the Twitter API
+      • peak_memory_mb: peak resident memory of the process at the end of the stage
+
+   Each finished stage is logged as a JSON line (prefixed by "METRICS "), and a summary of the run is logged at the end.
+   The metrics can also be written to a file in the Prometheus text format (finish_run), or served over HTTP (serve_prometheus).
+
+   Usage:
+      import metrics
+      metrics.start_run("clean")
+      with metrics.stage("parse"):
+         ...
+         metrics.rows(rows_in = len(tweets), rows_out = df.shape[0])
+      metrics.finish_run(prometheus_file = "clean_metrics.prom")
+
+"""
+
+import collections
+import contextlib
+import http.server
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+_lock = threading.Lock()
+_local = threading.local()
+_run = {'script': None, 'started_at': time.time(), 'stages': collections.OrderedDict()}
+_stage_hooks = []
+
+COUNTERS = ['rows_in', 'rows_out', 'bytes_read', 'bytes_written', 'api_calls']
+
+
+def peak_memory_mb():
+
+   """ Returns the peak resident memory of the process (MB) """
+
+   # ru_maxrss is in KB on Linux (bytes on macOS)
+   peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+   return peak / (1024 ** 2) if sys.platform == 'darwin' else peak / 1024
+
+def log_json(event, **fields):
+
+   """ Logs a structured (JSON) line """
+
+   print("METRICS " + json.dumps(dict(event = event, script = _run['script'], time = round(time.time(), 3), **fields), default = str))
+
+def start_run(script):
+
+   """
+      Starts recording the metrics of a run of a script
+
+      Input:
+         • script: name of the script (e.g., "clean")
+   """
+
+   with _lock:
+      _run['script'] = script
+      _run['started_at'] = time.time()
+      _run['stages'].clear()
+
+def _current_stage():
+   stack = getattr(_local, 'stack', [])
+   return stack[-1] if stack else 'main'
+
+def _get_stage(name):
+   if name not in _run['stages']:
+      _run['stages'][name] = dict(seconds = 0.0, calls = 0, peak_memory_mb = 0.0, **{counter: 0 for counter in COUNTERS})
+   return _run['stages'][name]
+
+def start_stage(name):
+
+   """
+      Starts timing a stage of the script. Stages can be nested: sub-steps are recorded as "[stage].[sub-step]"
+
+      Input:
+         • name: name of the stage
+
+      Output:
+         • timer: object to pass to end_stage
+   """
+
+   stack = getattr(_local, 'stack', None)
+   if stack is None:
+      stack = _local.stack = []
+   full_name = stack[-1] + "." + name if stack else name
+
+   stack.append(full_name)
+   for hook in _stage_hooks:
+      hook.enter(full_name)
+
+   return (full_name, time.perf_counter())
+
+def end_stage(timer):
+
+   """
+      Stops timing a stage (started by start_stage), and logs its metrics
+   """
+
+   full_name, start = timer
+   seconds = time.perf_counter() - start
+   for hook in _stage_hooks:
+      hook.exit(full_name)
+   _local.stack.pop()
+
+   memory = peak_memory_mb()
+   with _lock:
+      stats = _get_stage(full_name)
+      stats['seconds'] += seconds
+      stats['calls'] += 1
+      stats['peak_memory_mb'] = max(stats['peak_memory_mb'], memory)
+      fields = dict(stats)
+   log_json('stage', stage = full_name, last_seconds = round(seconds, 6), **fields)
+
+@contextlib.contextmanager
+def stage(name):
+
+   """
+      Times a stage of the script (as a context manager, see start_stage)
+
+      Input:
+         • name: name of the stage
+   """
+
+   timer = start_stage(name)
+   try:
+      yield
+   finally:
+      end_stage(timer)
+
+def add_stage_hook(hook):
+
+   """
+      Registers an object whose enter(stage) and exit(stage) methods are called around every stage (e.g., a profiler)
+   """
+
+   _stage_hooks.append(hook)
+
+def count(counter, value = 1, stage = None):
+
+   """
+      Adds to a counter of a stage
+
+      Input:
+         • counter: name of the counter ('rows_in', 'rows_out', 'bytes_read', 'bytes_written', 'api_calls', or any other name)
+         • value: amount to add
+         • stage: name of the stage (default: the stage currently running)
+   """
+
+   with _lock:
+      stats = _get_stage(stage or _current_stage())
+      stats[counter] = stats.get(counter, 0) + value
+
+def rows(rows_in = None, rows_out = None, stage = None):
+
+   """ Records the number of rows going in and out of a stage """
+
+   if rows_in is not None:
+      count('rows_in', int(rows_in), stage)
+   if rows_out is not None:
+      count('rows_out', int(rows_out), stage)
+
+def file_read(local_file, stage = None):
+
+   """ Records the size of a file that was downloaded / read """
+
+   if os.path.exists(local_file):
+      count('bytes_read', os.path.getsize(local_file), stage)
+
+def file_written(local_file, stage = None):
+
+   """ Records the size of a file that was uploaded / written """
+
+   if os.path.exists(local_file):
+      count('bytes_written', os.path.getsize(local_file), stage)
+
+def summary():
+
+   """ Returns the metrics of the run so far (dict) """
+
+   with _lock:
+      stages = {name: dict(stats) for name, stats in _run['stages'].items()}
+
+   return {'script': _run['script'],
+      'seconds': time.time() - _run['started_at'],
+      'peak_memory_mb': peak_memory_mb(),
+      'stages': stages}
+
+def label_value(value):
+
+   """ Escapes a label value of the Prometheus text format (backslashes, double quotes and line breaks) """
+
+   return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def to_prometheus():
+
+   """ Returns the metrics of the run in the Prometheus text format (the names of the counters end with _total) """
+
+   run = summary()
+   script = label_value(run['script'])
+   lines = ["# TYPE outrage_run_seconds gauge",
+      'outrage_run_seconds{{script="{0}"}} {1}'.format(script, run['seconds']),
+      "# TYPE outrage_peak_memory_mb gauge",
+      'outrage_peak_memory_mb{{script="{0}"}} {1}'.format(script, run['peak_memory_mb'])]
+
+   metric_names = ['seconds', 'calls', 'peak_memory_mb'] + COUNTERS + sorted(set(counter for stats in run['stages'].values() for counter in stats) - set(['seconds', 'calls', 'peak_memory_mb'] + COUNTERS))
+   for metric in metric_names:
+      metric_type = 'gauge' if metric == 'peak_memory_mb' else 'counter'
+      metric_name = "outrage_stage_" + metric + ("_total" if metric_type == 'counter' else "")
+      lines.append("# TYPE {0} {1}".format(metric_name, metric_type))
+      for name, stats in run['stages'].items():
+         lines.append('{0}{{script="{1}",stage="{2}"}} {3}'.format(metric_name, script, label_value(name), stats.get(metric, 0)))
+
+   return "\n".join(lines) + "\n"
+
+def finish_run(prometheus_file = None):
+
+   """
+      Logs the summary of the run, and (optionally) writes the metrics to a file in the Prometheus text format
+
+      Input:
+         • prometheus_file: name/location of the file to write (e.g., for the node_exporter textfile collector)
+   """
+
+   run = summary()
+   del run['script']
+   log_json('run', **run)
+
+   if prometheus_file:
+      with open(prometheus_file, 'w') as f:
+         f.write(to_prometheus())
+      print("Metrics written to {}".format(prometheus_file))
+
+def serve_prometheus(port):
+
+   """
+      Serves the metrics in the Prometheus text format at http://[host]:[port]/metrics (in a background thread)
+   """
+
+   class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+      def do_GET(self):
+         body = to_prometheus().encode('utf-8')
+         self.send_response(200)
+         self.send_header('Content-Type', 'text/plain; version=0.0.4')
+         self.send_header('Content-Length', str(len(body)))
+         self.end_headers()
+         self.wfile.write(body)
+
+      def log_message(self, format, *args):
+         pass
+
+   server = http.server.ThreadingHTTPServer(('', port), MetricsHandler)
+   threading.Thread(target = server.serve_forever, daemon = True).start()
+   print("Metrics served at http://localhost:{}/metrics".format(port))
+   return server
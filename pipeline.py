@@ -0,0 +1,520 @@
+"""
+   pipeline.py
+
+   The purpose of this script is to run the whole pipeline (stream -> clean -> classify -> send_DMs) in a single,
+   long-running process, so that a tweet can be classified (and its author DMed) seconds after it is posted.
+
+   Input:
+      • twitter_credentials.txt: has credentials for Twitter developer account
+      • aws_credentials.txt: has credentials for AWS account
+      • search_terms = search terms to use when scraping tweets
+
+   Tweets flow from the Twitter stream through the filtering of clean.py (parse_tweet), are classified in micro-batches
+   (preprocess_tweets and predict_values from classify.py), and the users whose tweets have outrage are DMed (as in send_DMs.py).
+   AWS is only used as an archive: the raw tweets and labelled tweets are periodically uploaded to the "raw_tweets/" and
+   "labelled_tweets/" directories, and the list of DMed users to the "lists_users_DMed/" directory.
+
+"""
+
+# working with Twitter API, AWS
+import tweepy # using version 3.8.0
+from tweepy import Stream
+from tweepy.streaming import StreamListener
+from keras.models import load_model
+from joblib import load
+from helpers import threshold_acc
+
+# helper functions, packages
+import pandas as pd
+import argparse
+import datetime
+import json
+import queue
+import sys
+import threading
+import time
+
+# pipeline stages
+import stream
+import clean
+import classify
+import send_DMs
+import metrics
+from term_matcher import TermMatcher
+
+
+class MicroBatcher(object):
+
+   """
+
+   Collects items into micro-batches and processes each batch (on a separate thread) as soon as it closes.
+   A batch closes once it has max_batch_size items, or max_wait seconds after its first item arrived.
+
+   """
+
+   def __init__(self, process_batch, max_batch_size = 500, max_wait = 5.0):
+
+      """
+         Input:
+            • process_batch: function called with each batch (list of items)
+            • max_batch_size: maximum number of items in a batch
+            • max_wait: maximum number of seconds that an item waits for its batch to close
+      """
+
+      self.process_batch = process_batch
+      self.max_batch_size = max_batch_size
+      self.max_wait = max_wait
+      self.num_batches = 0
+      self._queue = queue.Queue()
+      self._stop_signal = object()
+      self._thread = threading.Thread(target = self._run, daemon = True)
+
+   def start(self):
+      self._thread.start()
+      return self
+
+   def add(self, item):
+      self._queue.put(item)
+
+   def stop(self):
+
+      """ Processes the items still waiting, then stops the worker thread """
+
+      self._queue.put(self._stop_signal)
+      self._thread.join()
+
+   def _run(self):
+
+      batch = []
+      deadline = None
+
+      while True:
+         # wait for the next item (or until the current batch has to close)
+         timeout = None if not batch else max(0, deadline - time.time())
+         try:
+            item = self._queue.get(timeout = timeout)
+         except queue.Empty:
+            item = None
+
+         if item is self._stop_signal:
+            if batch:
+               self._process(batch)
+            break
+
+         if item is not None:
+            if not batch:
+               deadline = time.time() + self.max_wait
+            batch.append(item)
+
+         if batch and (len(batch) >= self.max_batch_size or time.time() >= deadline):
+            self._process(batch)
+            batch = []
+
+   def _process(self, batch):
+
+      # errors in one batch shouldn't stop the pipeline
+      try:
+         self.process_batch(batch)
+         self.num_batches += 1
+      except Exception as e:
+         print("Error while processing a batch of {} items. See error message: ".format(len(batch)))
+         print(e)
+
+
+class Archiver(object):
+
+   """
+
+   Appends data to a local file, and uploads it to AWS as a new file (segment) every archive_interval seconds
+
+   """
+
+   def __init__(self, name, extension, upload, archive_interval = 3600):
+
+      """
+         Input:
+            • name: name of the archived files (the segments are named [name]_[date and time][extension])
+            • extension: extension of the files ('.json' or '.csv')
+            • upload: function called with (local_file, s3_file) to upload a finished segment
+            • archive_interval: number of seconds covered by each segment
+      """
+
+      self.name = name
+      self.extension = extension
+      self.upload = upload
+      self.archive_interval = archive_interval
+      self._lock = threading.Lock()
+      self._file = None
+      self._file_name = None
+      self._opened_at = None
+      self._uploads = []
+
+   def write(self, text):
+
+      with self._lock:
+         self._open_segment()
+         self._file.write(text)
+         self._rotate_if_due()
+
+   def write_df(self, df):
+
+      """ Appends a df to a .csv segment (the header is only written at the top of each segment) """
+
+      with self._lock:
+         is_new_segment = self._file is None
+         self._open_segment()
+         df.to_csv(self._file, index = False, header = is_new_segment)
+         self._rotate_if_due()
+
+   def close(self):
+
+      """ Uploads the last segment, and waits for all uploads to finish """
+
+      with self._lock:
+         self._rotate()
+      for upload_thread in self._uploads:
+         upload_thread.join()
+
+   def _open_segment(self):
+
+      if self._file is None:
+         self._opened_at = time.time()
+         self._file_name = "{0}_{1}{2}".format(self.name, datetime.datetime.now().strftime('%d-%b-%Y_%H-%M-%S'), self.extension)
+         self._file = open(self._file_name, 'a', encoding = 'utf-8')
+
+   def _rotate_if_due(self):
+
+      if time.time() - self._opened_at >= self.archive_interval:
+         self._rotate()
+
+   def _rotate(self):
+
+      if self._file is None:
+         return
+
+      self._file.close()
+      self._file = None
+
+      # upload in the background, so that the stream isn't blocked
+      upload_thread = threading.Thread(target = self.upload, args = (self._file_name, self._file_name))
+      upload_thread.start()
+      self._uploads = [t for t in self._uploads if t.is_alive()] + [upload_thread]
+
+
+class DMSender(object):
+
+   """
+
+   Sends DMs to the users whose tweets were classified as having outrage (as in send_DMs.py),
+   making sure that no user is DMed more than once
+
+   """
+
+   def __init__(self, api, script_str, users_DMed, dm_threshold = 0.95, send = True, on_DMs_sent = None):
+
+      """
+         Input:
+            • api: authenticated Twitter API
+            • script_str: string of message (see send_DMs.send_DM_to_user)
+            • users_DMed: pandas df with the list of all users ever DMed (from 'lists_users_DMed/')
+            • dm_threshold: minimum gru_prob of the tweets whose users are DMed
+            • send: actually send the DMs? (bool). If False, only prints the users that would be DMed
+            • on_DMs_sent: function called after each micro-batch in which new users were DMed (e.g., to store the list 
+              of users DMed right away, so that it isn't lost if the process dies)
+      """
+
+      self.api = api
+      self.script_str = script_str
+      self.dm_threshold = dm_threshold
+      self.send = send
+      self.users_DMed = users_DMed
+      self.user_ids_DMed = set(users_DMed['user_ids'])
+      self.new_users_DMed = []
+      self.on_DMs_sent = on_DMs_sent
+
+   def process_batch(self, labelled_tweets):
+
+      """ Sends DMs to the users in a df of labelled tweets (output of classify_batch) """
+
+      num_DMed = len(self.new_users_DMed)
+      with metrics.stage("send_DMs"):
+         self._send_DMs(labelled_tweets)
+      if self.on_DMs_sent is not None and len(self.new_users_DMed) > num_DMed:
+         try:
+            self.on_DMs_sent()
+         except Exception as e:
+            print("List of users DMed could not be stored. See error message: ")
+            print(e)
+
+   def _send_DMs(self, labelled_tweets):
+
+      users_info = send_DMs.get_users_tweet_info(labelled_tweets)
+      users_info = users_info[users_info['gru_prob'] > self.dm_threshold]
+      screen_names = dict(zip(labelled_tweets['user_id'], labelled_tweets['user_screen_name']))
+
+      for user in users_info.itertuples(index = False):
+         if int(user.user_id) in self.user_ids_DMed:
+            continue
+
+         if not self.send:
+            print("Would send a DM to user_id {0} (gru_prob: {1:.3f})".format(user.user_id, user.gru_prob))
+            continue
+
+         try:
+            send_DMs.send_DM_to_user(user.user_id, user.tweet_text, user.tweet_link, user.tweet_date, self.script_str, self.api)
+         except Exception as e:
+            print("DM to user_id = {} unsuccessful.".format(user.user_id))
+            print(e)
+            continue
+
+         self.user_ids_DMed.add(int(user.user_id))
+         self.new_users_DMed.append({'user_names' : screen_names[user.user_id],
+                                     'user_ids' : user.user_id,
+                                     'tweet_ids' : user.tweet_id,
+                                     'gru_prob' : user.gru_prob,
+                                     'date_time_messaged' : datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S')})
+
+   def export(self, users_DMed_file, users_DMed_delta_file):
+
+      """ Exports the updated list of all users ever DMed, and the list of users DMed by this process """
+
+      DMed_columns = ['user_names', 'user_ids', 'tweet_ids', 'gru_prob', 'date_time_messaged']
+      new_users_DMed = pd.DataFrame(self.new_users_DMed, columns = DMed_columns)
+      pd.concat([self.users_DMed, new_users_DMed], sort = False, ignore_index = True).reindex(columns = DMed_columns).to_csv(users_DMed_file)
+      new_users_DMed.to_csv(users_DMed_delta_file, index = False)
+      print("{} users DMed by the pipeline".format(new_users_DMed.shape[0]))
+
+
+class PipelineListener(StreamListener):
+
+   """
+
+   Listens for tweets (as stream.Listener does), archives the raw tweets, and passes the tweets that
+   pass the filters of clean.py on to the classification stage
+
+   """
+
+   def __init__(self, on_tweet, raw_archiver = None, api = None, fields_projection = None, matcher = None):
+
+      """
+         Input:
+            • on_tweet: function called with each parsed tweet (output of clean.parse_tweet)
+            • raw_archiver: Archiver for the raw tweets (optional)
+            • fields_projection: fields of the raw tweets to archive (clean.projection, optional: all the fields by default)
+            • matcher: term_matcher.TermMatcher of the search terms, to tag the tweets with the terms they matched (optional)
+      """
+
+      super(PipelineListener, self).__init__(api)
+      self.on_tweet = on_tweet
+      self.raw_archiver = raw_archiver
+      self.fields_projection = fields_projection
+      self.matcher = matcher
+      self.tweet_count = 0
+      self.parsed_count = 0
+
+   def on_data(self, data):
+
+      try:
+         self.tweet_count += 1
+         metrics.count('rows_in', stage = "stream")
+         if self.tweet_count % 1000 == 0:
+            print("{0} tweets streamed, {1} passed on to classification".format(self.tweet_count, self.parsed_count))
+
+         tweet = json.loads(data)
+         if self.matcher is not None:
+            clean.tag_matched_terms(tweet, self.matcher)
+         if self.raw_archiver is not None:
+            if self.fields_projection is None:
+               # (the full payload is archived as received, with the matched terms added at the end)
+               self.raw_archiver.write(data.rstrip()[:-1] + ',"matched_terms":' + json.dumps(tweet['matched_terms'], separators = (',', ':')) + '}\n'
+                  if 'matched_terms' in tweet else data)
+            elif 'text' in tweet:
+               self.raw_archiver.write(json.dumps(clean.project_tweet(tweet, self.fields_projection), separators = (',', ':')) + '\n')
+
+         record = clean.parse_tweet(tweet)
+         if record is not None:
+            self.parsed_count += 1
+            metrics.count('rows_out', stage = "stream")
+            self.on_tweet(record)
+
+      # (Ctrl-C stops the pipeline)
+      except KeyboardInterrupt:
+         raise
+      except BaseException as e:
+         print('Error on data: %s' % str(e))
+
+      return True
+
+   def on_error(self, status):
+      print(status)
+      if status == 420:
+         print('Above rate limit')
+         # The streaming is halted in this instance,
+         #because Twitter applies penalities once the rate limit is breached
+         return False
+
+
+def classify_batch(records, gru_model, embedding_tokenizer, set_name):
+
+   """
+      Classifies a micro-batch of parsed tweets (clean.parse_tweet -> classify.preprocess_tweets -> classify.predict_values)
+
+      Input:
+         • records: list of parsed tweets (output of clean.parse_tweet)
+         • gru_model: GRU model (see classify.predict_values)
+         • embedding_tokenizer: tokenizer of the GRU model
+         • set_name: name to give to set of tweets
+
+      Output:
+         • labelled_tweets: df of labelled tweets (columns of classify.LABELLED_COLUMNS)
+   """
+
+   with metrics.stage("classify_batch"):
+      df = clean.records_to_df(records, set_name)
+      # (min-max scaling over a micro-batch isn't meaningful, and the scaled features aren't used by the GRU model)
+      with metrics.stage("preprocess"):
+         df = classify.preprocess_tweets(df, scale = False)
+      with metrics.stage("predict"):
+         df = classify.predict_values(df, gru_model, embedding_tokenizer)
+      metrics.rows(rows_in = len(records), rows_out = df.shape[0])
+
+   return df.loc[:, classify.LABELLED_COLUMNS]
+
+def read_credentials(twitter_credentials, aws_credentials):
+
+   """
+      Reads the Twitter and AWS credentials files (same formats as the other scripts)
+
+      Output:
+         • twitter_keys: [consumer key, consumer secret, access key, access secret]
+         • aws_keys: [AWS access, AWS secret]
+   """
+
+   with open(twitter_credentials, 'r') as twitter_creds:
+      twitter_keys = [twitter_creds.readline().rstrip() for i in range(4)] # reads lines, removes trailing whitespaces
+
+   with open(aws_credentials, 'r') as aws_creds:
+      aws_keys = [aws_creds.readline().split(sep = "=")[1].rstrip() for i in range(2)] # separate the equal sign, eliminate \n
+
+   return twitter_keys, aws_keys
+
+def main():
+
+   # get params
+   parser = argparse.ArgumentParser(description = "Runs the whole pipeline (stream -> clean -> classify -> send_DMs) in a single long-running process.")
+   parser.add_argument("twitter_credentials", help = "Text file with Twitter developer credentials (consumer key, consumer secret, access key, access secret)")
+   parser.add_argument("aws_credentials", help = "Text file with AWS credentials (AWS access, AWS secret)")
+   parser.add_argument("search_terms", help = "Search terms to use for Twitter streaming query.", nargs = "+")
+   parser.add_argument("--session_name", help = "Name of the pipeline session (used to name the archived files)",
+      default = "outrage_tweets_pipeline_{}".format(datetime.datetime.today().strftime('%d-%b-%Y')))
+   parser.add_argument("--batch_size", help = "Maximum number of tweets per classification micro-batch", default = 500, type = int)
+   parser.add_argument("--batch_interval", help = "Maximum number of seconds a tweet waits for its micro-batch to be classified", default = 5.0, type = float)
+   parser.add_argument("--archive_interval", help = "Number of seconds between uploads of archived tweets to AWS", default = 3600, type = float)
+   parser.add_argument("--full_payload", help = "Archive the full raw tweets (by default, only the fields read by clean.py are archived)", action = "store_true")
+   parser.add_argument("--extra_fields", help = "Fields of the raw tweets to archive on top of the fields read by clean.py (e.g., lang place.full_name)", nargs = "+", default = [])
+   parser.add_argument("--no_term_tags", help = "Don't tag the tweets with the search terms they matched (matched_terms)", action = "store_true")
+   parser.add_argument("--dm_threshold", help = "Minimum gru_prob of the tweets whose users are DMed", default = 0.95, type = float)
+   parser.add_argument("--all_users_DMed_name", help = "Name of .csv file (without .csv extension), in AWS, that has the list of all users ever DMed",
+      default = "all_users_DMed")
+   parser.add_argument("--no_DMs", help = "Don't send DMs (only print the users that would be DMed)", action = "store_true")
+   parser.add_argument("--metrics_port", help = "Port to serve the pipeline's metrics on (Prometheus text format, at /metrics)", type = int)
+   parser.add_argument("--metrics_file", help = "Name of file to write the pipeline's metrics to when it stops (Prometheus text format)")
+   args = parser.parse_args()
+   metrics.start_run("pipeline")
+   if args.metrics_port:
+      metrics.serve_prometheus(args.metrics_port)
+
+   (consumer_key, consumer_secret, access_key, access_secret), (aws_access, aws_secret) = read_credentials(args.twitter_credentials, args.aws_credentials)
+   bucket = 'augmented-outrage-classifier-tweets' # name of bucket in AWS
+
+   try:
+      auth, api = stream.authenticate(consumer_key, consumer_secret, access_key, access_secret)
+   except Exception as e:
+      print("Authentication failed")
+      print(e)
+      sys.exit()
+
+   # import model files (only once, for the whole session)
+   try:
+      gru_model = load_model("model_files/GRU_20200309.h5", custom_objects={'threshold_acc': threshold_acc})
+      embedding_tokenizer = load('model_files/training.joblib')
+      print("Model files successfully loaded")
+   except Exception as e:
+      print("Error in loading model files")
+      print(e)
+      sys.exit()
+
+   # import list of users who have been DMed before, and the script to send
+   users_DMed_file = args.all_users_DMed_name + '.csv'
+   send_DMs.extract_from_AWS(aws_access, aws_secret, bucket, directory = 'lists_users_DMed/', s3_file = users_DMed_file, local_file = users_DMed_file)
+   users_DMed = pd.read_csv(users_DMed_file)
+   print("This is the number of people that we have sent DMs to so far: {}".format(users_DMed.shape[0]))
+
+   script_str = ''
+   with open('twitter_DM_script.txt', 'r') as script:
+      for line in script.readlines():
+         script_str += line
+
+   # archives (AWS is only written as a side output)
+   raw_archiver = Archiver(args.session_name, '.json',
+      lambda local_file, s3_file: stream.store_AWS(aws_access, aws_secret, local_file, bucket, s3_file), args.archive_interval)
+   labelled_archiver = Archiver(args.session_name + '_labelled', '.csv',
+      lambda local_file, s3_file: classify.store_AWS(aws_access, aws_secret, local_file, bucket, s3_file), args.archive_interval)
+
+   # DM stage: consumes the labelled micro-batches. The list of users DMed is stored in AWS after every micro-batch that DMed
+   # new users (not only when the pipeline stops), so that they aren't DMed again if the process dies
+   users_DMed_export_file = args.all_users_DMed_name + '.csv'
+   # (the delta of the process is stored again after every micro-batch: receive_DMs.py merges it again when its ETag changes)
+   users_DMed_delta_file = "{0}_DMed_delta_{1}.csv".format(args.session_name, datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+
+   def store_users_DMed():
+      dm_sender.export(users_DMed_export_file, users_DMed_delta_file)
+      send_DMs.store_AWS(aws_access, aws_secret, users_DMed_export_file, bucket, directory = 'lists_users_DMed/', s3_file = users_DMed_export_file)
+      send_DMs.store_AWS(aws_access, aws_secret, users_DMed_delta_file, bucket, directory = 'lists_users_DMed_deltas/', s3_file = users_DMed_delta_file)
+
+   dm_sender = DMSender(api, script_str, users_DMed, args.dm_threshold, send = not args.no_DMs, on_DMs_sent = store_users_DMed)
+   dm_batcher = MicroBatcher(lambda batches: dm_sender.process_batch(pd.concat(batches, ignore_index = True)), max_batch_size = 1, max_wait = 0).start()
+
+   # classification stage: consumes the parsed tweets
+   def process_tweets(records):
+      labelled_tweets = classify_batch(records, gru_model, embedding_tokenizer, args.session_name)
+      print("Micro-batch of {0} tweets classified ({1} with outrage)".format(labelled_tweets.shape[0], int(labelled_tweets['gru_binary'].sum())))
+      labelled_archiver.write_df(labelled_tweets)
+      dm_batcher.add(labelled_tweets)
+
+   tweet_batcher = MicroBatcher(process_tweets, args.batch_size, args.batch_interval).start()
+
+   # stream until interrupted (reconnect if the stream stops)
+   listener = PipelineListener(tweet_batcher.add, raw_archiver,
+      fields_projection = None if args.full_payload else clean.projection(clean.PARSED_FIELDS + args.extra_fields),
+      matcher = None if args.no_term_tags else TermMatcher(args.search_terms))
+   print("Pipeline started. Searching for tweets with the following terms: " + ", ".join(args.search_terms))
+   try:
+      while True:
+         try:
+            twitter_stream = Stream(auth, listener, tweet_mode = 'extended', include_entities = True)
+            twitter_stream.filter(languages = ['en'], track = args.search_terms)
+         except KeyboardInterrupt:
+            raise
+         except Exception as e:
+            print("Problem with the Twitter stream. See error message: ")
+            print(e)
+         print("Twitter stream stopped. Reconnecting in 60 seconds")
+         time.sleep(60)
+   except KeyboardInterrupt:
+      print("Pipeline interrupted. Finishing the last batches...")
+
+   # drain the stages in order, then archive everything
+   tweet_batcher.stop()
+   dm_batcher.stop()
+   raw_archiver.close()
+   labelled_archiver.close()
+
+   store_users_DMed()
+
+   print("{0} tweets streamed, {1} micro-batches classified".format(listener.tweet_count, tweet_batcher.num_batches))
+   metrics.finish_run(args.metrics_file)
+   print("Pipeline finished.")
+
+if __name__ == '__main__':
+   main()
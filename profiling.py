@@ -0,0 +1,140 @@
+"""
+   profiling.py
+
+   Opt-in profiling of the named steps of the scripts (the stages recorded by metrics.py, e.g. the feature steps of
+   classify.preprocess_tweets and the tokenize / pad / GRU predict steps of classify.predict_values)
+
+   While a step runs, it is profiled with its own cProfile profiler (nested steps are profiled separately from their parent),
+   and a sampling thread records the call stack every few milliseconds. At the end of the run, write_report writes:
+      • [output]_summary.txt: the steps ranked by time, with the functions that take the most time in each step (cProfile)
+      • [output].folded: the sampled call stacks, prefixed by the step, in the folded format of flamegraph.pl / speedscope
+
+   Usage:
+      import metrics, profiling
+      profiler = profiling.StepProfiler().start()
+      metrics.add_stage_hook(profiler)
+      ...
+      profiler.stop()
+      profiler.write_report("classify_profile")
+
+"""
+
+import cProfile
+import collections
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+
+
+class StepProfiler(object):
+
+   """
+
+   Profiles each step separately (cProfile), and samples the call stacks of the running steps (for flame graphs)
+
+   """
+
+   def __init__(self, sample_interval = 0.005, top_functions = 15):
+
+      """
+         Input:
+            • sample_interval: number of seconds between two samples of the call stacks
+            • top_functions: number of functions listed for each step in the summary
+      """
+
+      self.sample_interval = sample_interval
+      self.top_functions = top_functions
+      self.profiles = collections.OrderedDict()
+      self.step_seconds = collections.Counter()
+      self.samples = collections.Counter()
+      self._running = {}
+      self._lock = threading.Lock()
+      self._stopped = threading.Event()
+      self._sampler = threading.Thread(target = self._sample, daemon = True)
+
+   def start(self):
+      self._sampler.start()
+      return self
+
+   def stop(self):
+      self._stopped.set()
+      self._sampler.join()
+
+   def enter(self, step):
+
+      """ Called when a step starts (see metrics.add_stage_hook) """
+
+      stack = self._running.setdefault(threading.get_ident(), [])
+
+      # only one profiler can be active per thread: pause the parent step's profiler
+      if stack:
+         stack[-1][1].disable()
+
+      with self._lock:
+         profile = self.profiles.setdefault(step, cProfile.Profile())
+      stack.append((step, profile, time.perf_counter()))
+      profile.enable()
+
+   def exit(self, step):
+
+      """ Called when a step finishes (see metrics.add_stage_hook) """
+
+      stack = self._running[threading.get_ident()]
+      step, profile, start = stack.pop()
+      profile.disable()
+
+      with self._lock:
+         self.step_seconds[step] += time.perf_counter() - start
+
+      if stack:
+         stack[-1][1].enable()
+
+   def _sample(self):
+
+      while not self._stopped.wait(self.sample_interval):
+         frames = sys._current_frames()
+         for thread_id, stack in list(self._running.items()):
+            try:
+               step = stack[-1][0]
+               frame = frames[thread_id]
+            except (IndexError, KeyError):
+               continue
+            calls = []
+            while frame is not None:
+               code = frame.f_code
+               calls.append("{0} ({1}:{2})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+               frame = frame.f_back
+            self.samples[";".join(step.split(".") + calls[::-1])] += 1
+
+   def write_report(self, output):
+
+      """
+         Writes the ranked summary ([output]_summary.txt) and the folded call stacks ([output].folded)
+
+         Input:
+            • output: name/location of the report files (without extension)
+      """
+
+      summary_file = output + "_summary.txt"
+      folded_file = output + ".folded"
+
+      with open(summary_file, 'w') as f:
+         f.write("Steps ranked by time (seconds, including nested steps):\n\n")
+         for step, seconds in self.step_seconds.most_common():
+            f.write("   {0:<40} {1:10.3f}\n".format(step, seconds))
+
+         for step, seconds in self.step_seconds.most_common():
+            stats_output = io.StringIO()
+            stats = pstats.Stats(self.profiles[step], stream = stats_output)
+            stats.strip_dirs().sort_stats('cumulative').print_stats(self.top_functions)
+            f.write("\n\n===== {0} ({1:.3f} seconds) =====\n".format(step, seconds))
+            f.write(stats_output.getvalue())
+
+      with open(folded_file, 'w') as f:
+         for stack, count in sorted(self.samples.items()):
+            f.write("{0} {1}\n".format(stack, count))
+
+      print("Profile written to {0} (ranked summary) and {1} (flame graph, folded stacks)".format(summary_file, folded_file))
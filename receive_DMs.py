@@ -8,7 +8,13 @@
       • aws_credentials: has credentials for AWS account
       • export_tweets_name: Name to give to .csv file (without .csv extension) of user responses, exported to AWS in a 'user_replies/' directory
 
-   This script will receive the DMs sent to the lab Twitter account in the past 30 days and store the information in AWS
+   This script will receive the DMs sent to the lab Twitter account since the last run (at most, the past 30 days) and store the 
+   information in AWS. The ID of the newest message fetched is kept in 'user_replies/last_message_id.txt', so each run only exports 
+   the new replies. If a run reaches the API call limit, the cursor of the next page is saved in the same file, and the next
+   run resumes from it (the mark only moves forward once every new message was fetched). Each reply is linked to the tweet (tweet_id, gru_prob) that triggered the DM through an index of DMed users 
+   ('user_replies/DM_index.json'), which is updated with the files that send_DMs.py and pipeline.py store in 'lists_users_DMed_deltas/'
+   (a file is merged again if its contents changed, see its ETag), and seeded once from the list of all users ever DMed in 'lists_users_DMed/'
+   (users DMed before the deltas were stored).
 
 """
 # working with Twitter API, AWS
@@ -27,6 +33,9 @@ import datetime
 import re
 import os
 
+import batch
+import metrics
+
 def authenticate(consumer_key, consumer_secret, access_token, access_secret):
    """
       Allows authentication with Twitter API, with relevant IDs
@@ -47,7 +56,7 @@ def authenticate(consumer_key, consumer_secret, access_token, access_secret):
 
    return auth, api
 
-def extract_from_AWS(aws_access, aws_secret, bucket, s3_file, local_file):
+def extract_from_AWS(aws_access, aws_secret, bucket, s3_file, local_file, directory = "labelled_tweets/"):
    
    """
    Imports .csv file from AWS.
@@ -56,8 +65,9 @@ def extract_from_AWS(aws_access, aws_secret, bucket, s3_file, local_file):
          • aws_access: AWS access key
          • aws_secret: AWS secret key
          • bucket: name of bucket in AWS S3 storage (place to store data)
-         • s3_file: name of file in AWS (assumes that it is in the 'labelled_tweets/' directory)
+         • s3_file: name of file in AWS
          • local_file: name/location of local .json file
+         • directory: the directory/folder that the file is in (default: 'labelled_tweets/')
         
    """
    # use boto3 to interface with AWS
@@ -73,7 +83,7 @@ def extract_from_AWS(aws_access, aws_secret, bucket, s3_file, local_file):
    # load data from AWS
    try:
       s3.download_file(Bucket = bucket, 
-         Key = "labelled_tweets/" + s3_file,
+         Key = directory + s3_file,
          Filename = local_file)
       print("Upload Successful")
       return True
@@ -87,20 +97,237 @@ def extract_from_AWS(aws_access, aws_secret, bucket, s3_file, local_file):
       print("File download unsuccessful")
       print(e)
 
-def get_DMs(api):
+def get_DMs(api, last_message_id = None, cursor = None, fetched_ids = None, page_size = 50, max_pages = 15):
     """
-        Receive the DMs that have been sent/received by the authenticated user's account (so, the lab account)
+        Receive the DMs that have been sent/received by the authenticated user's account (so, the lab account).
+        Follows the API cursor page by page, and stops as soon as it reaches a message that was already
+        seen in a previous run (Twitter returns DM events newest first).
         
         Input:
             • api: authenticated Twitter API
+            • last_message_id: ID of the newest message fetched by the previous run (high-water mark). 
+              If None, every page from the past 30 days is fetched.
+            • cursor: cursor of the page to start from, saved by a previous run that reached the API call limit (optional: 
+              the newest page by default)
+            • fetched_ids: (oldest, newest) IDs of the messages already fetched since the high-water mark by previous runs,
+              which are skipped (optional)
+            • page_size: number of messages per API call (max. 50)
+            • max_pages: maximum number of API calls (the endpoint allows 15 calls / 15 minutes)
+
+        Output:
+            • message_list: list of new DM events (newest first)
+            • next_cursor: cursor of the next page if the API call limit was reached before the messages of the previous run 
+              (or the oldest messages), i.e. older new messages weren't fetched yet (None otherwise)
     
     """
     
-    message_list = api.list_direct_messages()
+    message_list = []
+    next_cursor = None
+
+    for page in range(max_pages):
+
+        # get next page of messages (from the newest page again, if the saved cursor doesn't work anymore)
+        metrics.count('api_calls')
+        if cursor:
+            try:
+                response = api.list_direct_messages(count = page_size, cursor = cursor)
+            except Exception as e:
+                print("Saved cursor of DMs not accepted, starting again from the newest messages. See error message: ")
+                print(e)
+                cursor = None
+                metrics.count('api_calls')
+                response = api.list_direct_messages(count = page_size)
+        else:
+            response = api.list_direct_messages(count = page_size)
+
+        # depending on the tweepy version, the cursor is returned alongside the page
+        page_messages, cursor = split_DM_page(response)
+
+        # keep messages until we reach the ones already fetched in a previous run
+        reached_last_message = False
+        for message in page_messages:
+            message_id = int(message.id)
+            if last_message_id is not None and message_id <= last_message_id:
+                reached_last_message = True
+                break
+            if fetched_ids is not None and fetched_ids[0] <= message_id <= fetched_ids[1]:
+                continue
+            message_list.append(message)
+
+        if reached_last_message or not cursor:
+            break
+    else:
+        next_cursor = cursor
+        print("Stopped after {} pages of DMs (API call limit). Older messages will be fetched from there in the next run".format(max_pages))
+
+    print("{0} new messages fetched in {1} API call(s)".format(len(message_list), page + 1))
+
+    return message_list, next_cursor
+
+def split_DM_page(response):
+    """
+        Splits a response of api.list_direct_messages into the messages and the cursor of the next page
+        
+        Input:
+            • response: output of api.list_direct_messages (a list of messages, or a (messages, cursors) tuple)
+
+        Output:
+            • messages: list of DM events
+            • next_cursor: cursor of the next page (None if this is the last page)
     
-    return message_list
+    """
+
+    if isinstance(response, tuple):
+        messages, cursors = response
+        next_cursor = cursors[-1] if isinstance(cursors, tuple) else cursors
+    else:
+        messages = response
+        next_cursor = getattr(response, 'next_cursor', None)
+
+    return messages, (next_cursor or None)
+
+def read_DM_state(local_file):
+    """
+        Reads the state of DM fetching from a local file: the high-water mark (ID of the newest message fetched so far,
+        first line) and, if the previous run reached the API call limit, the cursor to resume from and the IDs of the
+        messages fetched since the mark (next lines)
+        
+        Input:
+            • local_file: name/location of local .txt file
+
+        Output:
+            • state: dict with keys 'last_message_id' (None if there is no file yet), 'cursor' and 'fetched_ids'
+              ((oldest, newest) message IDs, or None)
+    
+    """
+
+    state = {'last_message_id' : None, 'cursor' : None, 'fetched_ids' : None}
+    if not os.path.exists(local_file):
+        return state
+
+    with open(local_file, 'r') as f:
+        lines = [line.strip() for line in f]
 
-def store_AWS(aws_access, aws_secret, local_file, bucket, s3_file):
+    if lines and lines[0]:
+        state['last_message_id'] = int(lines[0])
+    if len(lines) >= 4 and lines[1]:
+        state['cursor'] = lines[1]
+        state['fetched_ids'] = (int(lines[2]), int(lines[3]))
+
+    return state
+
+def next_DM_state(state, messages_list, next_cursor):
+    """
+        Returns the state of DM fetching after a run (see read_DM_state): the high-water mark only moves forward once
+        every message newer than it was fetched, i.e. once the gap left by runs that reached the API call limit is closed
+        
+        Input:
+            • state: state before the run
+            • messages_list: messages fetched by the run
+            • next_cursor: cursor to resume from (output of get_DMs, None if every new message was fetched)
+
+        Output:
+            • state: state after the run
+    
+    """
+
+    message_ids = [int(message.id) for message in messages_list]
+    if state['fetched_ids'] is not None:
+        message_ids += list(state['fetched_ids'])
+
+    if next_cursor is None:
+        return {'last_message_id' : max(message_ids + [state['last_message_id'] or 0]) or None, 'cursor' : None, 'fetched_ids' : None}
+    return {'last_message_id' : state['last_message_id'], 'cursor' : next_cursor, 'fetched_ids' : (min(message_ids), max(message_ids))}
+
+def write_DM_state(local_file, state):
+    """
+        Writes the state of DM fetching (see read_DM_state) to a local file
+        
+        Input:
+            • local_file: name/location of local .txt file
+            • state: state of DM fetching
+    
+    """
+
+    with open(local_file, 'w') as f:
+        f.write(("" if state['last_message_id'] is None else str(state['last_message_id'])) + "\n")
+        if state['cursor'] is not None:
+            f.write("{0}\n{1}\n{2}\n".format(state['cursor'], *state['fetched_ids']))
+
+def load_DM_index(local_file):
+
+   """
+   Loads the index of DMed users: user_id -> (tweet_id, gru_prob, date_time_messaged) of the tweet that triggered the DM
+
+   Input: 
+      • local_file: name/location of local .json file with the index
+
+   Output:
+      • DM_index: dict with keys 'users' (user_id (str) -> [tweet_id, gru_prob, date_time_messaged]), 'merged_files' (name -> ETag
+        of the send_DMs.py / pipeline.py files already added to the index) and 'seeded_from' (list of all users ever DMed that the
+        index was seeded from, or None)
+   """
+
+   if not os.path.exists(local_file):
+      return {'users' : {}, 'merged_files' : {}, 'seeded_from' : None}
+
+   with open(local_file, 'r') as f:
+      DM_index = json.load(f)
+
+   # (indexes saved before the ETags were recorded: their files are merged again once)
+   if isinstance(DM_index['merged_files'], list):
+      DM_index['merged_files'] = {file_name : None for file_name in DM_index['merged_files']}
+   DM_index.setdefault('seeded_from', None)
+
+   return DM_index
+
+def update_DM_index(DM_index, users_DMed, file_name, etag = None):
+
+   """
+   Adds the users DMed in one session of send_DMs.py to the index of DMed users 
+
+   Input: 
+      • DM_index: index of DMed users (see load_DM_index)
+      • users_DMed: pandas df of users DMed in one session (columns 'user_ids', 'tweet_ids', 'gru_prob', 'date_time_messaged'; 
+        lists of users DMed before tweet_ids/gru_prob were recorded don't have them)
+      • file_name: name of the file that users_DMed came from (so it isn't added twice)
+      • etag: ETag of the file (so it is added again if its contents change)
+   """
+
+   users = DM_index['users']
+   users_DMed = users_DMed.reindex(columns = ['user_ids', 'tweet_ids', 'gru_prob', 'date_time_messaged'])
+
+   # (dates are compared as datetimes: missing or malformed dates are NaT, and never replace a known date)
+   dates_messaged = pd.to_datetime(users_DMed['date_time_messaged'], errors = 'coerce')
+   for user_id, tweet_id, gru_prob, date_time_messaged, date_messaged in zip(users_DMed['user_ids'], users_DMed['tweet_ids'], 
+                                                            users_DMed['gru_prob'], users_DMed['date_time_messaged'], dates_messaged):
+      if pd.isna(user_id):
+         continue
+      key = str(int(user_id))
+      # if a user was DMed more than once, keep the most recent DM
+      if key in users:
+         indexed_date = pd.to_datetime(users[key][2], errors = 'coerce')
+         if pd.isna(date_messaged) or (not pd.isna(indexed_date) and indexed_date > date_messaged):
+            continue
+      users[key] = [None if pd.isna(tweet_id) else str(int(tweet_id)), None if pd.isna(gru_prob) else float(gru_prob),
+         None if pd.isna(date_messaged) else str(date_time_messaged)]
+
+   DM_index['merged_files'][file_name] = etag
+
+def save_DM_index(DM_index, local_file):
+
+   """
+   Saves the index of DMed users to a local .json file 
+
+   Input: 
+      • DM_index: index of DMed users (see load_DM_index)
+      • local_file: name/location of local .json file
+   """
+
+   with open(local_file, 'w') as f:
+      json.dump(DM_index, f)
+
+def store_AWS(aws_access, aws_secret, local_file, bucket, s3_file, directory = "user_replies/"):
 
    """
    Takes the exported .csv file, and stores it into aws
@@ -111,6 +338,7 @@ def store_AWS(aws_access, aws_secret, local_file, bucket, s3_file):
       • local_file: name/location of local .csv file
       • bucket: name of bucket in AWS S3 storage (place to store data)
       • s3_file: name of file once it is stored in AWS
+      • directory: name of directory to store the file (default: 'user_replies/')
    """
 
    # use boto3 to interface with AWS
@@ -125,7 +353,7 @@ def store_AWS(aws_access, aws_secret, local_file, bucket, s3_file):
 
    # upload data to AWS
    try:
-      s3.upload_file(local_file, bucket, "user_replies/" + s3_file)
+      s3.upload_file(local_file, bucket, directory + s3_file)
       print("Upload Successful")
       return True
    except FileNotFoundError:
@@ -147,8 +375,16 @@ def main():
    parser = argparse.ArgumentParser(description = "File for sending DMs to users on Twitter, if their tweet was deemed to have outrage in it.")
    parser.add_argument("twitter_credentials", help = "Text file with Twitter developer credentials (consumer key, consumer secret, access key, access secret)")
    parser.add_argument("aws_credentials", help = "Text file with AWS credentials (AWS access, AWS secret)")
-   parser.add_argument("export_tweets_name", help = "Name to give to .csv file (without .csv extension) of user replies exported to AWS")
+   parser.add_argument("export_tweets_name", help = "Name to give to .csv file (without .csv extension) of user replies exported to AWS (only has the replies received since the last run)")
+   parser.add_argument("--DM_index_name", help = "Name of .json file (without .json extension), in the 'user_replies/' directory in AWS, with the index of DMed users", 
+      default = "DM_index")
+   parser.add_argument("--metrics_file", help = "Name of file to write the run's metrics to (Prometheus text format)")
+   parser.add_argument("--all_users_DMed_name", help = "Name of .csv file (without .csv extension), in the 'lists_users_DMed/' directory in AWS, with the list of all users ever DMed (seeds the index of DMed users once)", 
+      default = "all_users_DMed")
+   parser.add_argument("--last_message_id_name", help = "Name of .txt file (without .txt extension), in the 'user_replies/' directory in AWS, with the ID of the newest message fetched so far", 
+      default = "last_message_id")
    args = parser.parse_args()
+   metrics.start_run("receive_DMs")
 
    # get authentication
    consumer_key = ''
@@ -163,7 +399,9 @@ def main():
       access_secret = twitter_creds.readline().rstrip()
 
    try:
-      auth, api = authenticate(consumer_key, consumer_secret, access_key, access_secret)
+      with metrics.stage("authenticate"):
+         auth, api = authenticate(consumer_key, consumer_secret, access_key, access_secret)
+         metrics.count('api_calls')
    except Exception as e:
       print("Authentication failed")
       print(e)
@@ -181,13 +419,72 @@ def main():
 
    # set own Twitter ID:
    own_id = int(api.me()._json['id'])
-
-   # get most recent DMs (from the past 30 days)
-   messages_list = get_DMs(api)
+   metrics.count('api_calls')
+
+   # get the high-water mark (ID of newest message fetched by the previous run), and the cursor to resume from if the previous
+   # run reached the API call limit
+   last_message_id_file = args.last_message_id_name + '.txt'
+   extract_from_AWS(aws_access, aws_secret, bucket, s3_file = last_message_id_file, local_file = last_message_id_file, directory = "user_replies/")
+   DM_state = read_DM_state(last_message_id_file)
+   if DM_state['last_message_id'] is None:
+      print("No previous high-water mark found. Fetching all DMs from the past 30 days")
+   else:
+      print("Fetching DMs newer than message id = {}".format(DM_state['last_message_id']))
+   if DM_state['cursor'] is not None:
+      print("Resuming from the cursor saved by the previous run (messages {0} to {1} already fetched)".format(*DM_state['fetched_ids']))
+
+   # get DMs received since the last run (at most, the past 30 days)
+   with metrics.stage("get_DMs"):
+      messages_list, next_cursor = get_DMs(api, DM_state['last_message_id'], DM_state['cursor'], DM_state['fetched_ids'])
+      metrics.rows(rows_out = len(messages_list))
+
+   if len(messages_list) == 0:
+      print("No new DMs since the last run. Nothing to export.")
+      # (the pages skipped while resuming still move the cursor, or close the gap)
+      new_DM_state = next_DM_state(DM_state, messages_list, next_cursor)
+      if new_DM_state != DM_state:
+         write_DM_state(last_message_id_file, new_DM_state)
+         store_AWS(aws_access, aws_secret, last_message_id_file, bucket, last_message_id_file)
+      metrics.finish_run(args.metrics_file)
+      print("Script execution finished.")
+      return
+
+   # update the index of DMed users with the sessions of send_DMs.py that aren't in it yet
+   DM_index_file = args.DM_index_name + '.json'
+   extract_from_AWS(aws_access, aws_secret, bucket, s3_file = DM_index_file, local_file = DM_index_file, directory = "user_replies/")
+   DM_index = load_DM_index(DM_index_file)
+
+   with metrics.stage("update_DM_index"):
+      # seed the index once with the list of all users ever DMed (users DMed before the deltas were stored), then add the deltas
+      # on top of it (the most recent DM of each user is kept)
+      if DM_index['seeded_from'] is None:
+         users_DMed_file = args.all_users_DMed_name + '.csv'
+         if extract_from_AWS(aws_access, aws_secret, bucket, s3_file = users_DMed_file, local_file = users_DMed_file, directory = "lists_users_DMed/"):
+            metrics.file_read(users_DMed_file)
+            update_DM_index(DM_index, pd.read_csv(users_DMed_file), 'lists_users_DMed/' + users_DMed_file)
+            DM_index['seeded_from'] = users_DMed_file
+            print("Index of DMed users seeded from {}".format(users_DMed_file))
+
+      try:
+         delta_files = batch.list_AWS_files(aws_access, aws_secret, bucket, 'lists_users_DMed_deltas/')
+      except Exception as e:
+         print("Listing of AWS directory lists_users_DMed_deltas/ unsuccessful.")
+         print(e)
+         delta_files = {}
+      for delta_file, etag in sorted(delta_files.items()):
+         if DM_index['merged_files'].get(delta_file, '') != etag:
+            extract_from_AWS(aws_access, aws_secret, bucket, s3_file = delta_file, local_file = delta_file, directory = "lists_users_DMed_deltas/")
+            metrics.file_read(delta_file)
+            update_DM_index(DM_index, pd.read_csv(delta_file), delta_file, etag)
+            print("{} added to the index of DMed users".format(delta_file))
+
+   print("The index of DMed users has {} users".format(len(DM_index['users'])))
 
    # initialize array to hold responses:
+   message_id_arr = []
    sender_id_arr = []
    message_arr = []
+   created_timestamp_arr = []
 
    # loop through all responses, keep those sent by someone else
    for message_json in messages_list:
@@ -206,25 +503,59 @@ def main():
          message = message_json.message_create['message_data']['text']
 
          # append to arrays
+         message_id_arr.append(int(message_json.id))
          sender_id_arr.append(sender_id)
          message_arr.append(message)
+         created_timestamp_arr.append(message_json.created_timestamp)
 
-   # now, package the two arrays as a dataframe
-   messages_from_users = pd.DataFrame(zip(sender_id_arr, message_arr),
-                                   columns = ['sender_id', 'message'])
+   # now, package the arrays as a dataframe (only has the new replies: a delta of the previous exports)
+   messages_from_users = pd.DataFrame(zip(message_id_arr, sender_id_arr, message_arr, created_timestamp_arr),
+                                   columns = ['message_id', 'sender_id', 'message', 'created_timestamp'])
+   messages_from_users.drop_duplicates(subset = 'message_id', inplace = True)
+   messages_from_users.reset_index(drop = True, inplace = True)
+   sender_id_arr = list(messages_from_users['sender_id'])
+
+   # link each reply to the tweet that triggered the DM (one index lookup per reply)
+   DMed_info = [DM_index['users'].get(str(sender_id), [None, None, None]) for sender_id in sender_id_arr]
+   messages_from_users['tweet_id'], messages_from_users['gru_prob'], messages_from_users['date_time_messaged'] = zip(*DMed_info) if DMed_info else ([], [], [])
+   print("{} new replies from other users".format(messages_from_users.shape[0]))
 
    # export df, then export to AWS
-   messages_from_users.to_csv(export_file_name, index = False)
+   metrics.rows(rows_in = len(messages_list), rows_out = messages_from_users.shape[0], stage = "filter_replies")
+   with metrics.stage("write"):
+      messages_from_users.to_csv(export_file_name, index = False)
+      metrics.file_written(export_file_name)
 
    # re-upload to AWS (store_AWS)
    try:
       print("Storing DMs from other others (for later analysis) in AWS ")
-      store_AWS(aws_access, aws_secret, export_file_name, bucket, export_file_name)
+      with metrics.stage("upload"):
+         stored = store_AWS(aws_access, aws_secret, export_file_name, bucket, export_file_name)
+         metrics.file_written(export_file_name)
       print("Tweets successfully stored in AWS")
    except Exception as e:
+      stored = False
       print("AWS storage unsuccessful. Please see error message: ")
       print(e)
 
+   # store the updated index of DMed users
+   save_DM_index(DM_index, DM_index_file)
+   store_AWS(aws_access, aws_secret, DM_index_file, bucket, DM_index_file)
+
+   # only update the state once the new replies are safely stored. The high-water mark only moves forward once every new
+   # message was fetched (otherwise the older messages not fetched yet would be below the mark, and skipped for good): until
+   # then, the next run resumes from the saved cursor, and skips the messages already exported
+   if stored:
+      DM_state = next_DM_state(DM_state, messages_list, next_cursor)
+      if DM_state['cursor'] is not None:
+         print("High-water mark not updated: not every new DM was fetched (API call limit), the next run resumes from the saved cursor")
+      write_DM_state(last_message_id_file, DM_state)
+      store_AWS(aws_access, aws_secret, last_message_id_file, bucket, last_message_id_file)
+   else:
+      print("High-water mark not updated: the new replies will be fetched again in the next run")
+
+   metrics.finish_run(args.metrics_file)
+
    print("Script execution finished.")
 
 
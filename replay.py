@@ -0,0 +1,376 @@
+"""
+   replay.py
+
+   Replays raw tweets into the ingest path of stream.py (Listener.on_data) offline, without a connection to Twitter,
+   to load-test it: how many tweets per second can the listener sustain, with which latency, and how many tweets are dropped?
+
+   Tweets come from a local file (recorded by stream.py, possibly a compressed segment), from synthetic tweets
+   (benchmarks/synthetic_tweets.py), or from a local socket server (`python replay.py serve`), and are sent at a rate:
+      • max: as fast as the listener takes them (nothing is dropped)
+      • fixed: --tweets_per_second
+      • bursty: --tweets_per_second, with bursts of --burst_tweets_per_second for --burst_seconds every --burst_period seconds
+
+   As with the Twitter stream, tweets are delivered through a bounded buffer (--max_queue): if the listener falls behind
+   and the buffer is full, the tweets are dropped. The latency of a tweet is the time between the moment it was scheduled
+   to be sent and the moment the listener finished with it.
+
+   ReplayStream has the interface of tweepy's Stream (filter, disconnect), so it can stand in for it (e.g., stream.py --replay).
+
+   Usage:
+      python replay.py run synthetic:100000 --rate fixed --tweets_per_second 2000
+      python replay.py run outrage_tweets_streamed_03-Apr-2020.json.zst --rate bursty --prefilter drop
+      python replay.py run synthetic:100000 --shards 4 --track outrageous shame vote virus   (sharded ingest, see stream.stream_sharded)
+      python replay.py serve outrage_tweets_streamed_03-Apr-2020.json --port 9999   (then: python replay.py run tcp://localhost:9999)
+
+"""
+
+import argparse
+import array
+import collections
+import itertools
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+import metrics
+
+
+def file_source(local_file, loop = False):
+
+   """ Raw tweets (JSON lines) of a local file: uncompressed or a compressed segment (see segments.open_segment) """
+
+   import segments
+
+   while True:
+      for line in segments.open_segment(local_file):
+         if line.strip():
+            yield line if line.endswith('\n') else line + '\n'
+      if not loop:
+         return
+
+def synthetic_source(num_tweets, seed = 0):
+
+   """ Synthetic raw tweets (see benchmarks/synthetic_tweets.py) """
+
+   benchmarks_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks")
+   if benchmarks_directory not in sys.path:
+      sys.path.insert(0, benchmarks_directory)
+   import synthetic_tweets
+
+   for tweet in synthetic_tweets.generate_tweets(num_tweets, seed):
+      yield json.dumps(tweet) + '\r\n'
+
+def socket_source(host, port):
+
+   """ Raw tweets (JSON lines) read from a socket (e.g., served by serve) """
+
+   with socket.create_connection((host, port)) as connection:
+      for line in connection.makefile('r', encoding = 'utf-8', newline = '\n'):
+         if line.strip():
+            yield line
+
+def open_source(source, loop = False):
+
+   """
+      Opens a source of raw tweets:
+         • 'synthetic:[number of tweets]' (optionally 'synthetic:[number of tweets]:[seed]')
+         • 'tcp://[host]:[port]'
+         • name/location of a local file
+   """
+
+   if source.startswith('synthetic:'):
+      params = source.split(':')[1:]
+      return synthetic_source(int(params[0]), int(params[1]) if len(params) > 1 else 0)
+
+   if source.startswith('tcp://'):
+      host, port = source[len('tcp://'):].rsplit(':', 1)
+      return socket_source(host, int(port))
+
+   return file_source(source, loop)
+
+def schedule(rate = 'max', tweets_per_second = 1000.0, burst_tweets_per_second = 10000.0, burst_seconds = 5.0, burst_period = 60.0):
+
+   """
+      Returns the times (seconds since the start of the replay) at which the tweets are sent (an infinite generator),
+      or None if the tweets are sent as fast as possible (rate = 'max')
+   """
+
+   if rate == 'max':
+      return None
+
+   def times():
+      now = 0.0
+      while True:
+         yield now
+         in_burst = rate == 'bursty' and now % burst_period >= burst_period - burst_seconds
+         now += 1.0 / (burst_tweets_per_second if in_burst else tweets_per_second)
+
+   return times()
+
+def percentile(sorted_values, fraction):
+   if not sorted_values:
+      return None
+   return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class ReplayStream(object):
+
+   """
+
+   Stand-in for tweepy's Stream: sends the tweets of a source to a listener's on_data, at a rate, through a bounded buffer
+
+   """
+
+   def __init__(self, listener, source, send_times = None, max_queue = 10000, match_terms = True):
+
+      """
+         Input:
+            • listener: StreamListener (e.g., stream.Listener)
+            • source: iterable of raw tweets (JSON strings, see open_source)
+            • send_times: times at which the tweets are sent (see schedule; None: as fast as possible)
+            • max_queue: size of the buffer between the source and the listener (tweets are dropped when it is full)
+            • match_terms: only send the tweets that contain one of the terms given to filter (as Twitter does)
+      """
+
+      self.listener = listener
+      self.source = source
+      self.send_times = send_times
+      self.max_queue = max_queue
+      self.match_terms = match_terms
+      self.running = False
+      self.num_sent = 0
+      self.num_delivered = 0
+      self.num_dropped = 0
+      self.latencies = array.array('d')
+      self.seconds = 0.0
+
+   def filter(self, track = None, languages = None, **kwargs):
+
+      """ Replays the tweets (blocks until the source is exhausted, or the stream is disconnected) """
+
+      terms = [term.lower() for term in track] if track and self.match_terms else None
+      buffer = queue.Queue(self.max_queue)
+      done = object()
+      self.running = True
+      start = time.perf_counter()
+
+      def produce():
+         for raw_tweet, send_time in zip(self.source, self.send_times if self.send_times is not None else itertools.repeat(None)):
+            if not self.running:
+               break
+            if terms is not None and not any(term in raw_tweet.lower() for term in terms):
+               continue
+            if send_time is not None:
+               delay = start + send_time - time.perf_counter()
+               if delay > 0:
+                  time.sleep(delay)
+               scheduled = start + send_time
+            else:
+               scheduled = None
+            self.num_sent += 1
+
+            # the buffer only blocks the source when sending as fast as possible (otherwise, like Twitter, tweets are dropped)
+            if send_time is None:
+               buffer.put((raw_tweet, scheduled))
+            else:
+               try:
+                  buffer.put_nowait((raw_tweet, scheduled))
+               except queue.Full:
+                  self.num_dropped += 1
+         buffer.put(done)
+
+      producer = threading.Thread(target = produce, daemon = True)
+      producer.start()
+
+      # (the duration is recorded even if the replay is interrupted, e.g. with Ctrl-C)
+      try:
+         while True:
+            item = buffer.get()
+            if item is done:
+               break
+            raw_tweet, scheduled = item
+            # (as fast as possible, the latency is the time the listener takes: the source waits for it)
+            if scheduled is None:
+               scheduled = time.perf_counter()
+            keep_going = self.listener.on_data(raw_tweet)
+            self.latencies.append(time.perf_counter() - scheduled)
+            self.num_delivered += 1
+            if keep_going is False or not self.running:
+               self.running = False
+               break
+      finally:
+         self.running = False
+         self.seconds = time.perf_counter() - start
+
+   def disconnect(self):
+      self.running = False
+
+   def report(self):
+
+      """ Returns the results of the replay (dict) """
+
+      return report([self])
+
+
+def report(replay_streams):
+
+   """ Returns the combined results of replay streams (e.g., the shards of stream.stream_sharded), as a dict """
+
+   seconds = max(replay_stream.seconds for replay_stream in replay_streams)
+   delivered = sum(replay_stream.num_delivered for replay_stream in replay_streams)
+   latencies = sorted(itertools.chain.from_iterable(replay_stream.latencies for replay_stream in replay_streams))
+   return {'seconds': seconds,
+      'streams': len(replay_streams),
+      'sent': sum(replay_stream.num_sent for replay_stream in replay_streams),
+      'delivered': delivered,
+      'dropped': sum(replay_stream.num_dropped for replay_stream in replay_streams),
+      'tweets_per_second': delivered / seconds if seconds > 0 else None,
+      'latency_p50_ms': percentile(latencies, 0.5) * 1000 if latencies else None,
+      'latency_p90_ms': percentile(latencies, 0.9) * 1000 if latencies else None,
+      'latency_p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+      'latency_max_ms': latencies[-1] * 1000 if latencies else None}
+
+
+def stream_factory(source, rate = 'max', tweets_per_second = 1000.0, burst_tweets_per_second = 10000.0, burst_seconds = 5.0, burst_period = 60.0,
+   max_queue = 10000, loop = False):
+
+   """
+      Returns a function (auth, listener) -> ReplayStream, to replace tweepy's Stream (see stream.stream_tweets)
+   """
+
+   def make_stream(auth, listener, **kwargs):
+      return ReplayStream(listener, open_source(source, loop),
+         schedule(rate, tweets_per_second, burst_tweets_per_second, burst_seconds, burst_period), max_queue)
+
+   return make_stream
+
+
+class TweetServer(socketserver.ThreadingTCPServer):
+
+   allow_reuse_address = True
+   daemon_threads = True
+
+def serve(source, port, loop = False):
+
+   """
+      Serves raw tweets (JSON lines) to each client that connects to localhost:[port], as fast as the client reads them
+   """
+
+   class TweetHandler(socketserver.StreamRequestHandler):
+
+      def handle(self):
+         try:
+            for raw_tweet in open_source(source, loop):
+               self.wfile.write(raw_tweet.encode('utf-8'))
+         except (BrokenPipeError, ConnectionResetError):
+            pass
+
+   server = TweetServer(('localhost', port), TweetHandler)
+   print("Serving the tweets of {0} at tcp://localhost:{1}".format(source, port))
+   server.serve_forever()
+
+def main():
+
+   parser = argparse.ArgumentParser(description = "Replays raw tweets into stream.py's listener, offline, to load-test the ingest path.")
+   subparsers = parser.add_subparsers(dest = "command")
+
+   run = subparsers.add_parser("run", help = "Replay tweets into the listener, and report throughput, latency and drops")
+   run.add_argument("source", help = "Local .json file (or compressed segment), 'synthetic:[number of tweets]', or 'tcp://[host]:[port]'")
+   run.add_argument("--rate", help = "Rate at which the tweets are sent", choices = ['max', 'fixed', 'bursty'], default = 'max')
+   run.add_argument("--tweets_per_second", help = "Rate of the tweets (fixed and bursty)", default = 1000.0, type = float)
+   run.add_argument("--burst_tweets_per_second", help = "Rate of the tweets during bursts", default = 10000.0, type = float)
+   run.add_argument("--burst_seconds", help = "Duration of the bursts (seconds)", default = 5.0, type = float)
+   run.add_argument("--burst_period", help = "Time between the starts of two bursts (seconds)", default = 60.0, type = float)
+   run.add_argument("--max_queue", help = "Size of the buffer between the source and the listener (tweets are dropped when it is full)", default = 10000, type = int)
+   run.add_argument("--loop", help = "Replay the file in a loop (stop with Ctrl-C)", action = "store_true")
+   run.add_argument("--prefilter", help = "Pre-filter of the listener (see stream.py)", choices = ['drop', 'side', 'off'], default = 'drop')
+   run.add_argument("--full_payload", help = "Write the full raw tweets (see stream.py)", action = "store_true")
+   run.add_argument("--compress", help = "Write a compressed segment (see stream.py)", choices = ['zstd', 'gzip'])
+   run.add_argument("--shards", help = "Number of connections to replay over, each with its share of the --track terms (see stream.stream_sharded)", default = 1, type = int)
+   run.add_argument("--track", help = "Search terms (only the tweets that contain one of them are replayed, as Twitter does)", nargs = "+", default = [])
+   run.add_argument("--reorder_window", help = "Number of tweets held to order the tweets of the shards by ID", default = 1000, type = int)
+   run.add_argument("--output", help = "Name of .json file to save the results to")
+
+   serve_parser = subparsers.add_parser("serve", help = "Serve tweets on a local socket")
+   serve_parser.add_argument("source", help = "Local .json file (or compressed segment), or 'synthetic:[number of tweets]'")
+   serve_parser.add_argument("--port", help = "Port to serve the tweets on", default = 9999, type = int)
+   serve_parser.add_argument("--loop", help = "Serve the file in a loop", action = "store_true")
+   args = parser.parse_args()
+
+   if args.command == "serve":
+      serve(args.source, args.port, args.loop)
+      return
+   if args.command != "run":
+      parser.print_help()
+      return
+
+   import clean
+   import segments
+   import stream
+
+   metrics.start_run("replay")
+   source = os.path.abspath(args.source) if os.path.exists(args.source) else args.source
+   output = os.path.abspath(args.output) if args.output else None
+   working_directory = os.getcwd()
+
+   # the listener writes its files (new_tweets.json, ...) to a temporary directory
+   with tempfile.TemporaryDirectory() as tmp_dir:
+      os.chdir(tmp_dir)
+      writer = segments.SegmentWriter(segments.segment_name("new_tweets.json", args.compress), args.compress) if args.compress else None
+      make_stream = stream_factory(source, args.rate, args.tweets_per_second, args.burst_tweets_per_second, args.burst_seconds, args.burst_period,
+         args.max_queue, args.loop)
+      replay_streams = []
+
+      def make_replay_stream(auth, listener, **kwargs):
+         replay_streams.append(make_stream(auth, listener, **kwargs))
+         return replay_streams[-1]
+
+      stream_args = dict(writer = writer, fields_projection = None if args.full_payload else clean.projection(clean.PARSED_FIELDS),
+         prefilter = None if args.prefilter == 'off' else args.prefilter, stream_factory = make_replay_stream)
+      merger = None
+      try:
+         with metrics.stage("replay"):
+            if args.shards > 1:
+               _, merger = stream.stream_sharded(args.track, [None], float('inf'), args.shards, reorder_window = args.reorder_window, **stream_args)
+            else:
+               stream.stream_tweets(args.track, None, None, float('inf'), **stream_args)
+      except KeyboardInterrupt:
+         for replay_stream in replay_streams:
+            replay_stream.disconnect()
+      # (the listeners are taken from the streams, so that they are reported even if the replay was interrupted)
+      listeners = [replay_stream.listener for replay_stream in replay_streams]
+      if writer is not None:
+         writer.close()
+
+      written = sum(os.path.getsize(name) for name in os.listdir('.'))
+      os.chdir(working_directory)
+
+   results = dict(report(replay_streams), source = args.source, rate = args.rate, bytes_written = written,
+      filter_counts = dict(sum((listener.filter_counts for listener in listeners), collections.Counter())))
+   if merger is not None:
+      results['merged'] = dict(merger.counts)
+   print("\nReplay of {0} ({1}, {2} stream(s)):".format(args.source, args.rate, results['streams']))
+   print("   {0} tweets sent, {1} delivered, {2} dropped, in {3:.2f} seconds".format(results['sent'], results['delivered'], results['dropped'], results['seconds']))
+   if merger is not None:
+      print("   Merged: {0} unique tweets written, {1} duplicates across shards, {2} out of order".format(merger.counts['written'], 
+         merger.counts['duplicates'], merger.counts['late']))
+   print("   Sustained throughput: {0:.0f} tweets/second".format(results['tweets_per_second'] or 0))
+   if results['latency_p50_ms'] is not None:
+      print("   Latency (ms): p50 {0:.3f}, p90 {1:.3f}, p99 {2:.3f}, max {3:.3f}".format(results['latency_p50_ms'], results['latency_p90_ms'],
+         results['latency_p99_ms'], results['latency_max_ms']))
+   print("   {0:.1f} MB written".format(written / 1e6))
+
+   if output:
+      with open(output, 'w') as f:
+         json.dump(results, f, indent = 2)
+      print("Results saved to {}".format(args.output))
+   metrics.finish_run()
+
+if __name__ == '__main__':
+   main()
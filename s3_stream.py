@@ -0,0 +1,177 @@
+"""
+   s3_stream.py
+
+   Reads files from AWS S3 as streams, without staging them on the local disk: the body of the S3 object is fed straight
+   into the line-by-line JSON parser (raw tweets, clean.py) or the CSV / Parquet reader (classify.py, send_DMs.py).
+
+   gzip and zstd compressed files are decompressed on the fly (detected from the first bytes of the file, whatever its name).
+   zstd needs the optional `zstandard` package. The zstd dictionaries that raw tweets segments were compressed with
+   (see segments.py) are loaded from the 'zstd_dictionaries/' directory in AWS.
+
+   Usage:
+      tweets = s3_stream.read_json_lines(aws_access, aws_secret, bucket, "raw_tweets/X.json")
+      for tweet in tweets:
+         ...
+      df = s3_stream.read_csv(aws_access, aws_secret, bucket, "cleaned_tweets/X.csv", lineterminator = '\\n', encoding = 'utf-8-sig')
+
+"""
+
+import functools
+import io
+import json
+
+import boto3 # for working with AWS S3
+import pandas as pd
+
+import metrics
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+class _RawReader(io.RawIOBase):
+
+   """ Adapts an object with a read(size) method (e.g., the body of an S3 object) to a raw binary stream, so it can be buffered """
+
+   def __init__(self, stream):
+      self.stream = stream
+
+   def readable(self):
+      return True
+
+   def readinto(self, buffer):
+      data = self.stream.read(len(buffer))
+      buffer[:len(data)] = data
+      return len(data)
+
+
+def decompressed(stream, load_dictionary = None):
+
+   """
+      Wraps a binary stream so that it is decompressed on the fly if it is gzip or zstd compressed
+
+      Input:
+         • stream: binary file-like object (needs a read method only)
+         • load_dictionary: function called with a dictionary ID, returns the zstd dictionary (if the frames were compressed with one)
+
+      Output:
+         • binary file-like object, with the decompressed content
+   """
+
+   if not hasattr(stream, 'peek'):
+      stream = io.BufferedReader(_RawReader(stream), buffer_size = 1 << 20)
+   magic = stream.peek(4)[:4]
+
+   if magic.startswith(GZIP_MAGIC):
+      import gzip
+      return gzip.GzipFile(fileobj = stream, mode = 'rb')
+
+   if magic == ZSTD_MAGIC:
+      try:
+         import zstandard
+      except ImportError:
+         raise ImportError("Reading zstd compressed files needs the zstandard package (pip install zstandard)")
+      dict_id = zstandard.get_frame_parameters(stream.peek(18)).dict_id
+      if dict_id and load_dictionary is None:
+         raise ValueError("The file was compressed with zstd dictionary {}, which wasn't given".format(dict_id))
+      dictionary = load_dictionary(dict_id) if dict_id else None
+      return zstandard.ZstdDecompressor(dict_data = dictionary).stream_reader(stream, read_across_frames = True)
+
+   return stream
+
+def open_AWS_stream(aws_access, aws_secret, bucket, key):
+
+   """
+      Opens a file in AWS as a (decompressed) binary stream. The number of bytes transferred is counted in the metrics (bytes_read)
+
+      Input:
+         • aws_access: AWS access key
+         • aws_secret: AWS secret key
+         • bucket: name of bucket in AWS S3 storage
+         • key: key of the file in AWS (directory + name, e.g. 'raw_tweets/X.json')
+
+      Output:
+         • binary file-like object
+   """
+
+   s3 = boto3.client('s3',
+                     aws_access_key_id = aws_access,
+                     aws_secret_access_key= aws_secret)
+
+   response = s3.get_object(Bucket = bucket, Key = key)
+   metrics.count('bytes_read', response['ContentLength'])
+   print("Streaming {0} from AWS ({1:.1f} MB)".format(key, response['ContentLength'] / 1e6))
+
+   return decompressed(response['Body'], functools.partial(load_AWS_dictionary, aws_access, aws_secret, bucket))
+
+# zstd dictionaries already loaded, by ID
+_dictionaries = {}
+
+def load_AWS_dictionary(aws_access, aws_secret, bucket, dict_id):
+
+   """
+      Loads a zstd dictionary from AWS ('zstd_dictionaries/[dict_id].dict', see segments.py). Dictionaries are only loaded once
+   """
+
+   if dict_id not in _dictionaries:
+      import zstandard
+      s3 = boto3.client('s3',
+                        aws_access_key_id = aws_access,
+                        aws_secret_access_key= aws_secret)
+      body = s3.get_object(Bucket = bucket, Key = "zstd_dictionaries/{}.dict".format(dict_id))['Body'].read()
+      _dictionaries[dict_id] = zstandard.ZstdCompressionDict(body)
+
+   return _dictionaries[dict_id]
+
+
+class JSONLines(object):
+
+   """
+
+   Iterable of the JSON objects of lines of text with one object per line (e.g., raw tweets). Counts the objects read (num_lines)
+
+   """
+
+   def __init__(self, lines):
+      self.lines = lines
+      self.num_lines = 0
+
+   def __iter__(self):
+      for line in self.lines:
+         if not line.strip():
+            continue
+         self.num_lines += 1
+         yield json.loads(line)
+
+
+def read_json_lines(aws_access, aws_secret, bucket, key):
+
+   """
+      Streams a file of JSON objects (one per line) from AWS. The objects are parsed as they are read (see JSONLines)
+   """
+
+   return JSONLines(io.TextIOWrapper(open_AWS_stream(aws_access, aws_secret, bucket, key), encoding = 'utf-8', newline = ''))
+
+def read_csv(aws_access, aws_secret, bucket, key, chunksize = None, **kwargs):
+
+   """
+      Streams a .csv (or .parquet) file from AWS into a DataFrame
+
+      Input:
+         • aws_access / aws_secret / bucket / key: see open_AWS_stream
+         • chunksize: if given, returns an iterator of DataFrames of chunksize rows (read as the stream goes), instead of one DataFrame
+         • kwargs: passed on to pd.read_csv (e.g., lineterminator, encoding)
+
+      Output:
+         • df (or iterator of dfs)
+   """
+
+   stream = open_AWS_stream(aws_access, aws_secret, bucket, key)
+
+   # (Parquet's metadata is at the end of the file, so the file is buffered in memory rather than streamed)
+   if key.endswith('.parquet'):
+      return pd.read_parquet(io.BytesIO(stream.read()))
+
+   # (newline = '': line endings are passed on to pandas as they are, e.g. the '\r' inside quoted text, as when reading a local file)
+   encoding = kwargs.pop('encoding', 'utf-8')
+   return pd.read_csv(io.TextIOWrapper(stream, encoding = encoding, newline = ''), chunksize = chunksize, **kwargs)
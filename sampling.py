@@ -0,0 +1,253 @@
+"""
+   sampling.py
+
+   Samplers of the streamed tweets (stream.py --sample), to keep the storage and the downstream compute (clean.py, classify.py,
+   send_DMs.py) bounded over a time window, instead of stopping the stream once max_tweet_count tweets have been received
+   (which, on busy days, only keeps the first hours of the day):
+      • ReservoirSampler: a uniform random sample of size tweets over the whole stream (or over each window of window_seconds)
+      • RateSampler: at most max_per_minute tweets per minute (the first ones of each minute)
+      • TermQuotaSampler: at most quota tweets per search term (over the whole stream, or over each window of window_seconds).
+        Tweets that match none of the terms (e.g., terms only found in a link or a quoted tweet) share a quota of their own
+
+   A sampler is given each tweet (data: the JSON line to store, tweet: the decoded tweet or None) with add, and returns the
+   tweets to store now. The reservoir returns the sample of a window once the window is over, and flush returns the tweets
+   still held at the end of the stream. Samplers can be shared by the listeners of several shards (see stream.stream_sharded).
+
+   Usage:
+      sampler = sampling.ReservoirSampler(10000)
+      for data, tweet in sampler.add((data, tweet)):
+         ...
+      for data, tweet in sampler.flush():
+         ...
+
+"""
+
+import collections
+import json
+import random
+import threading
+import time
+
+import metrics
+from term_matcher import TermMatcher
+
+# quota bucket of the tweets that match none of the search terms (TermQuotaSampler)
+UNMATCHED = '(unmatched)'
+
+def tweet_text(tweet):
+
+   """ Returns the full text of a raw tweet (the text of the extended tweet, for truncated tweets) """
+
+   extended_tweet = tweet.get('extended_tweet')
+   if extended_tweet is not None and 'full_text' in extended_tweet:
+      return extended_tweet['full_text']
+   return tweet.get('text') or ''
+
+class Sampler(object):
+
+   """ Base class of the samplers: counts the tweets kept and dropped """
+
+   def __init__(self, clock = time.time):
+      self.clock = clock
+      self.counts = collections.Counter()
+      self._lock = threading.Lock()
+
+   def add(self, item):
+
+      """
+         Input:
+            • item: (data, tweet) of a tweet
+         Output:
+            • list of (data, tweet) to store now
+      """
+
+      with self._lock:
+         self.counts['offered'] += 1
+         kept = self._add(item)
+         self.counts['kept'] += len(kept)
+      return kept
+
+   def flush(self):
+
+      """ Returns the tweets still held by the sampler (call at the end of the stream) """
+
+      with self._lock:
+         kept = self._flush()
+         self.counts['kept'] += len(kept)
+      return kept
+
+   def drop(self, num_tweets = 1):
+      self.counts['dropped'] += num_tweets
+      metrics.count('sampled_out', num_tweets)
+
+   def _add(self, item):
+      raise NotImplementedError
+
+   def _flush(self):
+      return []
+
+
+class ReservoirSampler(Sampler):
+
+   """
+
+   Uniform random sample of size tweets (reservoir sampling): every tweet of the stream (or of the window) has the same
+   chance of being kept, however long the stream runs, and only size tweets are held in memory.
+   The sampled tweets are stored in the order they were received
+
+   """
+
+   def __init__(self, size, window_seconds = None, seed = None, clock = time.time):
+
+      """
+         Input:
+            • size: number of tweets in the sample (of each window)
+            • window_seconds: duration of the windows (optional: a single sample over the whole stream by default)
+            • seed: seed of the random number generator (optional)
+      """
+
+      super(ReservoirSampler, self).__init__(clock)
+      self.size = size
+      self.window_seconds = window_seconds
+      self.random = random.Random(seed)
+      self._reservoir = []
+      self._seen = 0
+      self._window_start = None
+
+   def _add(self, item):
+
+      now = self.clock()
+      kept = []
+      if self._window_start is None:
+         self._window_start = now
+      elif self.window_seconds is not None and now - self._window_start >= self.window_seconds:
+         kept = self._flush()
+         self._window_start = now
+
+      # (each reservoir entry keeps its position in the stream, to store the sample in order)
+      self._seen += 1
+      if len(self._reservoir) < self.size:
+         self._reservoir.append((self._seen, item))
+      else:
+         index = self.random.randrange(self._seen)
+         if index < self.size:
+            self._reservoir[index] = (self._seen, item)
+         self.drop()
+
+      return kept
+
+   def _flush(self):
+      kept = [item for position, item in sorted(self._reservoir, key = lambda entry: entry[0])]
+      self._reservoir = []
+      self._seen = 0
+      return kept
+
+
+class RateSampler(Sampler):
+
+   """
+
+   Keeps at most max_per_minute tweets per minute (the first tweets received in each minute), so that bursts don't take over the sample
+
+   """
+
+   def __init__(self, max_per_minute, clock = time.time):
+      super(RateSampler, self).__init__(clock)
+      self.max_per_minute = max_per_minute
+      self._minute = None
+      self._minute_count = 0
+
+   def _add(self, item):
+
+      minute = int(self.clock() // 60)
+      if minute != self._minute:
+         self._minute = minute
+         self._minute_count = 0
+
+      if self._minute_count >= self.max_per_minute:
+         self.drop()
+         return []
+
+      self._minute_count += 1
+      return [item]
+
+
+class TermQuotaSampler(Sampler):
+
+   """
+
+   Keeps at most quota tweets per search term (over the whole stream, or over each window of window_seconds), so that
+   the most frequent terms don't crowd out the others. A tweet is kept if one of the terms it matches is under its quota,
+   and it counts towards the quota of every term it matches. Tweets that match none of the terms (Twitter also matches the
+   terms in links, mentions and quoted tweets) count towards the quota of the UNMATCHED bucket, and their number is in counts['unmatched']
+
+   """
+
+   def __init__(self, terms, quota, window_seconds = None, matcher = None, clock = time.time):
+
+      """
+         Input:
+            • terms: search terms
+            • quota: maximum number of tweets per term (in each window)
+            • window_seconds: duration of the windows (optional: quotas over the whole stream by default)
+            • matcher: function text -> search terms found in the text (default: term_matcher.TermMatcher(terms).match).
+              Tweets already tagged with their matched_terms (see stream.Listener) aren't matched again
+      """
+
+      super(TermQuotaSampler, self).__init__(clock)
+      self.terms = terms
+      self.quota = quota
+      self.window_seconds = window_seconds
+      self.matcher = matcher or TermMatcher(terms).match
+      self.term_counts = collections.Counter()
+      self._window_start = None
+
+   def _add(self, item):
+
+      now = self.clock()
+      if self._window_start is None or (self.window_seconds is not None and now - self._window_start >= self.window_seconds):
+         self._window_start = now
+         self.term_counts.clear()
+
+      data, tweet = item
+      if tweet is None:
+         tweet = json.loads(data)
+      matched = tweet['matched_terms'] if 'matched_terms' in tweet else self.matcher(tweet_text(tweet))
+      if not matched:
+         self.counts['unmatched'] += 1
+         matched = [UNMATCHED]
+      if not any(self.term_counts[term] < self.quota for term in matched):
+         self.drop()
+         return []
+
+      self.term_counts.update(matched)
+      return [item]
+
+
+def make_sampler(mode, search_terms, sample_size, sample_window = None, max_per_minute = None, term_quota = None, seed = None):
+
+   """
+      Creates the sampler of stream.py --sample
+
+      Input:
+         • mode: 'reservoir', 'rate' or 'quota' (None: no sampling)
+         • search_terms: search terms of the stream (for 'quota')
+         • sample_size: number of tweets in the sample of each window ('reservoir')
+         • sample_window: duration of the windows, in seconds ('reservoir' and 'quota', optional)
+         • max_per_minute: maximum number of tweets per minute ('rate')
+         • term_quota: maximum number of tweets per search term in each window ('quota')
+         • seed: seed of the reservoir's random number generator (optional)
+
+      Output:
+         • sampler (or None)
+   """
+
+   if mode is None:
+      return None
+   if mode == 'reservoir':
+      return ReservoirSampler(sample_size, sample_window, seed)
+   if mode == 'rate':
+      return RateSampler(max_per_minute)
+   if mode == 'quota':
+      return TermQuotaSampler(search_terms, term_quota, sample_window)
+   raise ValueError("Unknown sampling mode {}".format(mode))
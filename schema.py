@@ -0,0 +1,98 @@
+"""
+   schema.py
+
+   Dtypes of the columns of the cleaned tweets (clean.py) and labelled tweets (classify.py), applied by each stage when it
+   loads (or writes) them, so that large files take as little memory as possible once read from .csv:
+      • text columns (text, user_description, user_location, user_name, user_screen_name): Arrow-backed strings
+        (needs the optional `pyarrow` package, kept as Python strings otherwise)
+      • low-cardinality columns (set_id, and user_location / user_screen_name when most of their values repeat): categoricals
+      • IDs (tweet_id, user_id): int64
+      • counts and flags: the smallest integer type that holds their values, user_verified: bool
+      • created_at: datetime (UTC)
+
+   Usage:
+      df = schema.apply_schema(pd.read_csv(...), "cleaned tweets")
+
+"""
+
+import pandas as pd
+
+import metrics
+
+STRING_COLUMNS = ['text', 'user_description', 'user_location', 'user_name', 'user_screen_name']
+CATEGORY_COLUMNS = ['set_id']
+# (categoricals if at most this fraction of their values are distinct)
+MAYBE_CATEGORY_COLUMNS = ['user_location', 'user_screen_name']
+MAX_DISTINCT_FRACTION = 0.5
+ID_COLUMNS = ['tweet_id', 'user_id']
+COUNT_COLUMNS = ['user_followers_count', 'user_following_count', 'user_statuses_count', 'user_likes_given_count',
+   'tweet_retweet_count', 'tweet_favorite_count', 'tweet_reply_count', 'gru_binary']
+BOOL_COLUMNS = ['user_verified']
+DATETIME_COLUMNS = ['created_at']
+
+
+def string_dtype():
+
+   """ Returns the dtype of the text columns: Arrow-backed strings if pyarrow is installed (None otherwise: Python strings) """
+
+   try:
+      import pyarrow
+   except ImportError:
+      return None
+   return pd.StringDtype("pyarrow")
+
+def memory_mb(df):
+   return df.memory_usage(deep = True).sum() / 1e6
+
+def apply_schema(df, name = "tweets"):
+
+   """
+      Converts the columns of a DataFrame of cleaned or labelled tweets to their dtypes (see module docstring), in place,
+      and reports the memory used before and after (columns that aren't in the schema, or can't be converted, are left as they are)
+
+      Input:
+         • df: DataFrame (e.g., read from a .csv file of cleaned tweets)
+         • name: name of the DataFrame in the report
+
+      Output:
+         • df
+   """
+
+   before = memory_mb(df)
+   strings = string_dtype()
+
+   for column in ID_COLUMNS:
+      if column in df.columns and df[column].dtype != 'int64':
+         ids = pd.to_numeric(df[column], errors = 'coerce')
+         df[column] = ids.astype('int64') if not ids.isna().any() else ids.astype('Int64')
+
+   for column in COUNT_COLUMNS:
+      if column in df.columns:
+         counts = pd.to_numeric(df[column], errors = 'coerce')
+         if not counts.isna().any():
+            df[column] = pd.to_numeric(counts, downcast = 'unsigned' if (counts >= 0).all() else 'integer')
+
+   for column in BOOL_COLUMNS:
+      if column in df.columns and df[column].dtype != bool and not df[column].isna().any():
+         df[column] = df[column].astype(str).str.lower() == 'true'
+
+   for column in DATETIME_COLUMNS:
+      if column in df.columns and not pd.api.types.is_datetime64_any_dtype(df[column]):
+         df[column] = pd.to_datetime(df[column], utc = True, errors = 'coerce')
+
+   for column in CATEGORY_COLUMNS + MAYBE_CATEGORY_COLUMNS:
+      if column in df.columns and df[column].dtype == object:
+         if column in CATEGORY_COLUMNS or df[column].nunique() <= MAX_DISTINCT_FRACTION * len(df):
+            df[column] = df[column].astype('category')
+
+   if strings is not None:
+      for column in STRING_COLUMNS:
+         if column in df.columns and df[column].dtype == object:
+            df[column] = df[column].astype(strings)
+
+   after = memory_mb(df)
+   print("Memory of the {0}: {1:.1f} MB -> {2:.1f} MB with the schema's dtypes".format(name, before, after))
+   metrics.count('dataframe_mb_before', round(before, 3))
+   metrics.count('dataframe_mb_after', round(after, 3))
+
+   return df
@@ -0,0 +1,298 @@
+"""
+   segments.py
+
+   Compressed storage format for the raw tweets (stream.py -> 'raw_tweets/' -> clean.py)
+
+   A segment is a .json file (one tweet per line) compressed in independent frames of frame_lines tweets:
+      • zstd (.json.zst, needs the optional `zstandard` package): each frame is a zstd frame, optionally compressed with a
+        dictionary trained on raw tweets (train_dictionary), which helps a lot with small frames of repetitive JSON.
+        The index of the frames (byte offset, size, number of tweets) is stored at the end of the file, in a zstd
+        "skippable frame" that decoders ignore, so that the frames can be decompressed in parallel (read_lines)
+      • gzip (.json.gz): each frame is a gzip member (no index, decompressed sequentially)
+
+   Since a segment is a plain concatenation of frames, any zstd / gzip decoder reads it as a single stream
+   (e.g., s3_stream.decompressed, `zstd -d`, `zcat`). Frames compressed with a dictionary need the dictionary to be decoded:
+   dictionaries are stored in the 'zstd_dictionaries/' directory in AWS, named by their ID (see s3_stream.load_AWS_dictionary).
+
+   Usage:
+      writer = segments.SegmentWriter("X.json.zst", codec = "zstd", dictionary = segments.load_dictionary("tweets.dict"))
+      writer.write(tweet_json_line)
+      writer.close()
+      for line in segments.open_segment("X.json.zst", load_dictionary = {dict_id: dictionary}.get):
+         ...
+
+      python segments.py train raw_tweets.json tweets.dict   (trains a dictionary on a file of raw tweets)
+
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import gzip
+import io
+import json
+import os
+import struct
+
+import s3_stream
+
+EXTENSIONS = {'zstd': '.zst', 'gzip': '.gz'}
+
+# index of the frames, stored in a zstd skippable frame at the end of the file: [magic][size][index JSON][length of JSON][INDEX_MAGIC]
+SKIPPABLE_FRAME_MAGIC = 0x184D2A5E
+INDEX_MAGIC = b'SEGIDX01'
+INDEX_TRAILER = struct.Struct('<I8s')
+
+
+def import_zstandard():
+   try:
+      import zstandard
+   except ImportError:
+      raise ImportError("zstd compressed segments need the zstandard package (pip install zstandard)")
+   return zstandard
+
+def segment_name(file_name, codec):
+
+   """ Returns the name of a segment (e.g., 'X.json' -> 'X.json.zst') """
+
+   return file_name + EXTENSIONS[codec] if codec else file_name
+
+def train_dictionary(lines, dict_size = 112640):
+
+   """
+      Trains a zstd dictionary on samples of raw tweets
+
+      Input:
+         • lines: raw tweets (JSON lines, str or bytes)
+         • dict_size: maximum size of the dictionary (bytes)
+
+      Output:
+         • zstandard.ZstdCompressionDict
+   """
+
+   zstandard = import_zstandard()
+   samples = [line.encode('utf-8') if isinstance(line, str) else line for line in lines]
+   return zstandard.train_dictionary(dict_size, samples)
+
+def load_dictionary(local_file):
+
+   """ Loads a zstd dictionary saved with save_dictionary (or `zstd --train`) """
+
+   zstandard = import_zstandard()
+   with open(local_file, 'rb') as f:
+      return zstandard.ZstdCompressionDict(f.read())
+
+def save_dictionary(dictionary, local_file):
+   with open(local_file, 'wb') as f:
+      f.write(dictionary.as_bytes())
+
+
+class SegmentWriter(object):
+
+   """
+
+   Writes tweets (JSON lines) to a compressed segment, one frame every frame_lines tweets. Each frame is written to the file
+   as soon as it is full, so at most one frame of tweets is held in memory (and lost if the process is killed)
+
+   """
+
+   def __init__(self, file_name, codec = 'zstd', frame_lines = 5000, level = 3, dictionary = None):
+
+      """
+         Input:
+            • file_name: name/location of the local segment (see segment_name)
+            • codec: 'zstd' or 'gzip'
+            • frame_lines: number of tweets per frame
+            • level: compression level
+            • dictionary: zstd dictionary (zstandard.ZstdCompressionDict, optional, zstd only)
+      """
+
+      if codec not in EXTENSIONS:
+         raise ValueError("Unknown codec {0} (choose from {1})".format(codec, sorted(EXTENSIONS)))
+
+      self.file_name = file_name
+      self.codec = codec
+      self.frame_lines = frame_lines
+      self.level = level
+      self.dictionary = dictionary
+      self.frames = []
+      self.num_lines = 0
+      self.raw_bytes = 0
+      self._buffer = []
+      self._file = open(file_name, 'wb')
+
+      if codec == 'zstd':
+         zstandard = import_zstandard()
+         self._compressor = zstandard.ZstdCompressor(level = level, dict_data = dictionary, write_content_size = True)
+      elif dictionary is not None:
+         raise ValueError("Dictionaries are only supported by zstd")
+
+   def write(self, line):
+
+      """ Adds a tweet (JSON line, str) to the segment """
+
+      if not line.endswith('\n'):
+         line += '\n'
+      self._buffer.append(line.encode('utf-8'))
+      if len(self._buffer) >= self.frame_lines:
+         self.flush()
+
+   def flush(self):
+
+      """ Compresses the buffered tweets into a frame, and writes it to the file """
+
+      if not self._buffer:
+         return
+
+      data = b''.join(self._buffer)
+      if self.codec == 'zstd':
+         frame = self._compressor.compress(data)
+      else:
+         frame = gzip.compress(data, compresslevel = self.level)
+
+      self.frames.append([self._file.tell(), len(frame), len(self._buffer)])
+      self._file.write(frame)
+      self._file.flush()
+      self.num_lines += len(self._buffer)
+      self.raw_bytes += len(data)
+      self._buffer = []
+
+   def close(self):
+
+      """ Writes the last frame (and the index of the frames, for zstd) and closes the file """
+
+      self.flush()
+      if self.codec == 'zstd':
+         index = json.dumps({'frames': self.frames,
+            'dict_id': self.dictionary.dict_id() if self.dictionary is not None else 0}).encode('utf-8')
+         payload = index + INDEX_TRAILER.pack(len(index), INDEX_MAGIC)
+         self._file.write(struct.pack('<II', SKIPPABLE_FRAME_MAGIC, len(payload)) + payload)
+      self._file.close()
+
+      compressed_bytes = os.path.getsize(self.file_name)
+      print("{0}: {1} tweets in {2} frames, {3:.1f} MB -> {4:.1f} MB ({5:.1f}x)".format(self.file_name, self.num_lines, len(self.frames),
+         self.raw_bytes / 1e6, compressed_bytes / 1e6, self.raw_bytes / compressed_bytes if compressed_bytes else 0))
+
+
+def read_index(local_file):
+
+   """
+      Reads the index of the frames of a zstd segment
+
+      Output:
+         • index: dict with 'frames' ([byte offset, size, number of tweets] of each frame) and 'dict_id' (0 if no dictionary),
+           or None if the file has no index
+   """
+
+   with open(local_file, 'rb') as f:
+      f.seek(0, os.SEEK_END)
+      if f.tell() < INDEX_TRAILER.size:
+         return None
+      f.seek(-INDEX_TRAILER.size, os.SEEK_END)
+      length, magic = INDEX_TRAILER.unpack(f.read(INDEX_TRAILER.size))
+      if magic != INDEX_MAGIC:
+         return None
+      f.seek(-(INDEX_TRAILER.size + length), os.SEEK_END)
+      return json.loads(f.read(length).decode('utf-8'))
+
+def read_lines(local_file, load_dictionary = None, num_workers = 4):
+
+   """
+      Reads the tweets (JSON lines) of a local zstd segment, decompressing its frames in parallel (zstd releases the GIL)
+
+      Input:
+         • local_file: name/location of the segment (with an index, see read_index)
+         • load_dictionary: function called with a dictionary ID, returns the zstd dictionary (if the segment was compressed with one)
+         • num_workers: number of frames decompressed in parallel
+
+      Output:
+         • generator of lines (str), in the order they were written
+   """
+
+   zstandard = import_zstandard()
+   index = read_index(local_file)
+   if index is None:
+      raise ValueError("{} has no index of frames".format(local_file))
+
+   dictionary = load_dictionary(index['dict_id']) if index['dict_id'] and load_dictionary is not None else None
+   if index['dict_id'] and dictionary is None:
+      raise ValueError("{0} needs zstd dictionary {1}".format(local_file, index['dict_id']))
+
+   def decompress_frame(frame):
+      offset, size, num_lines = frame
+      with open(local_file, 'rb') as f:
+         f.seek(offset)
+         data = f.read(size)
+      # (decompressors aren't thread-safe: one per frame)
+      return zstandard.ZstdDecompressor(dict_data = dictionary).decompress(data).decode('utf-8').split('\n')[:-1]
+
+   # (at most 2 * num_workers frames are decompressed ahead of the reader, so the segment isn't held in memory)
+   with concurrent.futures.ThreadPoolExecutor(max_workers = num_workers) as executor:
+      pending = collections.deque()
+      for frame in index['frames']:
+         pending.append(executor.submit(decompress_frame, frame))
+         if len(pending) >= 2 * num_workers:
+            for line in pending.popleft().result():
+               yield line
+      while pending:
+         for line in pending.popleft().result():
+            yield line
+
+def open_segment(local_file, load_dictionary = None, num_workers = 4):
+
+   """
+      Reads the lines of a local file of raw tweets, whatever its format: zstd segments with an index are decompressed
+      in parallel (read_lines), other files (uncompressed, gzip, zstd) are decompressed sequentially on the fly
+
+      Input:
+         • local_file: name/location of the file
+         • load_dictionary: function called with a dictionary ID, returns the zstd dictionary (e.g., s3_stream.load_AWS_dictionary)
+         • num_workers: number of frames decompressed in parallel
+
+      Output:
+         • iterable of lines (str)
+   """
+
+   if local_file.endswith(EXTENSIONS['zstd']) and read_index(local_file) is not None:
+      return read_lines(local_file, load_dictionary, num_workers)
+
+   return io.TextIOWrapper(s3_stream.decompressed(open(local_file, 'rb'), load_dictionary), encoding = 'utf-8')
+
+
+def main():
+
+   parser = argparse.ArgumentParser(description = "Compressed segments of raw tweets: train a zstd dictionary, or compress a .json file of raw tweets.")
+   subparsers = parser.add_subparsers(dest = "command")
+   train = subparsers.add_parser("train", help = "Train a zstd dictionary on a .json file of raw tweets")
+   train.add_argument("raw_tweets_file", help = "Local .json file of raw tweets (one tweet per line)")
+   train.add_argument("dictionary_file", help = "Name of the dictionary file to write")
+   train.add_argument("--dict_size", help = "Maximum size of the dictionary (bytes)", default = 112640, type = int)
+   train.add_argument("--max_samples", help = "Maximum number of tweets to train on", default = 100000, type = int)
+   compress = subparsers.add_parser("compress", help = "Compress a .json file of raw tweets into a segment")
+   compress.add_argument("raw_tweets_file", help = "Local .json file of raw tweets (one tweet per line)")
+   compress.add_argument("--codec", help = "Compression codec", choices = sorted(EXTENSIONS), default = "zstd")
+   compress.add_argument("--frame_lines", help = "Number of tweets per frame", default = 5000, type = int)
+   compress.add_argument("--dictionary_file", help = "zstd dictionary to compress with")
+   args = parser.parse_args()
+
+   if args.command == "train":
+      with open(args.raw_tweets_file) as f:
+         lines = [line for _, line in zip(range(args.max_samples), f) if line.strip()]
+      dictionary = train_dictionary(lines, args.dict_size)
+      save_dictionary(dictionary, args.dictionary_file)
+      print("Dictionary {0} (ID {1}) trained on {2} tweets".format(args.dictionary_file, dictionary.dict_id(), len(lines)))
+
+   elif args.command == "compress":
+      dictionary = load_dictionary(args.dictionary_file) if args.dictionary_file else None
+      writer = SegmentWriter(segment_name(args.raw_tweets_file, args.codec), args.codec, args.frame_lines, dictionary = dictionary)
+      with open(args.raw_tweets_file) as f:
+         for line in f:
+            if line.strip():
+               writer.write(line)
+      writer.close()
+
+   else:
+      parser.print_help()
+
+if __name__ == '__main__':
+   main()
@@ -33,6 +33,10 @@ import re
 import os
 import time
 
+import metrics
+import s3_stream
+import schema
+
 def authenticate(consumer_key, consumer_secret, access_token, access_secret):
    """
       Allows authentication with Twitter API, with relevant IDs
@@ -94,148 +98,58 @@ def extract_from_AWS(aws_access, aws_secret, bucket, directory, s3_file, local_f
       print("File download unsuccessful")
       print(e)
 
-def get_link(screen_name, tweet_id):
+def format_tweet_dates(created_at):
 
    """
-      Derives tweet link from screen name and tweet id
+      Formats a whole column of tweet dates at once.
          Input:
-            • screen_name: Screen name of user
-            • tweet_id: ID of tweet
-         Output:
-            • link: link of tweet
-   """
-    
-   link = "https://twitter.com/" + screen_name + "/status/" + str(tweet_id)
-   return link
-
-
-def clean_date_tweet(date_str):
-   """
-   Get day name, day #, month, year, of a post. 
-      Input: 
-         • date_str: Date and time of tweet (str).
-               Format example:
-                  '2020-04-03 19:04:26+00:00'
-                  (need to filter out +00:00)
-                    
-      Output:
-         • date_obj: date/time of tweet (Datetime.datetime object)
-   """
-
-   # clean date string 
-   cleaned_date_str = re.sub("\+.{5}", "", date_str)
-
-   # turn string date/time into datetime object
-   date_obj = datetime.datetime.strptime(cleaned_date_str, '%Y-%m-%d %H:%M:%S')
-   return date_obj
-
-
-def get_date_tweet(date_obj):
-
-   """
-      Get day name, day #, month, year, of a post. 
-         Input: 
-            • date_obj: date/time of tweet (Datetime.datetime object)
+            • created_at: pandas Series of tweet dates/times (datetime, or str, e.g. '2020-04-03 19:04:26+00:00')
 
          Output:
-            • day_name: The day of the week (Monday - Sunday)
-            • day_num: The day of the month (1 - 31)
-            • month: month name
-            • year: year
+            • tweet_dates: pandas Series of human-readable dates (e.g. 'Friday, April 3, 2020')
    """
 
-   # initialize array of days
-   days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-
-   # initialize months
-   months = ['January', 'February', 'March', 'April', 'May', 'June', 
-          'July', 'August', 'September', 'October', 'November', 'December']
-
-   # get day name
-   day_name = days[date_obj.weekday()]
+   # parse the whole column at once (handles the +00:00 offset, so no regex stripping is needed)
+   dates = pd.to_datetime(created_at, utc = True, errors = 'coerce')
 
-   # get day number
-   day_num = date_obj.date().day
+   # build the "[day name], [month] [day #], [year]" string in bulk
+   tweet_dates = dates.dt.day_name() + ", " + dates.dt.month_name() + " " + dates.dt.day.astype(str) + ", " + dates.dt.year.astype(str)
+   return tweet_dates
 
-   # get month name
-   month = months[date_obj.date().month - 1]
 
-   # get year
-   year = date_obj.date().year
+def get_users_tweet_info(data):
 
-   return [day_name, day_num, month, year]
-
-
-def get_tweet_info(data, user_id):
-   
    """
-   Use user_id to get tweet info. For cases where a user has multiple tweets, use first tweet. 
-      
+   Gets the tweet info of every user in the df at once. For cases where a user has multiple tweets, use first tweet.
+   Tweets whose date can't be parsed are left out (and counted).
+
       Input: 
-         • data: pandas df
-         • user_id: ID of user (int)
-         • days: array of day names
-         • months: array of month names
-            
+         • data: pandas df (labelled tweets)
+
       Output:
-         • user_id: ID of the user
-         • text: text of tweet
-         • tweet_link: link of tweet
-         • date_time_tweet = [day, day #, month, year] of tweet
-         • gru_prob, the probability of having outrage
+         • outrage_users_info: pandas df with one row per user, with columns 
+            ['user_id', 'tweet_id', 'tweet_text', 'tweet_link', 'tweet_date', 'gru_prob']
    """
 
-   # get tweet text
-   filtered_data = data.loc[data['user_id'] == user_id, :]
-
-   # if no rows, return
-   if filtered_data.shape[0] == 0: 
-      return "No entries with that user ID"
-
-   # if the user has multiple tweets
-   elif filtered_data.shape[0] > 1:
-      # get dates for each of the tweets
-      filtered_data['created_at'] = filtered_data['created_at'].apply(lambda x : clean_date_tweet(x))
-      # get column names of filtered data
-      #print(filtered_data)
-      #print("The column names of the unfiltered data are : {}".format(filtered_data.columns))
-      # get the earliest tweet
-      min_index = np.argmin(np.array(filtered_data['created_at']))
-      # get row corresponding to minimum value. This returns a series.
-      min_series_arr = filtered_data.iloc[min_index, :]
-      # turn series to dictionary
-      min_dict = dict(min_series_arr)
-      # turn dictionary into pandas df
-      filtered_data = pd.DataFrame(min_dict, index = range(1))
-      # change dtype of date column to string
-      filtered_data['created_at'] = filtered_data['created_at'].astype('str')
-      #print("The filtered dataset is : {}".format(filtered_data))
-      #print("The shape of the dataset is : {}".format(filtered_data.shape))
-      #print("The type of the dataset is : {}".format(type(filtered_data)))
-      #print("THE columns of the data are: {}".format(filtered_data.columns))
-
-   # reset indices
-   filtered_data = filtered_data.reset_index()
-
-   # get column names of filtered data
-   #print("The column names are : {}".format(filtered_data.columns))
-   
-   # get tweet text
-   tweet_text = filtered_data['text'][0]
-   #print("THE text is: {}".format(tweet_text))
-   # get tweet link
-   tweet_link = get_link(filtered_data['user_screen_name'][0], filtered_data['tweet_id'][0])
-   #print("THE tweet link is: {}".format(tweet_link))
-
-   # get date and time
-   date_time_arr = get_date_tweet(clean_date_tweet(filtered_data['created_at'][0]))
-   #print("THE tweet date is : {}".format(date_time_arr))
-
-   # get probability of outrage
-   prob_outrage = filtered_data['gru_prob'][0]
-
-   # return
-   return [user_id, tweet_text, tweet_link, date_time_arr, prob_outrage]
+   # parse all dates once (malformed dates become NaT, and their tweets are left out), then keep the earliest tweet of each user
+   first_tweets = data.assign(created_at = pd.to_datetime(data['created_at'], utc = True, errors = 'coerce'))
+   num_bad_dates = int(first_tweets['created_at'].isna().sum())
+   if num_bad_dates > 0:
+      print("{} tweets left out (their date could not be parsed)".format(num_bad_dates))
+      first_tweets = first_tweets.dropna(subset = ['created_at'])
+   first_tweets = first_tweets.sort_values('created_at', kind = 'mergesort').drop_duplicates(subset = 'user_id', keep = 'first')
+
+   # build links and dates for all users in bulk
+   outrage_users_info = pd.DataFrame({'user_id' : first_tweets['user_id'],
+      'tweet_id' : first_tweets['tweet_id'],
+      'tweet_text' : first_tweets['text'],
+      'tweet_link' : "https://twitter.com/" + first_tweets['user_screen_name'].astype(str) + "/status/" + first_tweets['tweet_id'].astype(str),
+      'tweet_date' : format_tweet_dates(first_tweets['created_at']),
+      'gru_prob' : first_tweets['gru_prob']})
+
+   # order the users by the index of their earliest tweet in the data
+   outrage_users_info = outrage_users_info.sort_index().reset_index(drop = True)
+   return outrage_users_info
 
 def see_friend_and_DM_status(api, self_id, user_id, print_status_message):
    """
@@ -255,6 +169,7 @@ def see_friend_and_DM_status(api, self_id, user_id, print_status_message):
 
    # get status of friendship between you and the other user
    try:
+      metrics.count('api_calls')
       friend_obj = api.show_friendship(source_id = user_id, target_id = self_id)
    # rate limit error
    except tweepy.error.TweepError:
@@ -295,6 +210,7 @@ def see_friend_and_DM_status(api, self_id, user_id, print_status_message):
    
    # this only applies if you don't follow them:
    if not you_follow_them:
+      metrics.count('api_calls')
       pending_follow_request = bool(dict(api.get_user('1935121784')._json)['follow_request_sent'])
    else:
       pending_follow_request = False
@@ -343,6 +259,7 @@ def send_DM_to_user(user_id, tweet_text, link, tweet_date, script_str, api):
    # send message
    try:
       # try to send message
+      metrics.count('api_calls')
       api_DM = api.send_direct_message(recipient_id = int(user_id), text = script_str_subbed)
       print("Message to user_id {} successfully sent!".format(user_id))
    except Exception as e:
@@ -364,6 +281,7 @@ def send_friend_request(user_id, api):
          • friend: a tweepy.User object with output information
    """
    try:
+      metrics.count('api_calls')
       friend = api.create_friendship(user_id = user_id)
       print("Friend request to user_id {} successfully sent!".format(user_id))
       return friend
@@ -427,7 +345,10 @@ def main():
    parser.add_argument("export_tweets_name", help = "Name to give to .csv file (without .csv extension) of messaged tweets exported to AWS")
    parser.add_argument("all_users_DMed_import_name", help = "Name of .csv file (without .csv extension), from AWS, that has the list of all users ever DMed")
    parser.add_argument("all_users_DMed_export_name", help = "Name of .csv file (without .csv extension), to export to AWS, that has the updated list of all users ever DMed")
+   parser.add_argument("--metrics_file", help = "Name of file to write the run's metrics to (Prometheus text format)")
+   parser.add_argument("--stage_locally", help = "Download the files from AWS to the local disk before reading them (instead of streaming them)", action = "store_true")
    args = parser.parse_args()
+   metrics.start_run("send_DMs")
 
    # get authentication
    consumer_key = ''
@@ -442,7 +363,9 @@ def main():
       access_secret = twitter_creds.readline().rstrip()
 
    try:
-      auth, api = authenticate(consumer_key, consumer_secret, access_key, access_secret)
+      with metrics.stage("authenticate"):
+         auth, api = authenticate(consumer_key, consumer_secret, access_key, access_secret)
+         metrics.count('api_calls')
    except Exception as e:
       print("Authentication failed")
       print(e)
@@ -459,27 +382,39 @@ def main():
       aws_access = aws_creds.readline().split(sep = "=")[1].rstrip() # separate the equal sign, eliminate \n
       aws_secret = aws_creds.readline().split(sep = "=")[1].rstrip() # separate the equal sign, eliminate \n
 
-   # load files from AWS (extract_from_AWS)
-   try: 
-      # try extraction
-      extract_from_AWS(aws_access, aws_secret, bucket, directory = 'labelled_tweets/', s3_file = import_file_name, local_file = import_file_name)
+   # stream the labelled tweets from AWS (without staging the file on the local disk)
+   if not args.stage_locally:
+      with metrics.stage("load"):
+         data = s3_stream.read_csv(aws_access, aws_secret, bucket, 'labelled_tweets/' + import_file_name, lineterminator = '\n', encoding = 'utf-8-sig')
+         metrics.rows(rows_out = data.shape[0])
+
+   # or load files from AWS (extract_from_AWS)
+   else:
+      try: 
+         # try extraction
+         with metrics.stage("download"):
+            extract_from_AWS(aws_access, aws_secret, bucket, directory = 'labelled_tweets/', s3_file = import_file_name, local_file = import_file_name)
+            metrics.file_read(import_file_name)
          
-      # check if file was exported successfully:
-      if import_file_name in os.listdir():
-         print("{} file successfully imported from AWS. Proceeding with parsing...".format(import_file_name))
-         print("\n")
-      else:
-         print("{} not found in the current directory (something may have gone wrong in the import?)".format(import_file_name))
-         raise ValueError("Data could not be imported")
-   except Exception as e:
-      print("Extraction from AWS failed. Please see error message: ")
-      print(e)
+         # check if file was exported successfully:
+         if import_file_name in os.listdir():
+            print("{} file successfully imported from AWS. Proceeding with parsing...".format(import_file_name))
+            print("\n")
+         else:
+            print("{} not found in the current directory (something may have gone wrong in the import?)".format(import_file_name))
+            raise ValueError("Data could not be imported")
+      except Exception as e:
+         print("Extraction from AWS failed. Please see error message: ")
+         print(e)
 
    
-   # load file
-   data = pd.read_csv(import_file_name, 
-      lineterminator = '\n', 
-      encoding = 'utf-8-sig')
+      # load file
+      with metrics.stage("load"):
+         data = pd.read_csv(import_file_name, 
+            lineterminator = '\n', 
+            encoding = 'utf-8-sig')
+         metrics.file_read(import_file_name)
+         metrics.rows(rows_out = data.shape[0])
 
    # check column names of data (data processed in R comes out differently, so we need to do some preprocessing to adjust for this)
    if 'status_id' in data.columns or 'user_id' in data.columns:
@@ -491,48 +426,13 @@ def main():
       data['status_id'] = data['status_id'].astype(int)
       # rename columns
       data.rename(columns = {'status_id':'tweet_id', 'screen_name':'user_screen_name'}, inplace = True)
+   schema.apply_schema(data, "labelled tweets")
 
-   # loop through all user IDs, get info
-   user_IDs = data.loc[:, 'user_id']
-
-   # initalize arrays
-   user_id_arr = []
-   tweet_text_arr = []
-   tweet_link_arr = []
-   date_time_arr = []
-   gru_prob_arr = []
-
-   # loop through all IDs. If the tweet doesn't exist, skip 
-   for index, user_id in enumerate(user_IDs):
-      # update tweet number every 100
-      if index % 100 == 0:
-         print('\n')
-         print("{0} IDs looped through, out of {1}".format(index, user_IDs.shape[0]))
-         print('\n')
-
-      # get relevant info
-      try:
-         # try to get relevant information
-         user_id, tweet_text, tweet_link, date_time, gru_prob = get_tweet_info(data, user_id)
-
-         # append IDs, text, link to arrays
-         user_id_arr.append(user_id)
-         tweet_text_arr.append(tweet_text)
-         tweet_link_arr.append(tweet_link)
-         gru_prob_arr.append(gru_prob)
-
-         # get date, create custom format, append to array
-         date_str = date_time[0] + ", " + str(date_time[2]) + " " + str(date_time[1]) + ", 2020"
-         date_time_arr.append(date_str)
-
-         #print("Information successfully appended to arrays")
-      except ValueError:
-         print("Error caught. User ID " + str(user_id) + " doesn't exist anymore.")
-         continue
-
-   # make df of outrage tweet and user info (for users whose tweet was marked as outrage and that tweet still exists)
-   outrage_users_info = pd.DataFrame(zip(user_id_arr, tweet_text_arr, tweet_link_arr, date_time_arr, gru_prob_arr), 
-      columns = ['user_id', 'tweet_text', 'tweet_link', 'tweet_date', 'gru_prob'])
+   # get the tweet info (text, link, date, outrage probability) of every user, in one pass
+   with metrics.stage("tweet_info"):
+      outrage_users_info = get_users_tweet_info(data)
+      metrics.rows(rows_in = data.shape[0], rows_out = outrage_users_info.shape[0])
+   print("Tweet info gathered for {} users".format(outrage_users_info.shape[0]))
 
    # read in the script to send
    script_str = ''
@@ -549,24 +449,33 @@ def main():
    users_DMed_import_file = args.all_users_DMed_import_name + '.csv'
    users_DMed_export_file = args.all_users_DMed_export_name + '.csv'
 
-   # import list of users who have been DMed before
-   try: 
-      # try extraction
-      extract_from_AWS(aws_access, aws_secret, bucket, directory = 'lists_users_DMed/', s3_file = users_DMed_import_file, local_file = users_DMed_import_file)
+   # stream the list of users who have been DMed before from AWS
+   if not args.stage_locally:
+      with metrics.stage("load"):
+         df_users_DMed = s3_stream.read_csv(aws_access, aws_secret, bucket, 'lists_users_DMed/' + users_DMed_import_file)
+
+   # or import it from AWS (extract_from_AWS)
+   else:
+      try: 
+         # try extraction
+         with metrics.stage("download"):
+            extract_from_AWS(aws_access, aws_secret, bucket, directory = 'lists_users_DMed/', s3_file = users_DMed_import_file, local_file = users_DMed_import_file)
+            metrics.file_read(users_DMed_import_file)
          
-      # check if file was exported successfully:
-      if users_DMed_import_file in os.listdir():
-         print("{} file (with the list of all users previously DMed) successfully imported from AWS. Proceeding with parsing...".format(users_DMed_import_file))
-         print("\n")
-      else:
-         print("{} not found in the current directory (something may have gone wrong in the import?)".format(import_file_name))
-         raise ValueError("Data could not be imported")
-   except Exception as e:
-      print("Extraction from AWS failed. Please see error message: ")
-      print(e)
+         # check if file was exported successfully:
+         if users_DMed_import_file in os.listdir():
+            print("{} file (with the list of all users previously DMed) successfully imported from AWS. Proceeding with parsing...".format(users_DMed_import_file))
+            print("\n")
+         else:
+            print("{} not found in the current directory (something may have gone wrong in the import?)".format(import_file_name))
+            raise ValueError("Data could not be imported")
+      except Exception as e:
+         print("Extraction from AWS failed. Please see error message: ")
+         print(e)
+
+      # get df of people who we've DMed
+      df_users_DMed = pd.read_csv(users_DMed_import_file)
 
-   # get df of people who we've DMed
-   df_users_DMed = pd.read_csv(users_DMed_import_file)
    print("This is the number of people that we have sent DMs to so far (prior to running this session of the code): {}".format(df_users_DMed.shape[0]))
 
    # get IDs of people that we've already DMed, track number of users we've previously DMed
@@ -575,11 +484,16 @@ def main():
 
    # get own Twitter ID
    self_id = dict(api.me()._json)['id']
+   metrics.count('api_calls')
 
    # initialize number of new friend requests
    number_new_friend_requests = 0
 
+   # users DMed in this session (exported separately, so receive_DMs can update its index of DMed users incrementally)
+   new_users_DMed = []
+
    # loop through all users, send friend requests + DMs
+   DM_stage = metrics.start_stage("send_DMs")
    for i in range(outrage_users_info.shape[0]):
 
       # get vars
@@ -587,6 +501,8 @@ def main():
       text = outrage_users_info.loc[i, 'tweet_text']
       link = outrage_users_info.loc[i, 'tweet_link']
       date = outrage_users_info.loc[i, 'tweet_date']
+      tweet_id = outrage_users_info.loc[i, 'tweet_id']
+      gru_prob = outrage_users_info.loc[i, 'gru_prob']
 
       # get your friend/DM status with the user
       try:
@@ -648,8 +564,11 @@ def main():
             # gather information to add to users who received DMs (name of user, their ID, and when the DM was sent:
             values_to_add_sent_DM = {'user_names' : data.loc[np.where(data['user_id'] == user_id)[0], 'user_screen_name'].values[0], 
                                     'user_ids' : user_id, 
+                                    'tweet_ids' : tweet_id,
+                                    'gru_prob' : gru_prob,
                                     'date_time_messaged' : time_DM_sent}
             df_users_DMed = df_users_DMed.append(values_to_add_sent_DM, sort = False, ignore_index = True)
+            new_users_DMed.append(values_to_add_sent_DM)
             print("User id : {}  - successfully added to list of DMed users".format(user_id))
          except Exception as e:
             print("DM to user_id = {} unsuccessful.".format(user_id))
@@ -673,6 +592,8 @@ def main():
             print("Due to permissions on their account / Twitter, you can't DM them (straight from Twitter status object)")
          else:
             print("You can't DM this user (but reason is unknown)")
+   metrics.rows(rows_in = outrage_users_info.shape[0], rows_out = len(new_users_DMed))
+   metrics.end_stage(DM_stage)
 
    print("This is the new total number of users who we've sent DMs to: {}".format(df_users_DMed.shape[0]))
    print("This is the total number of users in our present dataset who we've DMed before: {}".format(num_users_previously_DMed))
@@ -681,13 +602,24 @@ def main():
    outrage_users_info.to_csv(export_file_name, index = False)
 
    # export list of all users who actually received DMs
-   df_users_DMed = df_users_DMed.loc[:, ['user_names', 'user_ids', 'date_time_messaged']]
-   df_users_DMed.to_csv(users_DMed_export_file)
+   # (lists exported before tweet_ids/gru_prob were recorded don't have those columns)
+   DMed_columns = ['user_names', 'user_ids', 'tweet_ids', 'gru_prob', 'date_time_messaged']
+   df_users_DMed = df_users_DMed.reindex(columns = DMed_columns)
+   with metrics.stage("write"):
+      df_users_DMed.to_csv(users_DMed_export_file)
+      metrics.file_written(users_DMed_export_file)
+
+   # export list of users who received DMs in this session only (named after the session's time, so that a later session with the
+   # same export name doesn't overwrite it)
+   users_DMed_delta_file = "{0}_delta_{1}.csv".format(args.all_users_DMed_export_name, datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+   pd.DataFrame(new_users_DMed, columns = DMed_columns).to_csv(users_DMed_delta_file, index = False)
 
    # re-upload to AWS (store_AWS)
    try:
       print("Storing tweets/IDs/date of tweets of those users who were supposed to receive DMs")
-      store_AWS(aws_access, aws_secret, export_file_name, bucket, directory = "messaged_users_tweets/", s3_file = export_file_name)
+      with metrics.stage("upload"):
+         store_AWS(aws_access, aws_secret, export_file_name, bucket, directory = "messaged_users_tweets/", s3_file = export_file_name)
+         metrics.file_written(export_file_name)
       print("Tweets successfully stored in AWS (For all users who, in this session, were supposed to receive DMs - need to cross-check with list that actually received DMs)")
    except Exception as e:
       print("AWS storage unsuccessful. Please see error message: ")
@@ -696,13 +628,27 @@ def main():
    # re-uploaded list of all users who have received DMs, across all iterations
    try:
       print("Storing tweets/IDs/date of tweets of ALL users who have received DMs")
-      store_AWS(aws_access, aws_secret, users_DMed_export_file, bucket, directory = 'lists_users_DMed/', s3_file = users_DMed_export_file)
+      with metrics.stage("upload"):
+         store_AWS(aws_access, aws_secret, users_DMed_export_file, bucket, directory = 'lists_users_DMed/', s3_file = users_DMed_export_file)
+         metrics.file_written(users_DMed_export_file)
       print("Updated list of ALL users who have received DMs: successfully stored in AWS")
    except Exception as e:
       print("AWS storage unsuccessful. Please see error message: ")
       print(e)
 
+   # upload list of users who received DMs in this session (picked up by receive_DMs.py)
+   try:
+      print("Storing tweets/IDs/date of users who received DMs in this session")
+      with metrics.stage("upload"):
+         store_AWS(aws_access, aws_secret, users_DMed_delta_file, bucket, directory = 'lists_users_DMed_deltas/', s3_file = users_DMed_delta_file)
+         metrics.file_written(users_DMed_delta_file)
+      print("List of users who received DMs in this session: successfully stored in AWS")
+   except Exception as e:
+      print("AWS storage unsuccessful. Please see error message: ")
+      print(e)
+
 
+   metrics.finish_run(args.metrics_file)
    print("Script execution finished.")
 
 if __name__ == "__main__":
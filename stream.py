@@ -10,6 +10,11 @@
       • search_terms = search terms to use when scraping tweets
 
    This script will scrape tweets from Twitter and store them in a "raw_tweets/" directory in an AWS bucket titled "augmented_outrage_classifier_tweets"
+   Only the fields of the raw tweets read by clean.py (plus --extra_fields) are stored, unless --full_payload is used
+   Each tweet is stored with the search terms it matched (matched_terms), unless --no_term_tags is used
+   With --sample, the tweets are sampled over the stream (e.g., over a day with --duration) instead of stopping at max_tweet_count (see sampling.py)
+   With --compress, the raw tweets are stored as a compressed segment (see segments.py)
+   With --classify, tweets are also classified in micro-batches while streaming, and the labelled tweets are stored in the "labelled_tweets/" directory
 
 """
 
@@ -32,6 +37,17 @@ import numpy as np
 import argparse
 import datetime
 import sys
+import os
+import collections
+import heapq
+import threading
+
+# filtering of tweets (same as clean.py)
+import clean
+import metrics
+import sampling
+import segments
+from term_matcher import TermMatcher
 
 
 def authenticate(consumer_key, consumer_secret, access_token, access_secret):
@@ -62,36 +78,121 @@ class Listener(StreamListener):
     """ 
     
     Creates an object that lets us listen for tweets from tweepy's StreamListener class
-    and adds certain functionalities for saving the data to a .json file
+    and adds certain functionalities for saving the data to a .json file.
+    Each listener counts its own tweets, and stops its stream once max_tweets tweets have been received
+    If on_tweet is given, each tweet that passes the filters of clean.py is also parsed and passed on to on_tweet 
+    (e.g., to classify tweets in micro-batches while streaming)
+    If writer is given (segments.SegmentWriter), the tweets are written to a compressed segment instead of the .json file
+    If fields_projection is given (clean.projection), only these fields of the tweets are written (see clean.project_tweet)
+    If prefilter is 'drop' or 'side', the tweets that clean.py filters out (retweets, tweets by verified users, messages that 
+    aren't tweets) are dropped before they are written, or written to a separate file (new_tweets_filtered.json, or filtered_writer)
+    If merger is given (ShardMerger, see stream_sharded), the tweets are passed on to the merger, which writes them 
+    (and duplicates received by other shards are neither written nor passed on to on_tweet)
+    If sampler is given (see sampling.py), only the tweets it samples are stored and passed on to on_tweet, and the stream runs
+    until stop_at (time.time()) instead of stopping at max_tweets
+    If matcher is given (term_matcher.TermMatcher), the tweets are stored with the search terms they matched (matched_terms)
 
     """
 
+    def __init__(self, on_tweet = None, api = None, writer = None, fields_projection = None, prefilter = None, filtered_writer = None,
+        max_tweets = float('inf'), merger = None, shard = 0, sampler = None, stop_at = None, matcher = None):
+        super(Listener, self).__init__(api)
+        self.on_tweet = on_tweet
+        self.writer = writer
+        self.fields_projection = fields_projection
+        self.prefilter = prefilter
+        self.filtered_writer = filtered_writer
+        self.max_tweets = max_tweets
+        self.merger = merger
+        self.shard = shard
+        self.sampler = sampler
+        self.stop_at = stop_at
+        self.matcher = matcher
+        self.tweet_count = 0
+        self.filter_counts = collections.Counter()
+
+    def write(self, data, writer, file_name):
+        # (the listeners of several shards may write to the same file)
+        with _write_lock:
+            if writer is not None:
+                writer.write(data)
+            else:
+                with open(file_name, 'a') as f:
+                    f.write(data)
+
     def on_data(self, data):
 
         # write file
         try:
 
-            # add to tweet count (lets you control how many tweets are scraped)
-            global max_num_tweets
-            global tweet_count
-
-            # update tweet count
-            tweet_count += 1
+            # update tweet count (lets you control how many tweets are scraped)
+            self.tweet_count += 1
 
-            # stream as long as max tweet count isn't exceeded
-            if tweet_count <= max_num_tweets:
+            # stream as long as max tweet count isn't exceeded (and until stop_at, if given)
+            if self.stop_at is not None and t.time() >= self.stop_at:
+               print("End of the streaming window reached. Streaming halted.")
+               return False
+            if self.tweet_count <= self.max_tweets and (self.merger is None or not self.merger.is_full()):
                # every thousand tweets
-               if tweet_count % 1000 == 0:
-                  print("{a} tweets scraped (out of maximum of {b} indicated).".format(a = tweet_count, b = max_num_tweets))
+               if self.tweet_count % 1000 == 0:
+                  print("{a} tweets scraped{c} (out of maximum of {b} indicated).".format(a = self.tweet_count, b = self.max_tweets,
+                     c = " by shard {}".format(self.shard) if self.merger is not None else ""))
             else:
-               print("Specified maximum number of tweets ({max})reached. Streaming halted.".format(max = max_num_tweets))
-               Stream.disconnect(self) # stop collecting tweets after max limit is reached
+               print("Specified maximum number of tweets ({max}) reached. Streaming halted.".format(max = self.max_tweets if self.merger is None else self.merger.max_tweets))
+               return False # stop collecting tweets after max limit is reached
             
-            # write data to a new file
-            with open("new_tweets.json", 'a') as f:
-               f.write(data)
+            # pre-filter the tweets that clean.py drops: the raw JSON is scanned first, and only decoded if the tweet might be filtered out
+            # (tweets that are decoded anyway, to be projected, tagged or passed on, are checked without the scan)
+            tweet = None
+            will_decode = self.fields_projection is not None or self.on_tweet is not None or self.matcher is not None
+            if self.prefilter is not None:
+               if will_decode or clean.might_be_filtered(data):
+                  tweet = json.loads(data)
+                  reason = clean.filter_reason(tweet)
+                  self.filter_counts['decoded'] += 1
+               else:
+                  reason = None
+                  self.filter_counts['passed_scan'] += 1
+
+               if reason is not None:
+                  self.filter_counts[reason] += 1
+                  self.filter_counts['bytes'] += len(data)
+                  metrics.count('filtered_' + reason)
+                  metrics.count('filtered_bytes', len(data))
+                  if self.prefilter == 'side':
+                     self.write(data, self.filtered_writer, "new_tweets_filtered.json")
+                  return True
+
+            # keep only the fields used downstream (messages that aren't tweets, e.g. limit notices, are dropped)
+            if tweet is None and will_decode:
+               tweet = json.loads(data)
+            # tag the tweet with the search terms it matched
+            if self.matcher is not None:
+               clean.tag_matched_terms(tweet, self.matcher)
+            if self.fields_projection is not None:
+               if 'text' not in tweet:
+                  return True
+               data = json.dumps(clean.project_tweet(tweet, self.fields_projection), separators = (',', ':')) + '\n'
+            elif tweet is not None and 'matched_terms' in tweet:
+               # (the full payload is stored as received, with the matched terms added at the end)
+               data = data.rstrip()[:-1] + ',"matched_terms":' + json.dumps(tweet['matched_terms'], separators = (',', ':')) + '}\n'
+
+            # skip the tweets already received by another shard (before they are sampled)
+            if self.merger is not None and not self.merger.claim(tweet.get('id_str') if tweet is not None else tweet_id_of(data)):
                return True
 
+            # sample the tweets (the sampler decides which tweets are stored, and when)
+            if self.sampler is not None:
+               for data, tweet in self.sampler.add((data, tweet)):
+                  self.emit(data, tweet)
+            else:
+               self.emit(data, tweet)
+
+            return True
+
+        # (Ctrl-C stops the stream, instead of being reported as an error of the tweet)
+        except KeyboardInterrupt:
+            raise
         except BaseException as e:
             print('Error on data: %s' % str(e))
             t.sleep(5)
@@ -99,6 +200,34 @@ class Listener(StreamListener):
         return True
     
     
+    def emit(self, data, tweet):
+
+        """ Stores a tweet, and passes it on to on_tweet """
+
+        # write data to a new file (or pass it on to the merger of the shards)
+        if self.merger is not None:
+           tweet_id = tweet.get('id_str') if tweet is not None else tweet_id_of(data)
+           if not self.merger.add(tweet_id, data, self.shard):
+              return
+        else:
+           self.write(data, self.writer, "new_tweets.json")
+           metrics.rows(rows_out = 1)
+           metrics.count('bytes_written', len(data))
+
+        # pass parsed tweet on (for micro-batch classification)
+        if self.on_tweet is not None:
+           record = clean.parse_tweet(tweet if tweet is not None else json.loads(data))
+           if record is not None:
+              self.on_tweet(record)
+
+    def finish(self):
+
+        """ Stores the tweets still held by the sampler (call once the stream is finished) """
+
+        if self.sampler is not None:
+           for data, tweet in self.sampler.flush():
+              self.emit(data, tweet)
+    
     #Handles minor errors
     def on_error(self, status):
         print(status)
@@ -108,7 +237,129 @@ class Listener(StreamListener):
             #because Twitter applies penalities once the rate limit is breached
             return False      
 
-def stream_tweets(search_terms, file_name, auth, max_tweets):
+_write_lock = threading.Lock()
+
+# ID of a raw tweet (the top-level id_str comes before the id_str of nested objects, e.g. user, in the tweets 
+# delivered by Twitter and in projected tweets. A quote inside a string value is always escaped, so text can't match)
+TWEET_ID_PATTERN = re.compile(r'"id_str":\s*"(\d+)"')
+
+def tweet_id_of(data):
+   match = TWEET_ID_PATTERN.search(data)
+   return match.group(1) if match is not None else None
+
+class ShardMerger(object):
+
+   """
+
+   Merges the tweets received by several shards (connections) into one output, ordered by tweet ID and without duplicates
+   (a tweet that matches the search terms of several shards is received by each of them).
+
+   Tweet IDs increase with time, but the shards deliver their tweets independently: tweets are held in a buffer of 
+   reorder_window tweets, and written in the order of their IDs once the buffer is full (or when the merger is closed). 
+   A tweet that arrives after a tweet with a higher ID was written (more than reorder_window tweets late) is written 
+   right away (counted as late). The IDs of the last seen_window tweets are kept to find duplicates.
+
+   """
+
+   def __init__(self, writer = None, file_name = "new_tweets.json", max_tweets = float('inf'), reorder_window = 1000, seen_window = 1000000):
+
+      """
+         Input:
+            • writer: segments.SegmentWriter to write the tweets to (optional: the .json file by default)
+            • file_name: name of the .json file to write the tweets to (if there is no writer)
+            • max_tweets: number of (unique) tweets after which the shards stop
+            • reorder_window: number of tweets held in the buffer to order them by ID
+            • seen_window: number of tweet IDs kept to find duplicates
+      """
+
+      self.writer = writer
+      self.file_name = file_name
+      self.max_tweets = max_tweets
+      self.reorder_window = reorder_window
+      self.seen_window = seen_window
+      self.counts = collections.Counter()
+      self.shard_counts = collections.Counter()
+      self._seen = collections.OrderedDict()
+      self._buffer = []
+      self._sequence = 0
+      self._last_written = -1
+      self._lock = threading.Lock()
+      self._file = open(file_name, 'a') if writer is None else None
+
+   def is_full(self):
+      return self.counts['unique'] >= self.max_tweets
+
+   def claim(self, tweet_id):
+
+      """
+         Checks if a tweet is new: returns True the first time a tweet ID is given, False if it was already received by another shard
+      """
+
+      with self._lock:
+         self.counts['received'] += 1
+         if tweet_id is None:
+            return True
+         if tweet_id in self._seen:
+            self.counts['duplicates'] += 1
+            metrics.count('duplicate_tweets')
+            return False
+         self._seen[tweet_id] = None
+         if len(self._seen) > self.seen_window:
+            self._seen.popitem(last = False)
+      return True
+
+   def add(self, tweet_id, data, shard = 0):
+
+      """
+         Adds a (new, see claim) tweet received by a shard. Returns False if max_tweets tweets have already been added
+      """
+
+      with self._lock:
+         # (the other shards may have reached max_tweets since this shard checked)
+         if self.is_full():
+            return False
+         self.counts['unique'] += 1
+         self.shard_counts[shard] += 1
+         self._sequence += 1
+         heapq.heappush(self._buffer, (int(tweet_id) if tweet_id is not None else self._last_written, self._sequence, data))
+         while len(self._buffer) > self.reorder_window:
+            self._write(*heapq.heappop(self._buffer))
+
+      return True
+
+   def _write(self, tweet_id, sequence, data):
+      if tweet_id < self._last_written:
+         self.counts['late'] += 1
+      self._last_written = max(self._last_written, tweet_id)
+      with _write_lock:
+         if self.writer is not None:
+            self.writer.write(data)
+         else:
+            self._file.write(data)
+      self.counts['written'] += 1
+      metrics.rows(rows_out = 1)
+      metrics.count('bytes_written', len(data))
+
+   def close(self):
+
+      """ Writes the tweets left in the buffer (call once the shards are done) """
+
+      with self._lock:
+         while self._buffer:
+            self._write(*heapq.heappop(self._buffer))
+         if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def split_terms(search_terms, num_shards):
+
+   """ Splits the search terms across shards (round robin), e.g. ['a', 'b', 'c'] on 2 shards -> [['a', 'c'], ['b']] """
+
+   shards = [search_terms[i::num_shards] for i in range(min(num_shards, len(search_terms)))]
+   return shards or [search_terms]
+
+def stream_tweets(search_terms, file_name, auth, max_tweets, on_tweet = None, writer = None, fields_projection = None, prefilter = None, filtered_writer = None,
+   stream_factory = Stream, sampler = None, duration = None, matcher = None):
 
    """
 
@@ -118,19 +369,26 @@ def stream_tweets(search_terms, file_name, auth, max_tweets):
          • search_terms: terms to search for during the stream (array)
          • file_name: name of exported .json file
          • auth: authentication from verification step
+         • on_tweet: function called with each tweet that passes the filters of clean.py (optional)
+         • writer: segments.SegmentWriter to write the tweets to, instead of the .json file (optional)
+         • fields_projection: fields of the tweets to write (clean.projection, optional: all the fields by default)
+         • prefilter: 'drop' or 'side' to drop or separate the tweets that clean.py filters out (optional, see Listener)
+         • filtered_writer: segments.SegmentWriter to write the filtered tweets to, with prefilter = 'side' (optional)
+         • stream_factory: class/function (auth, listener, **kwargs) -> stream, tweepy's Stream by default (e.g., replay.stream_factory to replay recorded tweets offline)
+         • sampler: sampler of the tweets to store (see sampling.py, optional: with a sampler, max_tweets isn't a hard stop)
+         • duration: number of seconds after which the stream stops (optional)
+         • matcher: term_matcher.TermMatcher of the search terms, to tag the tweets with the terms they matched (optional)
+      Output:
+         • listener: the Listener (with its counts of tweets and filtered tweets)
 
    """
 
-   # initialize tweet counts
-   global tweet_count
-   global max_num_tweets
-   tweet_count = 0
-   max_num_tweets = max_tweets
-
    # create an instance of streaming, with the listener class above
    try:
-      listener = Listener()
-      twitter_stream = Stream(auth, listener, tweet_mode = 'extended', include_entities = True)
+      listener = Listener(on_tweet, writer = writer, fields_projection = fields_projection, prefilter = prefilter, filtered_writer = filtered_writer,
+         max_tweets = max_tweets if sampler is None else float('inf'), sampler = sampler, stop_at = t.time() + duration if duration else None,
+         matcher = matcher)
+      twitter_stream = stream_factory(auth, listener, tweet_mode = 'extended', include_entities = True)
       print("Twitter stream initialized")
 
    except Exception as e:
@@ -139,15 +397,81 @@ def stream_tweets(search_terms, file_name, auth, max_tweets):
 
    # start streaming, with parameters
    try:
+      print("Streaming in progress. Searching for tweets with the following terms: " + ", ".join(search_terms))
       twitter_stream.filter(languages = ['en'], track = search_terms)
-      print("Streaming in progressing. Searching for tweets with the following terms: " + search_terms)
    except Exception as e:
       print("Problem with streaming in progress (Twitter stream already initialized)")
       print(e)
    finally:
+      listener.finish()
       print("Twitter stream finished (successful if no exception has been raised.)")
 
-def store_AWS(aws_access, aws_secret, local_file, bucket, s3_file):
+   return listener
+
+def stream_sharded(search_terms, auths, max_tweets, num_shards = None, on_tweet = None, writer = None, fields_projection = None, prefilter = None, 
+   filtered_writer = None, stream_factory = Stream, reorder_window = 1000, sampler = None, duration = None, matcher = None):
+
+   """
+
+      Streams tweets over several connections (shards) at once, each with its own Listener and its share of the search terms, 
+      so that the tweets delivered are not capped by a single connection. The tweets of the shards are merged into one output 
+      (new_tweets.json, or writer), ordered by tweet ID and without duplicates (see ShardMerger)
+      Input: 
+         • search_terms: terms to search for during the stream (array), split across the shards (see split_terms)
+         • auths: authentications (one per credential set). Twitter allows one filter connection per credential set, so there
+           should be one per shard (shards only use them in turn if there are more shards than credential sets, e.g. for replays)
+         • max_tweets: maximum number of (unique) tweets, across all shards
+         • num_shards: number of connections (default: one per credential set)
+         • on_tweet / writer / fields_projection / prefilter / filtered_writer / stream_factory / duration / matcher: see stream_tweets
+         • sampler: sampler of the tweets to store, shared by the shards (see sampling.py, optional)
+         • reorder_window: number of tweets held to order them by ID (see ShardMerger)
+      Output:
+         • listeners: the Listener of each shard
+         • merger: the ShardMerger (with its counts of unique, duplicate and late tweets)
+
+   """
+
+   terms_by_shard = split_terms(search_terms, num_shards or len(auths))
+   merger = ShardMerger(writer, max_tweets = max_tweets if sampler is None else float('inf'), reorder_window = reorder_window)
+   stop_at = t.time() + duration if duration else None
+   listeners = []
+   threads = []
+
+   for shard, terms in enumerate(terms_by_shard):
+      listener = Listener(on_tweet, writer = writer, fields_projection = fields_projection, prefilter = prefilter, filtered_writer = filtered_writer,
+         merger = merger, shard = shard, sampler = sampler, stop_at = stop_at, matcher = matcher)
+      twitter_stream = stream_factory(auths[shard % len(auths)], listener, tweet_mode = 'extended', include_entities = True)
+      print("Shard {0}: searching for tweets with the following terms: {1}".format(shard, ", ".join(terms)))
+
+      def run_shard(twitter_stream = twitter_stream, terms = terms, shard = shard):
+         try:
+            with metrics.stage("shard_{}".format(shard)):
+               twitter_stream.filter(languages = ['en'], track = terms)
+         except Exception as e:
+            print("Problem with streaming in progress (shard {})".format(shard))
+            print(e)
+         finally:
+            print("Twitter stream of shard {} finished".format(shard))
+
+      listeners.append(listener)
+      threads.append(threading.Thread(target = run_shard, name = "shard-{}".format(shard), daemon = True))
+
+   for thread in threads:
+      thread.start()
+   try:
+      for thread in threads:
+         thread.join()
+   finally:
+      # (the shards share the sampler: the first listener stores the tweets it still holds)
+      listeners[0].finish()
+      merger.close()
+
+   print("{0} tweets received by {1} shards: {2} unique, {3} duplicates, {4} written out of order".format(merger.counts['received'], 
+      len(listeners), merger.counts['unique'], merger.counts['duplicates'], merger.counts['late']))
+
+   return listeners, merger
+
+def store_AWS(aws_access, aws_secret, local_file, bucket, s3_file, directory = "raw_tweets/"):
 
    """
       Takes the exported .json file from stream_tweets, and stores it into aws
@@ -157,6 +481,7 @@ def store_AWS(aws_access, aws_secret, local_file, bucket, s3_file):
          • local_file: name/location of local .json file
          • bucket: name of bucket in AWS S3 storage (place to store data)
          • s3_file: name of file once it is stored in AWS
+         • directory: the directory/folder to store the file in (default: 'raw_tweets/')
    """
 
    # use boto3 to interface with AWS
@@ -171,7 +496,7 @@ def store_AWS(aws_access, aws_secret, local_file, bucket, s3_file):
 
    # upload data to AWS
    try:
-      s3.upload_file(local_file, bucket, "raw_tweets/" + s3_file)
+      s3.upload_file(local_file, bucket, directory + s3_file)
       print("Upload Successful")
       return True
    except FileNotFoundError:
@@ -187,6 +512,17 @@ def store_AWS(aws_access, aws_secret, local_file, bucket, s3_file):
 
    print("Export to AWS finished.")
 
+def store_dictionary(aws_access, aws_secret, bucket, dictionary):
+
+   """
+      Stores a zstd dictionary in AWS ('zstd_dictionaries/[dictionary ID].dict'), where clean.py finds it (see s3_stream.load_AWS_dictionary)
+   """
+
+   s3 = boto3.client('s3', 
+                     aws_access_key_id = aws_access,
+                     aws_secret_access_key= aws_secret)
+   s3.put_object(Bucket = bucket, Key = "zstd_dictionaries/{}.dict".format(dictionary.dict_id()), Body = dictionary.as_bytes())
+
 def main():
 
    # get params
@@ -197,34 +533,137 @@ def main():
       default = "outrage_tweets_streamed_{}".format(datetime.datetime.today().strftime ('%d-%b-%Y'))) # named by current date, by default
    parser.add_argument("max_tweet_count", help = "Maximum number of tweets to scrape", default = 250000, type = int)
    parser.add_argument("search_terms", help = "Search terms to use for Twitter streaming query.", nargs = "+") # unspecified # of possible keywords
+   parser.add_argument("--metrics_file", help = "Name of file to write the run's metrics to (Prometheus text format)")
+   parser.add_argument("--classify", help = "Classify tweets in micro-batches while streaming (labelled tweets are exported to a [export_tweets_name]_labelled.csv file)", action = "store_true")
+   parser.add_argument("--batch_size", help = "Maximum number of tweets per classification micro-batch", default = 500, type = int)
+   parser.add_argument("--batch_interval", help = "Maximum number of seconds a tweet waits for its micro-batch to be classified", default = 5.0, type = float)
+   parser.add_argument("--full_payload", help = "Store the full raw tweets (by default, only the fields read by clean.py are stored)", action = "store_true")
+   parser.add_argument("--extra_fields", help = "Fields of the raw tweets to store on top of the fields read by clean.py (e.g., lang place.full_name entities.user_mentions[].id_str)", 
+      nargs = "+", default = [])
+   parser.add_argument("--prefilter", help = "What to do with the tweets that clean.py filters out (retweets, tweets by verified users): drop them at ingest, " + 
+      "store them separately (side: in the 'filtered_tweets/' directory), or store them with the other tweets (off)", choices = ['drop', 'side', 'off'], default = 'drop')
+   parser.add_argument("--compress", help = "Store the raw tweets as a compressed segment ([export_tweets_name].json.zst or .json.gz, see segments.py)", choices = sorted(segments.EXTENSIONS))
+   parser.add_argument("--frame_lines", help = "Number of tweets per compressed frame", default = 5000, type = int)
+   parser.add_argument("--zstd_dictionary", help = "zstd dictionary file to compress the raw tweets with (trained with 'python segments.py train')")
+   parser.add_argument("--shards", help = "Number of connections to stream over, each with its share of the search terms (the tweets are merged into one file, ordered and without duplicates)", 
+      default = 1, type = int)
+   parser.add_argument("--extra_twitter_credentials", help = "Text files with more Twitter developer credentials, for the other shards (one credential set per shard)", 
+      nargs = "+", default = [])
+   parser.add_argument("--reorder_window", help = "Number of tweets held to order the tweets of the shards by ID", default = 1000, type = int)
+   parser.add_argument("--no_term_tags", help = "Don't store the search terms matched by each tweet (matched_terms)", action = "store_true")
+   parser.add_argument("--sample", help = "Sample the tweets over the stream instead of stopping at max_tweet_count (see sampling.py): a random sample of max_tweet_count tweets (reservoir), " + 
+      "at most --max_per_minute tweets per minute (rate), or at most --term_quota tweets per search term (quota)", choices = ['reservoir', 'rate', 'quota'])
+   parser.add_argument("--duration", help = "Number of seconds to stream for (e.g., 86400 to sample a day)", type = float)
+   parser.add_argument("--sample_window", help = "Window (seconds) of the reservoir sample and of the term quotas (default: the whole stream; --sample reservoir needs --duration or --sample_window)", type = float)
+   parser.add_argument("--max_per_minute", help = "Maximum number of tweets stored per minute (--sample rate)", default = 100, type = int)
+   parser.add_argument("--term_quota", help = "Maximum number of tweets stored per search term, in each window (--sample quota)", default = 1000, type = int)
+   parser.add_argument("--replay", help = "Replay tweets offline instead of streaming from Twitter: local .json file, 'synthetic:[number of tweets]' or 'tcp://[host]:[port]' (see replay.py)")
+   parser.add_argument("--replay_rate", help = "Rate at which the tweets are replayed (see replay.py)", choices = ['max', 'fixed', 'bursty'], default = 'max')
+   parser.add_argument("--replay_tweets_per_second", help = "Rate of the replayed tweets (fixed and bursty)", default = 1000.0, type = float)
    args = parser.parse_args()
-
-   # get authentication
-   consumer_key = ''
-   consumer_secret = ''
-   access_key = ''
-   access_secret = ''
-
-   with open(args.twitter_credentials, 'r') as twitter_creds:
-      consumer_key = twitter_creds.readline().rstrip() # reads line, removes trailing whitespaces
-      consumer_secret = twitter_creds.readline().rstrip()
-      access_key = twitter_creds.readline().rstrip()
-      access_secret = twitter_creds.readline().rstrip()
-
-   try:
-      auth, api = authenticate(consumer_key, consumer_secret, access_key, access_secret)
-   except Exception as e:
-      print("Authentication failed")
-      print(e)
+   # (the reservoir only stores its sample at the end of each window, or of the stream)
+   if args.sample == 'reservoir' and not (args.duration or args.sample_window):
+      print("--sample reservoir needs --duration or --sample_window: without them, no tweets are stored until the stream is interrupted")
+      sys.exit()
+   metrics.start_run("stream")
+
+   # get authentication (one per credential set, for sharded streaming)
+   auths = []
+   for credentials_file in [args.twitter_credentials] + args.extra_twitter_credentials:
+      with open(credentials_file, 'r') as twitter_creds:
+         consumer_key = twitter_creds.readline().rstrip() # reads line, removes trailing whitespaces
+         consumer_secret = twitter_creds.readline().rstrip()
+         access_key = twitter_creds.readline().rstrip()
+         access_secret = twitter_creds.readline().rstrip()
+
+      # (replayed tweets don't need Twitter)
+      auth = None
+      try:
+         if not args.replay:
+            with metrics.stage("authenticate"):
+               auth, api = authenticate(consumer_key, consumer_secret, access_key, access_secret)
+               metrics.count('api_calls')
+      except Exception as e:
+         print("Authentication failed")
+         print(e)
+      auths.append(auth)
+   num_shards = max(args.shards, len(auths))
+   # (Twitter allows one filter connection per credential set: more shards would disconnect each other)
+   if num_shards > len(auths) and not args.replay:
+      print("{0} shards need {0} credential sets, but only {1} were given (see --extra_twitter_credentials). Streaming over {1} shard(s)".format(num_shards, len(auths)))
+      num_shards = len(auths)
 
    # get number of tweets to stream, as well as an initialized count variable
    max_num_tweets = args.max_tweet_count
-   tweet_count = 0
+
+   # set up micro-batch classification (the classifier is only imported if needed)
+   tweet_batcher = None
+   if args.classify:
+      import classify
+      import pipeline
+
+      labelled_file_name = args.export_tweets_name + "_labelled.csv"
+      gru_model = pipeline.load_model("model_files/GRU_20200309.h5", custom_objects={'threshold_acc': pipeline.threshold_acc})
+      embedding_tokenizer = pipeline.load('model_files/training.joblib')
+      print("Model files successfully loaded")
+
+      def process_tweets(records):
+         labelled_tweets = pipeline.classify_batch(records, gru_model, embedding_tokenizer, args.export_tweets_name)
+         # append the micro-batch to the labelled tweets (the header is only written once)
+         labelled_tweets.to_csv(labelled_file_name, mode = 'a', index = False, header = not os.path.exists(labelled_file_name), encoding = 'utf-8')
+         print("Micro-batch of {0} tweets classified ({1} with outrage)".format(labelled_tweets.shape[0], int(labelled_tweets['gru_binary'].sum())))
+
+      tweet_batcher = pipeline.MicroBatcher(process_tweets, args.batch_size, args.batch_interval).start()
+
+   # write the raw tweets to a compressed segment (optional)
+   raw_file_name = segments.segment_name("new_tweets.json", args.compress)
+   filtered_file_name = segments.segment_name("new_tweets_filtered.json", args.compress)
+   writer = None
+   filtered_writer = None
+   if args.compress:
+      dictionary = segments.load_dictionary(args.zstd_dictionary) if args.zstd_dictionary else None
+      writer = segments.SegmentWriter(raw_file_name, args.compress, args.frame_lines, dictionary = dictionary)
+      if args.prefilter == 'side':
+         filtered_writer = segments.SegmentWriter(filtered_file_name, args.compress, args.frame_lines, dictionary = dictionary)
+
+   # replay recorded tweets instead of streaming from Twitter (optional, for load-testing)
+   stream_factory = Stream
+   if args.replay:
+      import replay
+      stream_factory = replay.stream_factory(args.replay, args.replay_rate, args.replay_tweets_per_second)
+
+   # tag each tweet with the search terms it matched, and sample the tweets over the stream instead of stopping at max_num_tweets (optional)
+   matcher = None if args.no_term_tags else TermMatcher(args.search_terms)
+   sampler = sampling.make_sampler(args.sample, args.search_terms, max_num_tweets, args.sample_window, args.max_per_minute, args.term_quota)
 
    # stream tweets
    try:
-      print("The maximum number of tweets to scrape: " + str(max_num_tweets))
-      stream_tweets(args.search_terms, args.export_tweets_name, auth, max_num_tweets)
+      if sampler is None:
+         print("The maximum number of tweets to scrape: " + str(max_num_tweets))
+      else:
+         print("Sampling the tweets ({0}) for {1}".format(args.sample, "{} seconds".format(args.duration) if args.duration else "as long as the stream runs"))
+      with metrics.stage("stream"):
+         stream_args = dict(on_tweet = tweet_batcher.add if tweet_batcher is not None else None, writer = writer, 
+            fields_projection = None if args.full_payload else clean.projection(clean.PARSED_FIELDS + args.extra_fields),
+            prefilter = None if args.prefilter == 'off' else args.prefilter, filtered_writer = filtered_writer,
+            stream_factory = stream_factory, sampler = sampler, duration = args.duration, matcher = matcher)
+         if num_shards > 1:
+            listeners, merger = stream_sharded(args.search_terms, auths, max_num_tweets, num_shards, reorder_window = args.reorder_window, **stream_args)
+            tweet_count = merger.counts['written']
+         else:
+            listeners = [stream_tweets(args.search_terms, args.export_tweets_name, auths[0], max_num_tweets, **stream_args)]
+            tweet_count = listeners[0].tweet_count
+         for segment_writer in [writer, filtered_writer]:
+            if segment_writer is not None:
+               segment_writer.close()
+      if args.prefilter != 'off':
+         counts = sum((listener.filter_counts for listener in listeners), collections.Counter())
+         print("Pre-filter: {0} retweets, {1} tweets by verified users and {2} other messages filtered out ({3:.1f} MB), {4} tweets decoded to be checked, {5} kept by the scan of the raw JSON without being decoded".format(
+            counts['retweet'], counts['verified'], counts['not_tweet'], counts['bytes'] / 1e6, counts['decoded'], counts['passed_scan']))
+      if sampler is not None:
+         print("Sampling: {0} tweets stored out of {1}".format(sampler.counts['kept'], sampler.counts['offered']))
+         if args.sample == 'quota':
+            print("{} tweets matched none of the search terms (quota of their own)".format(sampler.counts['unmatched']))
       print("Tweet streaming step successful. {} tweets scraped. Tweets automatically stored in a new_tweets.json file, which is temporary".format(tweet_count))
       print("The new file will now we stored to AWS")
    except Exception as e:
@@ -232,7 +671,7 @@ def main():
       print(e)
 
    # store in AWS
-   export_file_name = args.export_tweets_name + ".json"
+   export_file_name = segments.segment_name(args.export_tweets_name + ".json", args.compress)
    aws_access = ''
    aws_secret = ''
    bucket = 'augmented-outrage-classifier-tweets' # name of bucket in AWS
@@ -243,12 +682,32 @@ def main():
       aws_secret = aws_creds.readline().split(sep = "=")[1].rstrip() # separate the equal sign, eliminate \n
 
    try:
-      store_AWS(aws_access, aws_secret, "new_tweets.json", bucket, export_file_name)
+      with metrics.stage("upload"):
+         store_AWS(aws_access, aws_secret, raw_file_name, bucket, export_file_name)
+         metrics.file_written(raw_file_name)
+         if args.prefilter == 'side' and os.path.exists(filtered_file_name):
+            store_AWS(aws_access, aws_secret, filtered_file_name, bucket, export_file_name, directory = "filtered_tweets/")
+         # (the dictionary is needed to read the segment)
+         if writer is not None and writer.dictionary is not None:
+            store_dictionary(aws_access, aws_secret, bucket, writer.dictionary)
       print("Tweets successfully stored in AWS")
    except Exception as e:
       print("AWS storage unsuccessful")
       print(e)
 
+   # classify the last micro-batch, then store the labelled tweets in AWS
+   if tweet_batcher is not None:
+      with metrics.stage("classify_last_batch"):
+         tweet_batcher.stop()
+      print("{} micro-batches of tweets classified".format(tweet_batcher.num_batches))
+      try:
+         classify.store_AWS(aws_access, aws_secret, labelled_file_name, bucket, labelled_file_name)
+         print("Labelled tweets successfully stored in AWS")
+      except Exception as e:
+         print("AWS storage unsuccessful")
+         print(e)
+
+   metrics.finish_run(args.metrics_file)
    print("Script for tweet scraping and storage in AWS: Finished")
 
 if __name__ == '__main__':
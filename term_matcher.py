@@ -0,0 +1,124 @@
+"""
+   term_matcher.py
+
+   Finds which of the search terms of the stream each tweet matched, in a single pass over its text, however many terms there are,
+   instead of searching the text for every term one after the other:
+      • words made of letters and digits only (most terms) are looked up in a hash set, for each word of the text
+        (the text is split into words by a compiled regular expression, in C)
+      • other words (e.g., 'covid-19', '#metoo', "don't") are found by an Aho-Corasick automaton, built only if there are such words
+
+   Terms are matched like Twitter's track parameter: case insensitive, on whole words (so 'vote' matches 'vote', '#vote' and
+   '@vote', but not 'voters'), and a term of several words (e.g., 'wear mask') matches if the text contains each of its words.
+
+   Usage:
+      matcher = term_matcher.TermMatcher(["outrage", "wear mask", "vote"])
+      matcher.match("Why won't they WEAR a mask? #outrage")   -> ['outrage', 'wear mask']
+
+"""
+
+import collections
+import re
+
+# words of a text (runs of letters and digits)
+WORD_PATTERN = re.compile(r'[^\W_]+')
+
+
+class TermMatcher(object):
+
+   """
+
+   Compiled matcher of search terms (see module docstring). The automaton only depends on the terms, so the matcher can be
+   built once and used for every tweet (and pickled, e.g. to be sent to the processes of clean.py --batch)
+
+   """
+
+   def __init__(self, terms):
+
+      """
+         Input:
+            • terms: search terms (list of str)
+      """
+
+      self.terms = list(terms)
+      self.term_words = [tuple(term.lower().split()) for term in self.terms]
+      self._word_terms = collections.defaultdict(list)
+      for index, term_words in enumerate(self.term_words):
+         for word in set(term_words):
+            self._word_terms[word].append(index)
+
+      self._plain_words = frozenset(word for word in self._word_terms if WORD_PATTERN.fullmatch(word))
+      self._build_automaton(sorted(word for word in self._word_terms if word not in self._plain_words))
+
+   def _build_automaton(self, words):
+
+      # trie of the words (state 0 is the root), then failure links in breadth-first order, turning the trie into a
+      # deterministic automaton: transitions[state][char] is the next state (chars that aren't in any word go back to the root)
+      transitions = [{}]
+      outputs = [[]]
+      for word in words:
+         state = 0
+         for char in word:
+            if char not in transitions[state]:
+               transitions.append({})
+               outputs.append([])
+               transitions[state][char] = len(transitions) - 1
+            state = transitions[state][char]
+         outputs[state].append(word)
+
+      alphabet = set(char for word in words for char in word)
+      fail = [0] * len(transitions)
+      queue = collections.deque(transitions[0].values())
+      while queue:
+         state = queue.popleft()
+         outputs[state] = outputs[state] + outputs[fail[state]]
+         for char, next_state in list(transitions[state].items()):
+            fail[next_state] = transitions[fail[state]].get(char, 0) if state != 0 else 0
+            queue.append(next_state)
+         # (missing transitions follow the failure link, already resolved for the shallower failure state)
+         if state != 0:
+            for char in alphabet:
+               if char not in transitions[state]:
+                  next_state = transitions[fail[state]].get(char, 0)
+                  if next_state:
+                     transitions[state][char] = next_state
+
+      self._transitions = transitions if words else None
+      self._outputs = [tuple((word, len(word)) for word in output) for output in outputs]
+
+   def match_words(self, text):
+
+      """ Returns the set of words of the terms found in the text (as whole words) """
+
+      text = text.lower()
+      plain_words = self._plain_words
+      found = set(word for word in WORD_PATTERN.findall(text) if word in plain_words)
+      if self._transitions is None:
+         return found
+
+      transitions = self._transitions
+      outputs = self._outputs
+      state = 0
+      for end, char in enumerate(text):
+         state = transitions[state].get(char, 0)
+         if outputs[state]:
+            for word, length in outputs[state]:
+               start = end - length + 1
+               # (whole words only: the characters around the word aren't letters or digits)
+               if (start == 0 or not text[start - 1].isalnum()) and (end + 1 == len(text) or not text[end + 1].isalnum()):
+                  found.add(word)
+
+      return found
+
+   def match(self, text):
+
+      """
+         Returns the search terms matched by a text (in the order of the terms)
+      """
+
+      if not text:
+         return []
+      found = self.match_words(text)
+      if not found:
+         return []
+      candidates = sorted(set(index for word in found for index in self._word_terms[word]))
+      return [self.terms[index] for index in candidates if all(word in found for word in self.term_words[index])]
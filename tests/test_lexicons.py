@@ -0,0 +1,61 @@
+"""
+   test_lexicons.py
+
+   Checks that the sparse lexicon scores of lexicons.py are exactly the same as scoring each tweet one token at a time
+   (as helpers.get_arousal and helpers.get_expanded_outrage do), including repeated tokens, tweets without tokens and
+   tokens that aren't in any lexicon.
+
+   Usage:
+      python -m pytest tests
+
+"""
+
+import os
+import random
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lexicons
+
+AROUSAL = {'angri': 6.2, 'calm': 1.7, 'furious': 7.4, 'sad': 3.1}
+OUTRAGE = ['outrag', 'disgust', 'angri']
+
+
+def row_scores(tokens):
+
+   """ Scores of one tweet summed one token at a time """
+
+   tokens = lexicons.tokens_of(tokens)
+   arousal = 0.0
+   for token in tokens:
+      if token in AROUSAL:
+         arousal += AROUSAL[token]
+   return arousal, sum(1 for token in tokens if token in OUTRAGE)
+
+def sparse_scores(token_lists):
+   scorer = lexicons.LexiconScorer({'arousal': AROUSAL, 'expanded_outrage': OUTRAGE})
+   counts = scorer.count_matrix(token_lists)
+   return scorer.score(counts, 'arousal'), scorer.score(counts, 'expanded_outrage')
+
+def assert_same_scores(token_lists):
+   arousal, outrage = sparse_scores(token_lists)
+   expected = [row_scores(tokens) for tokens in token_lists]
+   assert np.array_equal(arousal, np.array([score for score, _ in expected]))
+   assert np.array_equal(outrage, np.array([count for _, count in expected], dtype = np.float64))
+
+def test_repeated_tokens():
+   assert_same_scores([['angri', 'calm', 'angri'], ['outrag', 'outrag', 'outrag'], ['angri'] * 50])
+
+def test_tweets_without_tokens():
+   assert_same_scores([[], '', ['unknown'], 'unknown words only'])
+
+def test_tokens_separated_by_spaces():
+   assert_same_scores(['angri calm angri', 'sad  furious', ['angri', 'calm', 'angri']])
+
+def test_random_tweets():
+   rng = random.Random(0)
+   words = list(AROUSAL) + OUTRAGE + ['word{}'.format(i) for i in range(20)]
+   assert_same_scores([[rng.choice(words) for _ in range(rng.randint(0, 40))] for _ in range(5000)])